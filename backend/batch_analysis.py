@@ -0,0 +1,197 @@
+# batch_analysis.py
+"""
+Offline emotion scoring for exported chat logs.
+
+Reads a JSONL file (one message object per line), scores each message with
+detect_emotion_percentages and get_significant_emotions in a pool of worker processes
+(each loads its own model), and appends one JSON result per line to the output file.
+Progress is checkpointed after every chunk, so an interrupted run picks up where it left off.
+
+    python batch_analysis.py transcripts.jsonl emotions.jsonl --workers 2 --text-field text --id-field id
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import chatbot_logic
+from chatbot_logic import load_llm, detect_emotion_percentages, get_significant_emotions
+
+try:
+    from emotion_vectors import scores_matrix, significant_emotions_batch
+except ImportError: # NumPy missing; fall back to scoring significance one message at a time
+    significant_emotions_batch = None
+
+# === CONFIGURATION ===
+BATCH_WORKERS = max(1, int(os.getenv("BATCH_WORKERS", 1))) # Processes; each holds a model instance
+BATCH_CHUNK_SIZE = max(1, int(os.getenv("BATCH_CHUNK_SIZE", 16))) # Messages per task and per checkpoint
+PROGRESS_INTERVAL = 10.0 # Seconds between progress log lines
+
+# === Worker Process ===
+_worker_llm: Optional[Any] = None
+_worker_options = {"text_field": "text", "id_field": "id"}
+
+
+def _init_worker(threads: int, text_field: str, id_field: str):
+    global _worker_llm
+    _worker_options.update(text_field=text_field, id_field=id_field)
+    chatbot_logic.MODEL_THREADS = threads # Split cores between worker processes
+    _worker_llm = load_llm()
+
+
+def score_chunk(chunk: List[Tuple[int, str]]) -> List[Dict[str, Any]]:
+    """Scores (line_number, raw_line) pairs. Bad lines become error records instead of failing the chunk."""
+    results, scored = [], []
+    for line_number, raw in chunk:
+        record: Dict[str, Any] = {"line": line_number}
+        try:
+            message = json.loads(raw)
+            text = message[_worker_options["text_field"]]
+            if _worker_options["id_field"] in message:
+                record["id"] = message[_worker_options["id_field"]]
+            scores = detect_emotion_percentages(str(text), _worker_llm)
+            record["emotion_scores"] = {emotion: round(score, 2) for emotion, score in scores.items()}
+            scored.append((record, scores))
+        except (ValueError, KeyError, TypeError) as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+        results.append(record)
+
+    if significant_emotions_batch and scored:
+        significant = significant_emotions_batch(scores_matrix(scores for _, scores in scored))
+    else:
+        significant = [get_significant_emotions(scores) for _, scores in scored]
+    for (record, _), emotions in zip(scored, significant):
+        record["significant_emotions"] = emotions
+    return results
+
+
+# === Checkpointing ===
+
+def checkpoint_path(output_path: str) -> str:
+    return f"{output_path}.checkpoint"
+
+
+def load_checkpoint(input_path: str, output_path: str) -> Tuple[int, int]:
+    """Returns (input lines already done, output bytes written for them); (0, 0) for a fresh run."""
+    try:
+        with open(checkpoint_path(output_path)) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return 0, 0
+    if checkpoint.get("input") != os.path.abspath(input_path):
+        raise ValueError(f"Checkpoint for {output_path} belongs to {checkpoint.get('input')}, not {input_path}.")
+    return checkpoint["lines_done"], checkpoint["output_bytes"]
+
+
+def save_checkpoint(input_path: str, output_path: str, lines_done: int, output_bytes: int):
+    tmp_path = checkpoint_path(output_path) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"input": os.path.abspath(input_path), "lines_done": lines_done, "output_bytes": output_bytes}, f)
+    os.replace(tmp_path, checkpoint_path(output_path)) # Atomic, so a crash leaves the previous checkpoint intact
+
+
+# === Driver ===
+
+def read_chunks(input_path: str, skip: int, chunk_size: int) -> Iterator[Tuple[List[Tuple[int, str]], int]]:
+    """Yields (chunk of (line_number, line), last line number), skipping the first `skip` lines."""
+    with open(input_path, encoding="utf-8") as f:
+        lines = enumerate(islice(f, skip, None), start=skip + 1)
+        while True:
+            chunk = [(number, line) for number, line in islice(lines, chunk_size)]
+            if not chunk:
+                return
+            yield chunk, chunk[-1][0]
+
+
+def analyze_file(input_path: str, output_path: str, workers: int = BATCH_WORKERS, chunk_size: int = BATCH_CHUNK_SIZE,
+                 text_field: str = "text", id_field: str = "id", resume: bool = True) -> Dict[str, Any]:
+    """
+    Scores every message in input_path into output_path and returns a summary with throughput.
+    At most two chunks per worker are in flight and results are written in input order,
+    so memory stays flat however large the file is.
+    """
+    lines_done, output_bytes = load_checkpoint(input_path, output_path) if resume else (0, 0)
+    if lines_done:
+        logging.info(f"Resuming {input_path} after line {lines_done}.")
+    threads = max(1, (os.cpu_count() or 1) // workers)
+
+    scored = errors = 0
+    started = last_report = time.perf_counter()
+    mode = "r+" if lines_done and os.path.exists(output_path) else "w"
+    with open(output_path, mode, encoding="utf-8") as out, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                initargs=(threads, text_field, id_field)) as pool:
+        out.seek(output_bytes)
+        out.truncate() # Drop results written after the last checkpoint; they'll be redone
+        in_flight: deque = deque()
+        chunks = read_chunks(input_path, lines_done, chunk_size)
+
+        def submit_next() -> bool:
+            item = next(chunks, None)
+            if item is None:
+                return False
+            chunk, last_line = item
+            in_flight.append((pool.submit(score_chunk, [(n, line) for n, line in chunk if line.strip()]), last_line))
+            return True
+
+        while len(in_flight) < workers * 2 and submit_next():
+            pass
+        while in_flight:
+            future, last_line = in_flight.popleft()
+            for record in future.result():
+                out.write(json.dumps(record) + "\n")
+                scored += "error" not in record
+                errors += "error" in record
+            out.flush()
+            save_checkpoint(input_path, output_path, last_line, out.tell())
+            submit_next()
+
+            now = time.perf_counter()
+            if now - last_report >= PROGRESS_INTERVAL:
+                logging.info(f"Scored {scored + errors} messages ({(scored + errors) / (now - started):.2f} msg/s), up to line {last_line}.")
+                last_report = now
+
+    elapsed = time.perf_counter() - started
+    return {
+        "input": input_path,
+        "output": output_path,
+        "resumed_after_line": lines_done,
+        "messages": scored + errors,
+        "scored": scored,
+        "errors": errors,
+        "workers": workers,
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round((scored + errors) / elapsed, 2) if elapsed else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="JSONL file with one message object per line")
+    parser.add_argument("output", help="JSONL file to write results to")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS, help="Worker processes, each with its own model")
+    parser.add_argument("--chunk-size", type=int, default=BATCH_CHUNK_SIZE, help="Messages per task and per checkpoint")
+    parser.add_argument("--text-field", default="text", help="Field holding the message text")
+    parser.add_argument("--id-field", default="id", help="Field copied to each result to identify the message")
+    parser.add_argument("--restart", action="store_true", help="Ignore any checkpoint and start from the first line")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        summary = analyze_file(args.input, args.output, max(1, args.workers), max(1, args.chunk_size),
+                               args.text_field, args.id_field, resume=not args.restart)
+    except (OSError, ValueError) as e:
+        sys.exit(f"Batch analysis failed: {e}")
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
+
+# --- End of batch_analysis.py ---
@@ -0,0 +1,150 @@
+# conflict_resolution.py
+"""
+Checks the compiled conflict resolution against the original implementation and times both,
+plus the batched NumPy path. Run from the backend directory:
+
+    python benchmarks/conflict_resolution.py --vectors 20000
+
+The original took candidates in set.pop() order, which depends on string hash randomization,
+so its result could differ between processes whenever conflicts chain (A beats B, B beats C).
+The reference below is the original code with candidates popped in descending score order
+(ties in EMOTION_LIST order), the order the compiled version fixes.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from chatbot_logic import EMOTION_LIST, INCOMPATIBILITY_MATRIX, get_significant_emotions
+
+
+# === Reference (original implementation, deterministic pop order) ===
+
+class _OrderedPop(list):
+    """Stands in for the original's set: pop() returns the highest-scoring remaining emotion."""
+
+    def __init__(self, emotions, emotion_scores):
+        key = lambda e: (-emotion_scores.get(e, 0), EMOTION_LIST.index(e) if e in EMOTION_LIST else len(EMOTION_LIST), e)
+        super().__init__(sorted(set(emotions), key=key))
+
+    def pop(self):
+        return super().pop(0)
+
+
+def reference_resolve_conflicts(emotion_scores: dict, selected_emotions: list) -> list:
+    selected = selected_emotions.copy()
+    resolved_list = []
+    emotions_to_process = _OrderedPop(selected, emotion_scores)
+    while emotions_to_process:
+        current_emotion = emotions_to_process.pop()
+        is_compatible = True
+        incompatible_list = INCOMPATIBILITY_MATRIX.get(current_emotion, [])
+        temp_resolved = resolved_list.copy()
+        for other_emotion in temp_resolved:
+            other_incompatible_list = INCOMPATIBILITY_MATRIX.get(other_emotion, [])
+            if other_emotion in incompatible_list or current_emotion in other_incompatible_list:
+                if emotion_scores.get(current_emotion, 0) < emotion_scores.get(other_emotion, 0):
+                    is_compatible = False; break
+                else:
+                    resolved_list.remove(other_emotion)
+        if is_compatible: resolved_list.append(current_emotion)
+    final_resolved = []
+    emotions_to_recheck = _OrderedPop(resolved_list, emotion_scores)
+    while emotions_to_recheck:
+        current_emotion = emotions_to_recheck.pop()
+        is_compatible = True
+        incompatible_list = INCOMPATIBILITY_MATRIX.get(current_emotion, [])
+        temp_final = final_resolved.copy()
+        for other_emotion in temp_final:
+            other_incompatible_list = INCOMPATIBILITY_MATRIX.get(other_emotion, [])
+            if other_emotion in incompatible_list or current_emotion in other_incompatible_list:
+                 if emotion_scores.get(current_emotion, 0) < emotion_scores.get(other_emotion, 0):
+                    is_compatible = False; break
+                 else: final_resolved.remove(other_emotion)
+        if is_compatible: final_resolved.append(current_emotion)
+    final_resolved.sort(key=lambda e: emotion_scores.get(e, 0), reverse=True)
+    return final_resolved
+
+
+def reference_significant_emotions(emotion_scores: dict, threshold=30.0) -> list:
+    if not emotion_scores: return ["neutral"]
+    strong_emotions = [e for e, s in emotion_scores.items() if s >= threshold]
+    if not strong_emotions:
+        sorted_emotions = sorted(emotion_scores.items(), key=lambda x: x[1], reverse=True)
+        strong_emotions = [e for e, s in sorted_emotions[:3] if s > 0]
+        if not strong_emotions: return ["neutral"]
+    resolved = reference_resolve_conflicts(emotion_scores, strong_emotions)
+    if not resolved:
+         sorted_emotions = sorted(emotion_scores.items(), key=lambda x: x[1], reverse=True)
+         if sorted_emotions and sorted_emotions[0][1] > 0: return [sorted_emotions[0][0]]
+         else: return ["neutral"]
+    return resolved
+
+
+# === Inputs ===
+
+def random_scores(rng: random.Random) -> dict:
+    """Score vectors like the parser produces: a few non-zero emotions, often tied, summing to ~100."""
+    scores = {emotion: 0.0 for emotion in EMOTION_LIST}
+    chosen = rng.sample(EMOTION_LIST, rng.randint(0, 6))
+    weights = [rng.choice([5, 10, 15, 20, 25, 30, 35, 40, 50]) for _ in chosen]
+    total = sum(weights) or 1
+    for emotion, weight in zip(chosen, weights):
+        scores[emotion] = round(100.0 * weight / total, 1) if rng.random() < 0.8 else float(weight)
+    return scores
+
+
+def timed(fn, inputs) -> tuple:
+    started = time.perf_counter()
+    results = [fn(scores) for scores in inputs]
+    return results, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    inputs = [random_scores(rng) for _ in range(args.vectors)]
+
+    expected, reference_seconds = timed(reference_significant_emotions, inputs)
+    compiled, compiled_seconds = timed(get_significant_emotions, inputs)
+    mismatches = sum(1 for a, b in zip(expected, compiled) if a != b)
+    results = {
+        "benchmark": "conflict_resolution",
+        "vectors": args.vectors,
+        "reference_us_per_vector": round(reference_seconds / args.vectors * 1e6, 2),
+        "compiled_us_per_vector": round(compiled_seconds / args.vectors * 1e6, 2),
+        "compiled_mismatches": mismatches,
+    }
+
+    try:
+        from emotion_vectors import scores_matrix, significant_emotions_batch
+    except ImportError:
+        results["numpy"] = "not installed"
+    else:
+        matrix = scores_matrix(inputs)
+        started = time.perf_counter()
+        batched = significant_emotions_batch(matrix)
+        numpy_seconds = time.perf_counter() - started
+        results["numpy_us_per_vector"] = round(numpy_seconds / args.vectors * 1e6, 2)
+        results["numpy_mismatches"] = sum(1 for a, b in zip(expected, batched) if a != b)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if mismatches or results.get("numpy_mismatches"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# emotion_decoding.py
+"""
+Compares free-form and constrained (structured) emotion scoring on a real GGUF model.
+
+For each sample message both modes score the text; the benchmark reports latency, tokens
+generated and how often the free-form reply couldn't be parsed (all-neutral fallback).
+Needs MODEL_PATH to point at a ctransformers model. Run from the backend directory:
+
+    python benchmarks/emotion_decoding.py --repeats 3 --output emotion_decoding.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from chatbot_logic import load_llm, build_emotion_prompt, parse_emotion_response, NEUTRAL_SCORES
+from structured_decoding import decode_emotion_scores, supports_constrained_decoding
+
+MESSAGES = [
+    "I feel sad today", "I'm stressed about work", "I can't stop worrying about my exams",
+    "I feel so lonely lately", "I'm angry at my roommate", "I'm bored and tired",
+    "Honestly I don't know how I feel", "I just got the job and I'm so excited!",
+]
+
+
+def summarize(latencies: list, tokens: list, fallbacks: int) -> dict:
+    return {
+        "calls": len(latencies),
+        "latency_avg_ms": round(statistics.mean(latencies) * 1000, 1),
+        "latency_p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "generated_tokens_avg": round(statistics.mean(tokens), 1),
+        "generated_tokens_max": max(tokens),
+        "neutral_fallbacks": fallbacks,
+    }
+
+
+def bench_free_form(llm, messages: list) -> dict:
+    latencies, tokens, fallbacks = [], [], 0
+    for text in messages:
+        started = time.perf_counter()
+        response = llm(build_emotion_prompt(text))
+        latencies.append(time.perf_counter() - started)
+        tokens.append(len(llm.tokenize(response)))
+        fallbacks += parse_emotion_response(response) == NEUTRAL_SCORES
+    return summarize(latencies, tokens, fallbacks)
+
+
+def bench_structured(llm, messages: list) -> dict:
+    latencies, tokens, fallbacks = [], [], 0
+    for text in messages:
+        started = time.perf_counter()
+        scores, _, generated = decode_emotion_scores(text, llm)
+        latencies.append(time.perf_counter() - started)
+        tokens.append(generated)
+        fallbacks += scores == NEUTRAL_SCORES
+    return summarize(latencies, tokens, fallbacks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=1, help="Passes over the sample messages")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    llm = load_llm()
+    if not supports_constrained_decoding(llm):
+        sys.exit("The loaded model has no token-level access (MockLLM?). Set MODEL_PATH to a GGUF model.")
+
+    decode_emotion_scores(MESSAGES[0], llm) # Warm up: the first structured call scans the vocabulary
+    messages = MESSAGES * args.repeats
+    free_form = bench_free_form(llm, messages)
+    structured = bench_structured(llm, messages)
+    results = {
+        "benchmark": "emotion_decoding",
+        "free_form": free_form,
+        "structured": structured,
+        "token_reduction": round(1 - structured["generated_tokens_avg"] / max(free_form["generated_tokens_avg"], 1), 3),
+        "speedup": round(free_form["latency_avg_ms"] / max(structured["latency_avg_ms"], 0.1), 2),
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# fairness.py
+"""
+Light-user latency while heavy users flood /chat/message.
+
+Light users hold normal conversations with think time between turns. At the same time, heavy
+users send turns back to back on a single user_id each, and a flood sends every turn from a
+new user_id. The benchmark runs once with the fair-share scheduler (FAIR_SHARE=true) and once
+without it, each in a fresh process, all in-process (ASGI, no network) with the MockLLM. It
+reports light-user latency percentiles, status counts per group and the scheduler's shed and
+starved counts. Run from the backend directory:
+
+    python benchmarks/fairness.py --seconds 20 --light-users 20 --heavy-users 2 --flood 20 --output fairness.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+from load_bench import (
+    FIRST_MESSAGES, FOLLOW_UPS, AsgiLifespan, asgi_post, start_stub_providers, wait_until_ready,
+    percentiles, git_commit,
+)
+
+
+async def light_user(app, index: int, deadline: float, think: float, latencies: dict, statuses: dict):
+    """A person chatting: a new conversation, then follow-ups with think time until it ends."""
+    while time.perf_counter() < deadline:
+        user_id = f"light-{index}-{random.randint(0, 1 << 30)}"
+        messages = [random.choice(FIRST_MESSAGES)] + random.sample(FOLLOW_UPS, k=len(FOLLOW_UPS))
+        for position, text in enumerate(messages):
+            if time.perf_counter() >= deadline:
+                return
+            started = time.perf_counter()
+            status, body = await asgi_post(app, "/chat/message", {"user_id": user_id, "text": text})
+            elapsed = time.perf_counter() - started
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200:
+                latencies["new_session" if position == 0 else "continue_session"].append(elapsed)
+            if status != 200 or json.loads(body).get("conversation_ended"):
+                break
+            await asyncio.sleep(think * random.uniform(0.5, 1.5))
+
+
+async def heavy_stream(app, user_id: str, deadline: float, statuses: dict):
+    """One of several concurrent request loops on the same user_id, resending as soon as an answer arrives."""
+    while time.perf_counter() < deadline:
+        status, _ = await asgi_post(app, "/chat/message", {"user_id": user_id, "text": random.choice(FOLLOW_UPS)})
+        statuses[status] = statuses.get(status, 0) + 1
+        # Cached replies and refusals complete without suspending; a network client would yield here
+        await asyncio.sleep(0.01 if status != 200 else 0)
+
+
+async def flood_stream(app, index: int, deadline: float, statuses: dict):
+    """Sends every turn as a new conversation from a fresh user_id."""
+    while time.perf_counter() < deadline:
+        user_id = f"flood-{index}-{random.randint(0, 1 << 30)}"
+        status, _ = await asgi_post(app, "/chat/message", {"user_id": user_id, "text": random.choice(FIRST_MESSAGES)})
+        statuses[status] = statuses.get(status, 0) + 1
+        await asyncio.sleep(0.01 if status != 200 else 0)
+
+
+async def run(args) -> dict:
+    import main # Imported after the environment is configured
+
+    lifespan = AsgiLifespan(main.app)
+    await lifespan.start()
+    await wait_until_ready(main.app)
+
+    latencies = {"new_session": [], "continue_session": []}
+    light_statuses: dict = {}
+    heavy_statuses: dict = {}
+    flood_statuses: dict = {}
+    deadline = time.perf_counter() + args.seconds
+    tasks = [light_user(main.app, i, deadline, args.think_ms / 1000, latencies, light_statuses) for i in range(args.light_users)]
+    tasks += [heavy_stream(main.app, f"heavy-{i}", deadline, heavy_statuses)
+              for i in range(args.heavy_users) for _ in range(args.heavy_concurrency)]
+    tasks += [flood_stream(main.app, i, deadline, flood_statuses) for i in range(args.flood)]
+    await asyncio.gather(*tasks)
+
+    fair_share = main.fair_share.stats() if main.fair_share else None
+    await lifespan.stop()
+
+    counts = lambda statuses: {str(status): count for status, count in sorted(statuses.items())}
+    return {
+        "fair_share": os.environ["FAIR_SHARE"],
+        "light_latency": {path: percentiles(values) for path, values in latencies.items()},
+        "light_status_counts": counts(light_statuses),
+        "heavy_status_counts": counts(heavy_statuses),
+        "flood_status_counts": counts(flood_statuses),
+        "scheduler": fair_share,
+    }
+
+
+def run_mode(args, fair_share: str) -> dict:
+    """Runs one mode in a fresh process, since the configuration is read at import time."""
+    command = [sys.executable, os.path.abspath(__file__), "--mode", fair_share] + [
+        f"--{name.replace('_', '-')}={value}" for name, value in vars(args).items()
+        if name not in ("mode", "output") and value is not None
+    ]
+    output = subprocess.check_output(command, text=True)
+    return json.loads(output)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--light-users", type=int, default=20, help="People chatting with think time between turns")
+    parser.add_argument("--think-ms", type=float, default=2000, help="Average pause between a light user's turns")
+    parser.add_argument("--heavy-users", type=int, default=2, help="User IDs hammered with back-to-back turns")
+    parser.add_argument("--heavy-concurrency", type=int, default=20, help="Concurrent request loops per heavy user")
+    parser.add_argument("--flood", type=int, default=20, help="Concurrent loops sending each turn from a new user ID")
+    parser.add_argument("--llm-latency-ms", type=float, default=50)
+    parser.add_argument("--llm-jitter-ms", type=float, default=10)
+    parser.add_argument("--provider-latency-ms", type=float, default=20)
+    parser.add_argument("--mode", choices=("true", "false"), help="Run only this FAIR_SHARE setting in this process")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    if args.mode is None:
+        results = {
+            "benchmark": "fairness",
+            "commit": git_commit(),
+            "config": {name: value for name, value in vars(args).items() if name not in ("mode", "output")},
+            "fair_share": run_mode(args, "true"),
+            "fifo": run_mode(args, "false"),
+        }
+        print(json.dumps(results, indent=2))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        return
+
+    stub = start_stub_providers(args.provider_latency_ms)
+    base = f"http://127.0.0.1:{stub.server_port}"
+    scratch = tempfile.TemporaryDirectory() # A fresh catalog per run; never the real one in the working directory
+    os.environ.update({
+        "FAIR_SHARE": args.mode,
+        "USE_MOCK_LLM": "true",
+        "MOCK_LLM_LATENCY_MS": str(args.llm_latency_ms),
+        "MOCK_LLM_JITTER_MS": str(args.llm_jitter_ms),
+        "RAPIDAPI_MOVIES_URL": f"{base}/movies",
+        "OPENLIBRARY_SEARCH_URL": f"{base}/books",
+        "CONVERSATION_STORE": os.getenv("CONVERSATION_STORE", "memory"),
+        "RECOMMENDATION_CATALOG_PATH": os.path.join(scratch.name, "recommendation_catalog.db"),
+    })
+    results = asyncio.run(run(args))
+    stub.shutdown()
+    scratch.cleanup()
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,289 @@
+# load_bench.py
+"""
+Offline load test for the chat pipeline.
+
+Drives the FastAPI app in-process (ASGI, no network) with many concurrent synthetic
+conversations. Each conversation covers the three paths through /chat/message: a new session,
+continuing turns, and an ending turn that triggers recommendations. The model is the MockLLM
+with injectable latency, and the movie/book providers are a local stub HTTP server.
+
+Reports p50/p95/p99 latency per path, throughput, event-loop lag and memory per session,
+and writes JSON that can be compared between commits. Run from the backend directory:
+
+    python benchmarks/load_bench.py --conversations 200 --concurrency 50 --llm-latency-ms 50 --output results.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+FIRST_MESSAGES = [
+    "I feel sad today", "I'm stressed about work", "I can't stop worrying about my exams",
+    "I feel so lonely lately", "I'm angry at my roommate", "I'm bored and tired",
+]
+FOLLOW_UPS = [
+    "It has been going on for a while", "Mostly at night when I'm alone", "I keep overthinking things",
+    "My family doesn't really get it", "I haven't talked to anyone about it",
+]
+
+
+# === Stub Providers ===
+
+class StubProviderHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if self.path.startswith("/movies"):
+            body = {"movies": [{"title": f"Stub Movie {i}"} for i in range(5)]}
+        elif self.path.startswith("/books"):
+            body = {"docs": [{"title": f"Stub Book {i}", "author_name": ["Stub Author"]} for i in range(5)]}
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass # Keep benchmark output clean
+
+
+def start_stub_providers(latency_ms: float) -> ThreadingHTTPServer:
+    StubProviderHandler.latency = latency_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubProviderHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# === Minimal In-Process ASGI Client ===
+
+class AsgiLifespan:
+    """Runs the app's startup handlers on start() and its shutdown handlers on stop()."""
+
+    def __init__(self, app):
+        self.app = app
+        self._messages: asyncio.Queue = asyncio.Queue()
+        self._events = {"startup": asyncio.Event(), "shutdown": asyncio.Event()}
+        self._task = None
+
+    async def _receive(self):
+        return await self._messages.get()
+
+    async def _send(self, message):
+        phase = message["type"].split(".")[1] # lifespan.startup.complete -> startup
+        self._events[phase].set()
+
+    async def start(self):
+        self._task = asyncio.ensure_future(self.app({"type": "lifespan", "asgi": {"version": "3.0"}}, self._receive, self._send))
+        await self._messages.put({"type": "lifespan.startup"})
+        await self._events["startup"].wait()
+
+    async def stop(self):
+        await self._messages.put({"type": "lifespan.shutdown"})
+        await self._events["shutdown"].wait()
+        await self._task
+
+
+async def wait_until_ready(app, timeout: float = 60.0):
+    """The model loads in the background after startup; measuring before /readyz passes would time degraded replies."""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        status, _ = await asgi_get(app, "/readyz")
+        if status == 200:
+            return
+        await asyncio.sleep(0.05)
+    raise RuntimeError(f"App wasn't ready after {timeout}s.")
+
+
+async def asgi_get(app, path: str):
+    return await asgi_request(app, "GET", path, b"")
+
+
+async def asgi_post(app, path: str, payload: dict):
+    return await asgi_request(app, "POST", path, json.dumps(payload).encode())
+
+
+async def asgi_request(app, method: str, path: str, body: bytes):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method,
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 50000), "server": ("testserver", 80),
+    }
+    request_sent = False
+    response = {"status": 0, "body": b""}
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await asyncio.Event().wait() # No disconnect; the app cancels this when it's done
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+
+    await app(scope, receive, send)
+    return response["status"], response["body"]
+
+
+# === Measurements ===
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {
+        "count": len(ordered),
+        "p50_ms": round(pick(0.50) * 1000, 2),
+        "p95_ms": round(pick(0.95) * 1000, 2),
+        "p99_ms": round(pick(0.99) * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2),
+    }
+
+
+async def monitor_loop_lag(samples: list, stop: asyncio.Event, interval: float = 0.01):
+    """Event-loop lag: how late a short sleep wakes up. Blocking work on the loop shows up here."""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.perf_counter() - started - interval))
+
+
+async def run_conversation(app, index: int, turns: int, latencies: dict, statuses: dict):
+    user_id = f"load-{index}-{random.randint(0, 1 << 30)}"
+    messages = [random.choice(FIRST_MESSAGES)] + random.sample(FOLLOW_UPS, k=min(turns, len(FOLLOW_UPS))) + ["bye"]
+    for position, text in enumerate(messages):
+        path = "new_session" if position == 0 else "end_conversation" if text == "bye" else "continue_session"
+        started = time.perf_counter()
+        status, _ = await asgi_post(app, "/chat/message", {"user_id": user_id, "text": text})
+        elapsed = time.perf_counter() - started
+        statuses[status] = statuses.get(status, 0) + 1
+        if status == 200:
+            latencies[path].append(elapsed)
+        else:
+            return # The conversation can't continue meaningfully after an error
+
+
+async def measure_memory_per_session(app, sessions: int) -> float:
+    """Opens sessions without ending them and measures traced allocations per session."""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(sessions):
+        await asgi_post(app, "/chat/message", {"user_id": f"memory-{i}", "text": random.choice(FIRST_MESSAGES)})
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    grown = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return grown / sessions if sessions else 0.0
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+async def run(args) -> dict:
+    import main # Imported after the environment is configured
+
+    lifespan = AsgiLifespan(main.app)
+    await lifespan.start()
+    await wait_until_ready(main.app)
+    latencies = {"new_session": [], "continue_session": [], "end_conversation": []}
+    statuses: dict = {}
+    lag_samples: list = []
+    stop = asyncio.Event()
+    monitor = asyncio.ensure_future(monitor_loop_lag(lag_samples, stop))
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(index):
+        async with semaphore:
+            await run_conversation(main.app, index, args.turns, latencies, statuses)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(i) for i in range(args.conversations)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await monitor
+
+    memory_per_session = await measure_memory_per_session(main.app, args.memory_sessions)
+    await lifespan.stop()
+
+    completed = sum(len(values) for values in latencies.values())
+    return {
+        "benchmark": "load_test",
+        "commit": git_commit(),
+        "config": {
+            "conversations": args.conversations, "concurrency": args.concurrency, "turns": args.turns,
+            "llm_latency_ms": args.llm_latency_ms, "provider_latency_ms": args.provider_latency_ms,
+        },
+        "seconds": round(elapsed, 3),
+        "requests_ok": completed,
+        "status_counts": {str(status): count for status, count in sorted(statuses.items())},
+        "throughput_rps": round(completed / elapsed, 2) if elapsed else 0.0,
+        "latency": {path: percentiles(values) for path, values in latencies.items()},
+        "event_loop_lag": percentiles(lag_samples),
+        "memory_per_session_bytes": round(memory_per_session),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=3, help="Continuing turns per conversation")
+    parser.add_argument("--llm-latency-ms", type=float, default=50)
+    parser.add_argument("--llm-jitter-ms", type=float, default=10)
+    parser.add_argument("--provider-latency-ms", type=float, default=20)
+    parser.add_argument("--memory-sessions", type=int, default=200, help="Sessions opened for the memory measurement")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    stub = start_stub_providers(args.provider_latency_ms)
+    base = f"http://127.0.0.1:{stub.server_port}"
+    scratch = tempfile.TemporaryDirectory() # A fresh catalog per run; never the real one in the working directory
+    os.environ.update({
+        "USE_MOCK_LLM": "true",
+        "MOCK_LLM_LATENCY_MS": str(args.llm_latency_ms),
+        "MOCK_LLM_JITTER_MS": str(args.llm_jitter_ms),
+        "RAPIDAPI_MOVIES_URL": f"{base}/movies",
+        "OPENLIBRARY_SEARCH_URL": f"{base}/books",
+        "CONVERSATION_STORE": os.getenv("CONVERSATION_STORE", "memory"),
+        "RECOMMENDATION_CATALOG_PATH": os.path.join(scratch.name, "recommendation_catalog.db"),
+        # Synthetic users answer instantly, far above a person's turn rate; fairness is measured by fairness.py
+        "FAIR_SHARE_USER_RATE": os.getenv("FAIR_SHARE_USER_RATE", "0"),
+    })
+
+    results = asyncio.run(run(args))
+    stub.shutdown()
+    scratch.cleanup()
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,134 @@
+# prompt_window_bench.py
+"""
+Compares follow-up prompts before and after token-aware windowing.
+
+"before" is the old prompt: the last 6 history entries, however long. "after" fits the newest
+entries into FOLLOWUP_PROMPT_TOKENS and folds older ones into a rolling summary, as the API does.
+Synthetic conversations mix short turns with long user messages. The benchmark reports the
+distribution of prompt tokens (model tokenizer) and prefill time (time to the first generated
+token) per follow-up prompt. Prefill is only measured with a real GGUF model (MODEL_PATH); with
+the MockLLM, token counts are estimates. Run from the backend directory:
+
+    python benchmarks/prompt_window_bench.py --conversations 10 --output prompt_window.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from collections import deque
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from chatbot_logic import (
+    load_llm, build_followup_preamble, build_followup_prompt, followup_history_budget, build_summary_prompt,
+    parse_summary_response, FOLLOWUP_INSTRUCTIONS, SUMMARY_PROFILE, MAX_CHAT_ROUNDS,
+)
+from conversation_store import CONVERSATION_HISTORY_LIMIT
+from generation import generate_with_profile
+from prompt_window import TokenCounter, window_history
+
+SHORT = ["I feel sad today", "It's mostly work", "Yes, every night", "Not really", "I guess so"]
+LONG_SENTENCES = [
+    "My manager keeps moving deadlines and I end up staying late almost every evening.",
+    "I haven't seen my friends in weeks because by the time I get home I'm exhausted.",
+    "Sometimes I lie awake replaying conversations and wondering if I said the wrong thing.",
+    "My family thinks I'm doing fine, so I don't really want to worry them with any of this.",
+    "I used to enjoy running, but lately I can't find the energy to get out of the door.",
+]
+ASSISTANT = "That sounds like a lot to carry. What has been the hardest part of it for you?"
+EMOTIONS = ["sadness", "stress"]
+
+
+def user_message(long_share: float) -> str:
+    if random.random() < long_share:
+        return " ".join(random.choices(LONG_SENTENCES, k=random.randint(4, 12)))
+    return random.choice(SHORT)
+
+
+def legacy_followup_prompt(significant_emotions: list, history: list) -> str:
+    """The follow-up prompt before windowing: the last 6 entries, whatever their length."""
+    history_text = "\n".join(f"{entry['role']}: {entry['content']}" for entry in history[-6:])
+    return f"""{build_followup_preamble(significant_emotions)}Recent conversation:
+{history_text}
+{FOLLOWUP_INSTRUCTIONS}"""
+
+
+def prefill_seconds(llm, prompt: str) -> float:
+    started = time.perf_counter()
+    for _ in llm(prompt, stream=True, max_new_tokens=1):
+        break
+    return time.perf_counter() - started
+
+
+def distribution(values: list, unit: str) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    scale, digits = (1000, 2) if unit == "ms" else (1, 0)
+    result = {"count": len(ordered)}
+    for name, q in (("p50", 0.5), ("p95", 0.95), ("max", 1.0)):
+        result[f"{name}_{unit}"] = round(pick(q) * scale, digits)
+    return result
+
+
+def run(llm, conversations: int, long_share: float) -> dict:
+    count = TokenCounter(llm)
+    measure_prefill = count.exact # MockLLM timings say nothing about prompt evaluation
+    results = {mode: {"tokens": [], "prefill": []} for mode in ("before", "after")}
+    summaries = 0
+    for _ in range(conversations):
+        history = deque(maxlen=CONVERSATION_HISTORY_LIMIT)
+        summary = None
+        for _ in range(MAX_CHAT_ROUNDS):
+            history.append({"role": "user", "content": user_message(long_share)})
+            prompts = {
+                "before": legacy_followup_prompt(EMOTIONS, list(history)),
+                "after": build_followup_prompt(EMOTIONS, history, summary, count),
+            }
+            for mode, prompt in prompts.items():
+                results[mode]["tokens"].append(count(prompt))
+                if measure_prefill:
+                    results[mode]["prefill"].append(prefill_seconds(llm, prompt))
+            history.append({"role": "assistant", "content": ASSISTANT})
+
+            # Fold what no longer fits, like summarize_history in main.py
+            _, budget = followup_history_budget(EMOTIONS, summary, count)
+            _, left_out, _ = window_history(list(history), budget, count)
+            if left_out > 0:
+                folded = [history.popleft() for _ in range(left_out)]
+                summary = parse_summary_response(generate_with_profile(build_summary_prompt(summary, folded), SUMMARY_PROFILE, llm))
+                summaries += 1
+
+    return {
+        "exact_token_counts": count.exact,
+        "summaries": summaries,
+        **{mode: {
+            "prompt_tokens": distribution(values["tokens"], "tokens"),
+            "prefill": distribution(values["prefill"], "ms") if measure_prefill else None,
+        } for mode, values in results.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=10)
+    parser.add_argument("--long-share", type=float, default=0.4, help="Fraction of user messages that are long")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    llm = load_llm()
+    results = {"benchmark": "prompt_window", **run(llm, args.conversations, args.long_share)}
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
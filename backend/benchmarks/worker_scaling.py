@@ -0,0 +1,115 @@
+# worker_scaling.py
+"""
+Measures /chat/message throughput as the number of uvicorn workers changes.
+
+For each worker count a fresh server is started with `python main.py` (UVICORN_WORKERS=N),
+driven with concurrent synthetic conversations, then stopped. Run from the backend directory:
+
+    python benchmarks/worker_scaling.py --workers 1 2 4 --requests 400 --concurrency 32
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MESSAGES = ["I feel sad today", "Work has been really stressful", "I can't sleep", "bye"]
+
+
+def post_json(url: str, payload: dict, timeout: float = 120) -> int:
+    request = urllib.request.Request(url, data=json.dumps(payload).encode(), headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except Exception:
+        return 0
+
+
+def wait_until_up(base_url: str, timeout: float = 600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(base_url + "/", timeout=2):
+                return
+        except Exception:
+            time.sleep(0.5)
+    raise RuntimeError(f"Server at {base_url} did not come up within {timeout}s")
+
+
+def run_conversation(base_url: str, user_id: str) -> list:
+    """Plays one short conversation; returns (status, seconds) per request."""
+    results = []
+    for text in MESSAGES:
+        started = time.perf_counter()
+        status = post_json(base_url + "/chat/message", {"user_id": user_id, "text": text})
+        results.append((status, time.perf_counter() - started))
+    return results
+
+
+def bench_workers(workers: int, requests: int, concurrency: int, port: int) -> dict:
+    # The workers share a fresh catalog, so runs neither read nor fill the real one in the backend directory
+    scratch = tempfile.TemporaryDirectory()
+    env = dict(os.environ, UVICORN_WORKERS=str(workers), PORT=str(port),
+               RECOMMENDATION_CATALOG_PATH=os.path.join(scratch.name, "recommendation_catalog.db"))
+    if workers > 1:
+        env.setdefault("CONVERSATION_DB_PATH", os.path.join(BACKEND_DIR, f"bench_conversations_{port}.db"))
+    server = subprocess.Popen([sys.executable, "main.py"], cwd=BACKEND_DIR, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        wait_until_up(base_url)
+        conversations = max(1, requests // len(MESSAGES))
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            runs = list(pool.map(lambda i: run_conversation(base_url, f"bench-{workers}-{i}"), range(conversations)))
+        elapsed = time.perf_counter() - started
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        scratch.cleanup()
+
+    samples = [sample for run in runs for sample in run]
+    latencies = sorted(seconds for status, seconds in samples if status == 200)
+    return {
+        "workers": workers,
+        "requests": len(samples),
+        "ok": len(latencies),
+        "errors": len(samples) - len(latencies),
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--requests", type=int, default=400, help="Approximate requests per worker count")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent client conversations")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    for workers in args.workers:
+        result = bench_workers(workers, args.requests, args.concurrency, args.port)
+        print(f"workers={result['workers']:<3} rps={result['requests_per_second']:<8} "
+              f"p50={result['p50_ms']}ms p95={result['p95_ms']}ms errors={result['errors']}")
+        results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"benchmark": "worker_scaling", "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
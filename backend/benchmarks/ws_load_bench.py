@@ -0,0 +1,202 @@
+# ws_load_bench.py
+"""
+Offline load test for the /ws/chat WebSocket gateway.
+
+Opens many idle connections and runs concurrent conversations over further connections, all
+in-process (ASGI, no network), with the MockLLM and stub providers as in load_bench.py.
+Reports per-turn latency and time to first token, refused turns (backpressure), event-loop lag
+and memory per idle connection. Run from the backend directory:
+
+    python benchmarks/ws_load_bench.py --idle 5000 --conversations 500 --concurrency 200 --output ws.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+from urllib.parse import urlencode
+
+from load_bench import (
+    FIRST_MESSAGES, FOLLOW_UPS, AsgiLifespan, start_stub_providers, wait_until_ready,
+    percentiles, monitor_loop_lag, git_commit,
+)
+
+
+# === Minimal In-Process ASGI WebSocket Client ===
+
+class AsgiWebSocket:
+    def __init__(self, app, path: str, params: dict):
+        self.app = app
+        self.path = path
+        self.query = urlencode(params).encode()
+        self._to_app: asyncio.Queue = asyncio.Queue()
+        self._from_app: asyncio.Queue = asyncio.Queue()
+        self._task = None
+
+    async def connect(self):
+        scope = {
+            "type": "websocket", "asgi": {"version": "3.0"}, "scheme": "ws", "http_version": "1.1",
+            "path": self.path, "raw_path": self.path.encode(), "query_string": self.query, "root_path": "",
+            "headers": [], "subprotocols": [], "client": ("127.0.0.1", 50000), "server": ("testserver", 80),
+        }
+        self._task = asyncio.ensure_future(self.app(scope, self._to_app.get, self._from_app.put))
+        await self._to_app.put({"type": "websocket.connect"})
+        accepted = await self._from_app.get()
+        if accepted["type"] != "websocket.accept":
+            raise RuntimeError(f"Connection refused: {accepted}")
+
+    async def send_json(self, payload: dict):
+        await self._to_app.put({"type": "websocket.receive", "text": json.dumps(payload)})
+
+    async def receive_json(self) -> dict:
+        message = await self._from_app.get()
+        if message["type"] != "websocket.send":
+            raise ConnectionError(f"Connection closed: {message}")
+        return json.loads(message["text"])
+
+    async def close(self):
+        await self._to_app.put({"type": "websocket.disconnect", "code": 1000})
+        await self._task
+
+
+# === Scenarios ===
+
+async def run_conversation(app, index: int, turns: int, latencies: dict, first_tokens: list, outcomes: dict):
+    user_id = f"ws-{index}-{random.randint(0, 1 << 30)}"
+    socket = AsgiWebSocket(app, "/ws/chat", {"user_id": user_id})
+    await socket.connect()
+    messages = [random.choice(FIRST_MESSAGES)] + random.sample(FOLLOW_UPS, k=min(turns, len(FOLLOW_UPS))) + ["bye"]
+    try:
+        for position, text in enumerate(messages):
+            path = "new_session" if position == 0 else "end_conversation" if text == "bye" else "continue_session"
+            started = time.perf_counter()
+            await socket.send_json({"type": "message", "id": str(position), "text": text})
+            first = None
+            while True:
+                event = await socket.receive_json()
+                if event["type"] == "token" and first is None:
+                    first = time.perf_counter() - started
+                elif event["type"] in ("done", "error"):
+                    break
+            outcome = "ok" if event["type"] == "done" else str(event["status"])
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            if event["type"] == "error":
+                return # The conversation can't continue meaningfully after an error
+            latencies[path].append(time.perf_counter() - started)
+            if first is not None:
+                first_tokens.append(first)
+    finally:
+        await socket.close()
+
+
+async def open_idle(app, count: int) -> tuple:
+    """Opens idle connections and returns them with the traced memory they added, per connection."""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    sockets = []
+    for i in range(count):
+        socket = AsgiWebSocket(app, "/ws/chat", {"user_id": f"idle-{i}"})
+        await socket.connect()
+        sockets.append(socket)
+    await asyncio.sleep(0) # Let every connection reach its receive wait
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    grown = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return sockets, grown / count if count else 0.0
+
+
+async def run(args) -> dict:
+    import main # Imported after the environment is configured
+
+    lifespan = AsgiLifespan(main.app)
+    await lifespan.start()
+    await wait_until_ready(main.app)
+
+    idle, memory_per_connection = await open_idle(main.app, args.idle)
+    latencies = {"new_session": [], "continue_session": [], "end_conversation": []}
+    first_tokens: list = []
+    outcomes: dict = {}
+    lag_samples: list = []
+    stop = asyncio.Event()
+    monitor = asyncio.ensure_future(monitor_loop_lag(lag_samples, stop))
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(index):
+        async with semaphore:
+            await run_conversation(main.app, index, args.turns, latencies, first_tokens, outcomes)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(i) for i in range(args.conversations)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await monitor
+
+    open_connections = main.WS_CONNECTIONS.value # The idle ones; conversations closed theirs
+    for socket in idle:
+        await socket.close()
+    await lifespan.stop()
+
+    completed = sum(len(values) for values in latencies.values())
+    return {
+        "benchmark": "ws_load_test",
+        "commit": git_commit(),
+        "config": {
+            "idle_connections": args.idle, "conversations": args.conversations, "concurrency": args.concurrency,
+            "turns": args.turns, "llm_latency_ms": args.llm_latency_ms, "provider_latency_ms": args.provider_latency_ms,
+        },
+        "seconds": round(elapsed, 3),
+        "turns_ok": completed,
+        "outcomes": outcomes,
+        "throughput_turns_per_second": round(completed / elapsed, 2) if elapsed else 0.0,
+        "latency": {path: percentiles(values) for path, values in latencies.items()},
+        "time_to_first_token": percentiles(first_tokens),
+        "event_loop_lag": percentiles(lag_samples),
+        "open_connections": open_connections,
+        "memory_per_idle_connection_bytes": round(memory_per_connection),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--idle", type=int, default=2000, help="Connections opened and left idle")
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50, help="Conversations with an open connection at once")
+    parser.add_argument("--turns", type=int, default=3, help="Continuing turns per conversation")
+    parser.add_argument("--llm-latency-ms", type=float, default=50)
+    parser.add_argument("--llm-jitter-ms", type=float, default=10)
+    parser.add_argument("--provider-latency-ms", type=float, default=20)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    stub = start_stub_providers(args.provider_latency_ms)
+    base = f"http://127.0.0.1:{stub.server_port}"
+    scratch = tempfile.TemporaryDirectory() # A fresh catalog per run; never the real one in the working directory
+    os.environ.update({
+        "USE_MOCK_LLM": "true",
+        "MOCK_LLM_LATENCY_MS": str(args.llm_latency_ms),
+        "MOCK_LLM_JITTER_MS": str(args.llm_jitter_ms),
+        "RAPIDAPI_MOVIES_URL": f"{base}/movies",
+        "OPENLIBRARY_SEARCH_URL": f"{base}/books",
+        "CONVERSATION_STORE": os.getenv("CONVERSATION_STORE", "memory"),
+        "RECOMMENDATION_CATALOG_PATH": os.path.join(scratch.name, "recommendation_catalog.db"),
+        # Synthetic users answer instantly, far above a person's turn rate; fairness is measured by fairness.py
+        "FAIR_SHARE_USER_RATE": os.getenv("FAIR_SHARE_USER_RATE", "0"),
+    })
+
+    results = asyncio.run(run(args))
+    stub.shutdown()
+    scratch.cleanup()
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(0 if results["turns_ok"] else 1)
+
+
+if __name__ == "__main__":
+    main_cli()
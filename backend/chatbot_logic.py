@@ -1,10 +1,13 @@
 # chatbot_logic.py
 import os
-import json
-import requests
-from datetime import datetime
+import re
+import time
+import heapq
+import random
 import logging
-from typing import Dict, List, Tuple, Optional, Any
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List, Tuple, Optional, Any
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -15,6 +18,11 @@ from ctransformers import AutoModelForCausalLM
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
 
+import http_client
+from metrics import Counter, Histogram
+from generation import GenerationProfile, generate_with_profile, complete_question
+from prompt_window import FOLLOWUP_PROMPT_TOKENS, estimate_tokens, window_history, record_window
+
 # === CONFIGURATION ===
 # --- Model ---
 MODEL_PATH = os.getenv("MODEL_PATH")
@@ -22,6 +30,15 @@ if not MODEL_PATH:
     # Default fallback path if environment variable is not set
     MODEL_PATH = r"D:\Mistral-7B-Instruct-v0.3-GGUF\Mistral-7B-Instruct-v0.3-Q4_K_M.gguf"
     logging.warning(f"MODEL_PATH not found in environment variables. Using default: {MODEL_PATH}")
+# Memory-map the weights so every worker process maps the same read-only pages from the
+# OS page cache instead of holding its own ~4 GB copy.
+MODEL_MMAP = os.getenv("MODEL_MMAP", "true").lower() in ("1", "true", "yes")
+# CPU threads per model instance; -1 lets ctransformers decide. Split cores between workers.
+MODEL_THREADS = int(os.getenv("MODEL_THREADS", -1))
+# Force the MockLLM (benchmarks, offline testing) and give it a simulated generation time
+USE_MOCK_LLM = os.getenv("USE_MOCK_LLM", "false").lower() in ("1", "true", "yes")
+MOCK_LLM_LATENCY_MS = float(os.getenv("MOCK_LLM_LATENCY_MS", 0))
+MOCK_LLM_JITTER_MS = float(os.getenv("MOCK_LLM_JITTER_MS", 0))
 
 # --- API Keys ---
 RAPIDAPI_KEY = os.getenv("RAPIDAPI_KEY")
@@ -56,36 +73,107 @@ MOOD_TONES = {
 DOWNER_MOODS = {"sadness", "loneliness", "guilt", "fear", "stress", "anxiety", "tiredness", "frustration", "anger", "boredom"}
 MAX_CHAT_ROUNDS = 5 # Can be defined here or in main.py depending on preference
 
-# === Initialization Function ===
-
-def initialize_dependencies() -> Tuple[Optional[Any], Optional[spotipy.Spotify]]:
-    """Loads LLM and initializes Spotify client."""
-    llm = None
-    sp = None
-    logging.info("Initializing chatbot dependencies...")
+# --- Recommendations ---
+# Provider endpoints; overridable so benchmarks and tests can point at local stub servers
+RAPIDAPI_MOVIES_URL = os.getenv("RAPIDAPI_MOVIES_URL", "https://ai-movie-recommender.p.rapidapi.com/api/search")
+OPENLIBRARY_SEARCH_URL = os.getenv("OPENLIBRARY_SEARCH_URL", "https://openlibrary.org/search.json")
+# Overall time budget for the three providers, which are queried concurrently
+RECOMMENDATION_DEADLINE = float(os.getenv("RECOMMENDATION_DEADLINE", 12))
+# What each provider returns when it errors or misses the deadline
+PROVIDER_FALLBACKS = {
+    "movies": ["Could not fetch movies", "Check connection or API key."],
+    "books": ["Could not fetch books", "Try searching online!"],
+    "songs": ["Could not fetch songs", "Check Spotify connection."],
+}
+# What each provider returns when the search finds nothing. Shown to users, but never stored in the catalog.
+PROVIDER_EMPTY = {
+    "movies": ["No specific movies found", "Maybe try a general feel-good film?"],
+    "books": ["No specific books found", "Maybe explore a local library?"],
+    "songs": ["No specific songs found", "Maybe try a favorite artist?"],
+}
+SPOTIFY_UNAVAILABLE = ["Spotify unavailable", "Check credentials."]
+RECOMMENDATIONS_PER_CATEGORY = 2 # Items of each kind in one reply
+
+# --- Generation Profiles ---
+# Per-call budgets instead of the load-time max_new_tokens=300 for everything.
+# A deadline of 0 lets generation run until a stop condition or the token limit.
+EMOTION_MAX_NEW_TOKENS = int(os.getenv("EMOTION_MAX_NEW_TOKENS", 160)) # 19 "emotion: N%" lines
+EMOTION_DEADLINE_MS = float(os.getenv("EMOTION_DEADLINE_MS", 0))
+FOLLOWUP_MAX_NEW_TOKENS = int(os.getenv("FOLLOWUP_MAX_NEW_TOKENS", 64)) # One short question
+FOLLOWUP_TEMPERATURE = float(os.getenv("FOLLOWUP_TEMPERATURE", 0.7))
+FOLLOWUP_DEADLINE_MS = float(os.getenv("FOLLOWUP_DEADLINE_MS", 0))
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", 96)) # Two or three sentences
+
+EMOTION_LINE_RE = re.compile(r"^\s*([a-z]+)\s*:\s*\d+(?:\.\d+)?\s*%", re.IGNORECASE | re.MULTILINE)
+
+def emotion_table_complete(text: str) -> Optional[int]:
+    """Stops emotion scoring once every emotion has a score, instead of letting the model ramble on."""
+    seen = set()
+    for match in EMOTION_LINE_RE.finditer(text):
+        seen.add(match.group(1).lower())
+        if seen.issuperset(EMOTION_LIST):
+            return match.end()
+    return None
+
+EMOTION_PROFILE = GenerationProfile("emotion", max_new_tokens=EMOTION_MAX_NEW_TOKENS, temperature=0.1,
+                                    stop=("User Input",), stop_when=emotion_table_complete, deadline_ms=EMOTION_DEADLINE_MS)
+FOLLOWUP_PROFILE = GenerationProfile("followup", max_new_tokens=FOLLOWUP_MAX_NEW_TOKENS, temperature=FOLLOWUP_TEMPERATURE,
+                                     stop=("?", "\n"), include_stop=True, deadline_ms=FOLLOWUP_DEADLINE_MS)
+SUMMARY_PROFILE = GenerationProfile("summary", max_new_tokens=HISTORY_SUMMARY_MAX_TOKENS, temperature=0.2,
+                                    stop=("\n\n", "User:", "Assistant:"))
+DEFAULT_PROFILE = GenerationProfile("default", max_new_tokens=300, temperature=0.5) # The model's load-time settings
+
+# --- Metrics ---
+MOCK_FALLBACKS = Counter("llm_mock_fallbacks_total", "Times the model failed to load and MockLLM was used instead.")
+EMOTION_PARSE_FAILURES = {
+    reason: Counter("emotion_parse_failures_total", "Emotion replies that didn't match the expected format.", labels={"reason": reason})
+    for reason in ("missing_header", "bad_line", "no_scores")
+}
+PROVIDER_SECONDS = {
+    name: Histogram("recommendation_provider_seconds", "Time per recommendation provider call.", labels={"provider": name})
+    for name in PROVIDER_FALLBACKS
+}
+PROVIDER_ERRORS = {
+    name: Counter("recommendation_provider_errors_total", "Provider calls that failed or missed the deadline.", labels={"provider": name})
+    for name in PROVIDER_FALLBACKS
+}
 
-    # --- Load LLM ---
-    try:
-        if not os.path.exists(MODEL_PATH):
-            logging.error(f"Model path '{MODEL_PATH}' not found.")
-            raise FileNotFoundError(f"Model path '{MODEL_PATH}' not found.")
-            
-        llm = AutoModelForCausalLM.from_pretrained(
-            MODEL_PATH, model_type="mistral", temperature=0.5, max_new_tokens=300,
-        )
-        logging.info("LLM loaded successfully.")
-    except Exception as e:
-        logging.error(f"FATAL: Failed to load LLM: {e}")
-        logging.warning("Using MockLLM as fallback for testing purposes")
-        
-        # Create a MockLLM as fallback
-        class MockLLM:
-            def __call__(self, prompt):
-                # Simple mock implementation that extracts key information from the prompt
-                
-                # For emotion detection
-                if "Emotion Probabilities:" in prompt:
-                    return """Emotion Probabilities:
+# === Mock LLM ===
+
+class MockLLM:
+    """Stand-in for the ctransformers model when the GGUF file can't be loaded."""
+    def __init__(self, latency_ms: float = MOCK_LLM_LATENCY_MS, jitter_ms: float = MOCK_LLM_JITTER_MS):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+
+    def _latency(self) -> float:
+        return max(0.0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+
+    def __call__(self, prompt, stream=False, max_new_tokens=None, **kwargs):
+        reply = self._limit(self._reply(prompt), max_new_tokens)
+        if stream:
+            return self._stream(reply)
+        time.sleep(self._latency()) # Simulated generation time; blocks like the real model
+        return reply
+
+    def _limit(self, reply, max_new_tokens):
+        # Words stand in for tokens; sampling settings have no effect on canned replies
+        return reply if max_new_tokens is None else " ".join(reply.split(" ")[:max_new_tokens])
+
+    def _stream(self, reply):
+        # Mimic ctransformers' stream=True, which yields text pieces as they're generated
+        words = reply.split(" ")
+        per_word = self._latency() / len(words)
+        for word in words:
+            time.sleep(per_word)
+            yield word + " "
+
+    def _reply(self, prompt):
+        # Simple mock implementation that extracts key information from the prompt
+
+        # For emotion detection
+        if "Emotion Probabilities:" in prompt:
+            return """Emotion Probabilities:
 happiness: 0%
 sadness: 60%
 anger: 10%
@@ -105,37 +193,86 @@ guilt: 0%
 love: 0%
 gratitude: 0%
 neutral: 0%"""
-                
-                # For follow-up questions
-                if "Goal: supportive, understanding" in prompt:
-                    user_text = prompt.split("Recent conversation:")[-1]
-                    if "sad" in user_text.lower():
-                        return "I'm sorry to hear you're feeling sad. Would you like to share more about what's been going on?"
-                    elif "happy" in user_text.lower():
-                        return "It's great that you're feeling happy! What's been bringing you joy lately?"
-                    elif "anxious" in user_text.lower() or "anxiety" in user_text.lower():
-                        return "I understand anxiety can be challenging. What specific situations have been triggering this feeling for you?"
-                    else:
-                        return "Thank you for sharing. Could you tell me more about how these feelings are affecting you?"
-                
-                # Default response
-                return "I appreciate you sharing that with me. How has that been affecting you recently?"
-        
-        llm = MockLLM()
-
-    # --- Initialize Spotify ---
+
+        # For history summaries
+        if "Updated Summary:" in prompt:
+            return "The user has been sharing how they feel and what has been weighing on them."
+
+        # For follow-up questions
+        if "Goal: supportive, understanding" in prompt:
+            user_text = prompt.split("Recent conversation:")[-1]
+            if "sad" in user_text.lower():
+                return "I'm sorry to hear you're feeling sad. Would you like to share more about what's been going on?"
+            elif "happy" in user_text.lower():
+                return "It's great that you're feeling happy! What's been bringing you joy lately?"
+            elif "anxious" in user_text.lower() or "anxiety" in user_text.lower():
+                return "I understand anxiety can be challenging. What specific situations have been triggering this feeling for you?"
+            else:
+                return "Thank you for sharing. Could you tell me more about how these feelings are affecting you?"
+
+        # Default response
+        return "I appreciate you sharing that with me. How has that been affecting you recently?"
+
+    def generate_batch(self, prompts, max_new_tokens=None, **kwargs):
+        # Lets the batch scheduler exercise its batched path without a real model;
+        # one simulated generation time per batch, as a batching backend would have
+        time.sleep(self._latency())
+        return [self._limit(self._reply(prompt), max_new_tokens) for prompt in prompts]
+
+# === Initialization Functions ===
+
+def load_llm(path: Optional[str] = None, model_type: str = "mistral", fallback: bool = True) -> Optional[Any]:
+    """
+    Loads a GGUF model (MODEL_PATH by default), falling back to MockLLM if it can't be loaded.
+    Without `fallback`, a model that fails to load returns None instead (see model_registry).
+    """
+    path = path or MODEL_PATH
+    if USE_MOCK_LLM:
+        logging.warning("USE_MOCK_LLM is set. Using MockLLM instead of loading the model.")
+        return MockLLM()
+    try:
+        if not os.path.exists(path):
+            logging.error(f"Model path '{path}' not found.")
+            raise FileNotFoundError(f"Model path '{path}' not found.")
+
+        llm = AutoModelForCausalLM.from_pretrained(
+            path, model_type=model_type, temperature=0.5, max_new_tokens=300,
+            mmap=MODEL_MMAP, threads=MODEL_THREADS,
+        )
+        logging.info(f"LLM loaded successfully from '{path}'.")
+        return llm
+    except Exception as e:
+        if not fallback:
+            logging.error(f"Failed to load model '{path}': {e}")
+            return None
+        logging.error(f"FATAL: Failed to load LLM: {e}")
+        logging.warning("Using MockLLM as fallback for testing purposes")
+        MOCK_FALLBACKS.inc()
+        return MockLLM()
+
+def init_spotify() -> Optional[spotipy.Spotify]:
+    """Initializes the Spotify client, or returns None if unavailable."""
     if not SPOTIFY_CLIENT_ID or not SPOTIFY_CLIENT_SECRET:
          logging.warning("Spotify Client ID or Secret not provided. Spotify features disabled.")
-         sp = None
-    else:
-        try:
-            auth_manager = SpotifyClientCredentials(client_id=SPOTIFY_CLIENT_ID, client_secret=SPOTIFY_CLIENT_SECRET)
-            sp = spotipy.Spotify(auth_manager=auth_manager)
-            sp.search(q='test', type='track', limit=1) # Test query
-            logging.info("Spotify authentication successful.")
-        except Exception as e:
-            logging.error(f"Failed to authenticate with Spotify: {e}")
-            sp = None # Ensure sp is None if auth failed
+         return None
+    try:
+        auth_manager = SpotifyClientCredentials(client_id=SPOTIFY_CLIENT_ID, client_secret=SPOTIFY_CLIENT_SECRET)
+        # Share the pooled session so Spotify calls reuse keep-alive connections too
+        sp = spotipy.Spotify(auth_manager=auth_manager, requests_session=http_client.get_session(), requests_timeout=10)
+        # No test query: it cost a round trip at startup. The token is fetched on the first
+        # search, and a bad credential shows up as a provider error there.
+        logging.info("Spotify client configured.")
+        return sp
+    except Exception as e:
+        logging.error(f"Failed to authenticate with Spotify: {e}")
+        return None # Ensure sp is None if auth failed
+
+def initialize_dependencies() -> Tuple[Optional[Any], Optional[spotipy.Spotify]]:
+    """Loads LLM and initializes Spotify client."""
+    logging.info("Initializing chatbot dependencies...")
+
+    llm = load_llm()
+    sp = init_spotify()
 
     if llm is None:
         logging.error("LLM initialization failed. Chatbot core functionality will be unavailable.")
@@ -146,13 +283,13 @@ neutral: 0%"""
 # --- LLM & API Dependent Functions ---
 # **Note:** These functions now require `llm` or `sp` to be passed as arguments
 
-def detect_emotion_percentages(text: str, llm: Any) -> dict:
-    """Analyzes text to detect emotion percentages using the provided LLM."""
-    if not llm:
-        logging.error("detect_emotion_percentages called without initialized LLM.")
-        return {"neutral": 100.0, **{em: 0.0 for em in EMOTION_LIST if em != "neutral"}}
+NEUTRAL_SCORES = {"neutral": 100.0, **{em: 0.0 for em in EMOTION_LIST if em != "neutral"}}
 
-    prompt = f"""
+# Prompt building and response parsing are split out so callers that schedule
+# model calls themselves (see inference.BatchScheduler) can reuse them.
+
+def build_emotion_prompt(text: str) -> str:
+    return f"""
 Analyze the user's text and assign a percentage score to each emotion in the list: {", ".join(EMOTION_LIST)}.
 The percentages must sum to 100%. Format the output strictly as:
 Emotion Probabilities:
@@ -161,203 +298,345 @@ emotion2: Y%
 ...
 User Input: "{text}"
 """
+
+def parse_emotion_response(response: str) -> dict:
+    """Parses an 'Emotion Probabilities:' reply into {emotion: percent}, normalized to 100."""
+    if "Emotion Probabilities:" not in response:
+        logging.warning("LLM did not return expected 'Emotion Probabilities:' header.")
+        EMOTION_PARSE_FAILURES["missing_header"].inc()
+        cleaned = response.strip()
+    else:
+        cleaned = response.split("Emotion Probabilities:")[-1].strip()
+
+    emotion_scores = {emotion: 0.0 for emotion in EMOTION_LIST}
+    total_percent = 0.0
+    for line in cleaned.splitlines():
+        if ":" in line:
+            try:
+                parts = line.strip().split(":")
+                emotion = parts[0].strip().lower()
+                percent_str = parts[1].strip().replace("%", "")
+                percent = float(percent_str)
+                if emotion in EMOTION_LIST:
+                    emotion_scores[emotion] = percent
+                    total_percent += percent
+            except (ValueError, IndexError):
+                logging.warning(f"Could not parse emotion line: '{line}'")
+                EMOTION_PARSE_FAILURES["bad_line"].inc()
+                continue
+
+    if total_percent > 0 and abs(total_percent - 100.0) > 1.0 :
+         logging.warning(f"Emotion percentages sum to {total_percent}%. Normalizing.")
+         norm_factor = 100.0 / total_percent
+         for emotion in emotion_scores:
+             emotion_scores[emotion] *= norm_factor
+    elif total_percent == 0:
+         logging.warning("LLM returned zero percentages for all emotions.")
+         EMOTION_PARSE_FAILURES["no_scores"].inc()
+         emotion_scores["neutral"] = 100.0
+
+    if "neutral" not in emotion_scores:
+        emotion_scores["neutral"] = 0.0
+    return emotion_scores
+
+def detect_emotion_percentages(text: str, llm: Any) -> dict:
+    """Analyzes text to detect emotion percentages using the provided LLM."""
+    if not llm:
+        logging.error("detect_emotion_percentages called without initialized LLM.")
+        return NEUTRAL_SCORES.copy()
+
     try:
-        response = llm(prompt) # Use the passed llm object
-        # --- Parsing Logic (same as before) ---
-        if "Emotion Probabilities:" not in response:
-            logging.warning("LLM did not return expected 'Emotion Probabilities:' header.")
-            cleaned = response.strip()
-        else:
-            cleaned = response.split("Emotion Probabilities:")[-1].strip()
-
-        emotion_scores = {emotion: 0.0 for emotion in EMOTION_LIST}
-        total_percent = 0.0
-        for line in cleaned.splitlines():
-            if ":" in line:
-                try:
-                    parts = line.strip().split(":")
-                    emotion = parts[0].strip().lower()
-                    percent_str = parts[1].strip().replace("%", "")
-                    percent = float(percent_str)
-                    if emotion in EMOTION_LIST:
-                        emotion_scores[emotion] = percent
-                        total_percent += percent
-                except (ValueError, IndexError):
-                    logging.warning(f"Could not parse emotion line: '{line}'")
-                    continue
-
-        if total_percent > 0 and abs(total_percent - 100.0) > 1.0 :
-             logging.warning(f"Emotion percentages sum to {total_percent}%. Normalizing.")
-             norm_factor = 100.0 / total_percent
-             for emotion in emotion_scores:
-                 emotion_scores[emotion] *= norm_factor
-        elif total_percent == 0:
-             logging.warning("LLM returned zero percentages for all emotions.")
-             emotion_scores["neutral"] = 100.0
-
-        if "neutral" not in emotion_scores:
-            emotion_scores["neutral"] = 0.0
-        # --- End Parsing Logic ---
-        return emotion_scores
+        response = generate_with_profile(build_emotion_prompt(text), EMOTION_PROFILE, llm) # Use the passed llm object
+        return parse_emotion_response(response)
     except Exception as e:
         logging.error(f"Error during emotion detection: {e}")
-        return {"neutral": 100.0, **{em: 0.0 for em in EMOTION_LIST if em != "neutral"}}
-
+        return NEUTRAL_SCORES.copy()
 
-def generate_followup_question(significant_emotions: list, conversation_history: list, llm: Any) -> str:
-    """Generates a follow-up question using the provided LLM."""
-    if not llm:
-         logging.error("generate_followup_question called without initialized LLM.")
-         return "How are you feeling about things?" # Generic fallback
 
+def build_followup_preamble(significant_emotions: list) -> str:
+    """Static part of the follow-up prompt; only changes with the conversation's emotions."""
     primary_emotion = significant_emotions[0] if significant_emotions else "neutral"
     tone = MOOD_TONES.get(primary_emotion, "neutral")
-    history_text = "\n".join([f"{entry['role']}: {entry['content']}" for entry in conversation_history[-6:]])
-    if not history_text: history_text = "(Start of conversation)"
-
-    prompt = f"""
+    return f"""
 You are a {tone} AI companion. Goal: supportive, understanding.
 User's significant emotions: {', '.join(significant_emotions)}.
-Recent conversation:
-{history_text}
+"""
 
+FOLLOWUP_INSTRUCTIONS = """
 Generate ONE gentle, thoughtful, open-ended follow-up question based on the user's emotions and conversation. Keep it concise. Avoid solutions.
 Assistant Question:
 """
+
+def followup_fixed_tokens(preamble: str, count_tokens=estimate_tokens) -> int:
+    """Tokens of a follow-up prompt outside its history lines."""
+    return count_tokens(preamble) + count_tokens("Recent conversation:\n") + count_tokens(FOLLOWUP_INSTRUCTIONS)
+
+def followup_history_budget(significant_emotions: list, summary: Optional[str] = None, count_tokens=estimate_tokens,
+                            budget: int = FOLLOWUP_PROMPT_TOKENS) -> Tuple[str, int]:
+    """The preamble (with the rolling summary, if any) and the tokens the prompt has left for history lines."""
+    preamble = build_followup_preamble(significant_emotions)
+    if summary:
+        preamble += f"Earlier in the conversation: {summary}\n"
+    return preamble, budget - followup_fixed_tokens(preamble, count_tokens)
+
+def window_followup_history(significant_emotions: list, conversation_history: list, summary: Optional[str] = None,
+                            count_tokens=estimate_tokens, budget: int = FOLLOWUP_PROMPT_TOKENS) -> Tuple[str, List[str], int, bool]:
+    """
+    The preamble, the history lines that fit the rest of `budget`, how many older entries were left out and
+    whether the newest was trimmed (see window_history). The preamble and lines are all the prompt is built from.
+    """
+    preamble, history_budget = followup_history_budget(significant_emotions, summary, count_tokens, budget)
+    lines, left_out, trimmed = window_history(list(conversation_history), history_budget, count_tokens)
+    return preamble, lines, left_out, trimmed
+
+def build_followup_prompt(significant_emotions: list, conversation_history: list, summary: Optional[str] = None,
+                          count_tokens=estimate_tokens, budget: int = FOLLOWUP_PROMPT_TOKENS,
+                          window: Optional[Tuple[str, List[str], int, bool]] = None) -> str:
+    """
+    Fits the newest history into `budget` tokens (see FOLLOWUP_PROMPT_TOKENS) instead of a fixed number of
+    entries; older entries are covered by the rolling summary once it has caught up (summarize_history in main.py).
+    Pass `window` from window_followup_history when it was already computed (e.g. for the cache key).
+    """
+    # Keep the preamble first and history in order: consecutive turns then share a long
+    # token prefix, which the model doesn't need to evaluate again (see prefix_cache.py).
+    preamble, lines, left_out, trimmed = window or window_followup_history(
+        significant_emotions, conversation_history, summary, count_tokens, budget)
+    record_window(followup_fixed_tokens(preamble, count_tokens) + sum(count_tokens(line) + 1 for line in lines),
+                  lines, left_out, trimmed)
+    history_text = "\n".join(lines)
+    if not history_text: history_text = "(Start of conversation)"
+
+    return f"""{preamble}Recent conversation:
+{history_text}
+{FOLLOWUP_INSTRUCTIONS}"""
+
+def build_summary_prompt(summary: Optional[str], entries: list, preamble: str = "") -> str:
+    """
+    Folds history entries that no longer fit the follow-up prompt into the running summary. With the
+    conversation's follow-up preamble first, the model still holds it for the next follow-up prompt.
+    """
+    turns = "\n".join(f"{entry['role'].capitalize()}: {entry['content']}" for entry in entries)
+    return f"""{preamble}Summarize this part of a supportive conversation in two or three short sentences, from the assistant's point of view.
+Keep what the user said they feel and why. Leave out greetings and questions.
+
+Conversation summary so far: {summary or "(none)"}
+
+New turns:
+{turns}
+
+Updated Summary:
+"""
+
+def parse_summary_response(response: str) -> str:
+    if "Updated Summary:" in response:
+        response = response.split("Updated Summary:")[-1]
+    return " ".join(response.split())
+
+def parse_followup_response(response: str) -> str:
+    if "Assistant Question:" in response:
+        response = response.split("Assistant Question:")[-1]
+    return response.strip().strip('"')
+
+ROLE_PREFIX_RE = re.compile(r"^\s*(user|assistant)\s*:", re.IGNORECASE)
+
+def followup_acceptable(response: str) -> bool:
+    """Cheap check that a raw follow-up reply is one usable question; the draft-model cascade regenerates the rest."""
+    question = parse_followup_response(response)
+    return question.endswith("?") and 3 <= len(question.split()) <= 40 and not ROLE_PREFIX_RE.match(question)
+
+def generate_followup_question(significant_emotions: list, conversation_history: list, llm: Any) -> str:
+    """Generates a follow-up question using the provided LLM."""
+    if not llm:
+         logging.error("generate_followup_question called without initialized LLM.")
+         return "How are you feeling about things?" # Generic fallback
+
     try:
-        response = llm(prompt) # Use the passed llm object
-        if "Assistant Question:" in response:
-            response = response.split("Assistant Question:")[-1]
-        return response.strip().strip('"')
+        response = generate_with_profile(build_followup_prompt(significant_emotions, conversation_history), FOLLOWUP_PROFILE, llm)
+        return complete_question(parse_followup_response(response))
     except Exception as e:
         logging.error(f"Error generating follow-up question: {e}")
-        return f"How are you feeling about that?" # Fallback
+        return "How are you feeling about that?" # Fallback
 
 # --- Recommendation API Functions ---
 # These functions don't directly need LLM, but fetch_spotify_songs needs `sp`
 
-def fetch_rapidapi_movies(emotion):
+def fetch_rapidapi_movies(emotion, limit: int = RECOMMENDATIONS_PER_CATEGORY):
     logging.info(f"Fetching movies for emotion: {emotion} using RapidAPI")
-    url = "https://ai-movie-recommender.p.rapidapi.com/api/search"
+    url = RAPIDAPI_MOVIES_URL
     query = f"movies related to feeling {emotion}"
     querystring = {"q": query}
     headers = {"x-rapidapi-key": RAPIDAPI_KEY, "x-rapidapi-host": "ai-movie-recommender.p.rapidapi.com"}
-    default_movies = ["Could not fetch movies", "Check connection or API key."]
+    default_movies = PROVIDER_FALLBACKS["movies"]
     try:
-        response = requests.get(url, headers=headers, params=querystring, timeout=10)
-        response.raise_for_status()
+        response = http_client.request("rapidapi", "GET", url, headers=headers, params=querystring, timeout=10)
         data = response.json()
         movies = data.get("movies", [])
-        if movies: return [movie.get("title", "Unknown Title") for movie in movies[:2]]
-        else: return ["No specific movies found", "Maybe try a general feel-good film?"]
+        if movies: return [movie.get("title", "Unknown Title") for movie in movies[:limit]]
+        else: return PROVIDER_EMPTY["movies"]
     except Exception as e:
         logging.error(f"RapidAPI movie error: {e}")
         return default_movies
 
-def fetch_openlibrary_books(emotion):
+def fetch_openlibrary_books(emotion, limit: int = RECOMMENDATIONS_PER_CATEGORY):
     logging.info(f"Fetching books for emotion: {emotion} using Open Library")
-    url = f"https://openlibrary.org/search.json?q={emotion}&limit=5"
-    default_books = ["Could not fetch books", "Try searching online!"]
+    url = OPENLIBRARY_SEARCH_URL
+    default_books = PROVIDER_FALLBACKS["books"]
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
+        response = http_client.request("openlibrary", "GET", url, params={"q": emotion, "limit": max(5, limit)}, timeout=10)
         data = response.json()
         books = data.get('docs', [])
         if books:
-            return [f"{book.get('title', 'Unknown Title')} by {book.get('author_name', ['Unknown Author'])[0]}" for book in books[:2]]
-        else: return ["No specific books found", "Maybe explore a local library?"]
+            return [f"{book.get('title', 'Unknown Title')} by {book.get('author_name', ['Unknown Author'])[0]}" for book in books[:limit]]
+        else: return PROVIDER_EMPTY["books"]
     except Exception as e:
         logging.error(f"Open Library error: {e}")
         return default_books
 
-def fetch_spotify_songs(keyword: str, sp: Optional[spotipy.Spotify]):
+def fetch_spotify_songs(keyword: str, sp: Optional[spotipy.Spotify], limit: int = RECOMMENDATIONS_PER_CATEGORY):
     """Fetches songs from Spotify using the provided client."""
     logging.info(f"Fetching songs for keyword: {keyword} using Spotify")
     if not sp:
         logging.warning("Spotify client not available. Cannot fetch songs.")
-        return ["Spotify unavailable", "Check credentials."]
+        return SPOTIFY_UNAVAILABLE
 
     search_query = keyword
     if keyword == "uplifting": search_query = "uplifting OR happy OR positive energy"
-    default_songs = ["Could not fetch songs", "Check Spotify connection."]
+    default_songs = PROVIDER_FALLBACKS["songs"]
     try:
-        results = sp.search(q=search_query, type='track', limit=5) # Use passed sp client
+        results = http_client.guarded("spotify", sp.search, q=search_query, type='track', limit=min(50, max(5, limit))) # Use passed sp client
         tracks = results.get('tracks', {}).get('items', [])
-        if tracks: return [f"{track['name']} by {track['artists'][0]['name']}" for track in tracks[:2]]
+        if tracks: return [f"{track['name']} by {track['artists'][0]['name']}" for track in tracks[:limit]]
         else:
             if keyword == "uplifting": return ["'Happy' by Pharrell Williams", "'Walking on Sunshine' by Katrina & The Waves"]
-            else: return ["No specific songs found", "Maybe try a favorite artist?"]
+            else: return PROVIDER_EMPTY["songs"]
     except Exception as e:
         logging.error(f"Spotify API error: {e}")
         return default_songs
 
-def generate_recommendations(significant_emotions: list, sp: Optional[spotipy.Spotify]) -> dict:
-    """Generates movie, book, and song recommendations."""
-    primary_emotion = significant_emotions[0] if significant_emotions else "neutral"
-    logging.info(f"Generating recommendations for primary emotion: {primary_emotion}")
-    spotify_keyword = "uplifting" if primary_emotion in DOWNER_MOODS else primary_emotion
+# Shared pool so one slow provider doesn't hold up the others
+_provider_pool = ThreadPoolExecutor(max_workers=6, thread_name_prefix="recommendations")
+
+def _timed_provider(name: str, fn, *args):
+    with PROVIDER_SECONDS[name].time():
+        return fn(*args)
 
-    # Call fetch functions, passing sp where needed
-    movies = fetch_rapidapi_movies(primary_emotion)
-    books = fetch_openlibrary_books(primary_emotion)
-    songs = fetch_spotify_songs(spotify_keyword, sp) # Pass sp here
+def _submit_provider(name: str, fn, *args):
+    # Copy the caller's context so the provider's log lines keep the request's trace ID
+    return _provider_pool.submit(contextvars.copy_context().run, _timed_provider, name, fn, *args)
 
+def recommendation_key(significant_emotions: list) -> Tuple[str, str]:
+    """Recommendations only depend on (primary emotion, Spotify keyword)."""
+    primary_emotion = significant_emotions[0] if significant_emotions else "neutral"
+    spotify_keyword = "uplifting" if primary_emotion in DOWNER_MOODS else primary_emotion
+    return primary_emotion, spotify_keyword
+
+def fetch_all_providers(primary_emotion: str, spotify_keyword: str, sp: Optional[spotipy.Spotify],
+                        deadline: float = RECOMMENDATION_DEADLINE,
+                        limit: int = RECOMMENDATIONS_PER_CATEGORY) -> Tuple[dict, List[str]]:
+    """
+    Queries movies, books and songs concurrently under one deadline, up to `limit` items each.
+    Returns the per-provider results and the names of providers that failed or timed out;
+    those get their PROVIDER_FALLBACKS entry so the other providers' results are still usable.
+    """
+    futures = {
+        "movies": _submit_provider("movies", fetch_rapidapi_movies, primary_emotion, limit),
+        "books": _submit_provider("books", fetch_openlibrary_books, primary_emotion, limit),
+        "songs": _submit_provider("songs", fetch_spotify_songs, spotify_keyword, sp, limit), # Pass sp here
+    }
+    wait(futures.values(), timeout=deadline)
+    results, failed = {}, []
+    for name, future in futures.items():
+        if future.done() and future.exception() is None:
+            results[name] = future.result()
+        else:
+            if not future.done():
+                logging.warning(f"Recommendation provider '{name}' missed the {deadline}s deadline.")
+                future.cancel()
+            results[name] = PROVIDER_FALLBACKS[name]
+        if results[name] == PROVIDER_FALLBACKS[name]:
+            failed.append(name)
+            PROVIDER_ERRORS[name].inc()
+    return results, failed
+
+def is_placeholder(category: str, items: list) -> bool:
+    """True for the canned lists providers return instead of real results."""
+    return items in (PROVIDER_FALLBACKS[category], PROVIDER_EMPTY[category], SPOTIFY_UNAVAILABLE)
+
+def build_recommendations(primary_emotion: str, spotify_keyword: str, results: dict) -> dict:
     return {
-        "movies": movies,
-        "books": books,
-        "songs": songs,
+        "movies": results["movies"][:RECOMMENDATIONS_PER_CATEGORY],
+        "books": results["books"][:RECOMMENDATIONS_PER_CATEGORY],
+        "songs": results["songs"][:RECOMMENDATIONS_PER_CATEGORY],
         "music_category": 'Uplifting' if spotify_keyword == 'uplifting' else primary_emotion.capitalize()
     }
 
+def generate_recommendations(significant_emotions: list, sp: Optional[spotipy.Spotify], catalog: Optional[Any] = None) -> dict:
+    """
+    Generates movie, book, and song recommendations, from the local catalog
+    (see recommendation_catalog.py) when it has this emotion and from the providers otherwise.
+    """
+    primary_emotion, spotify_keyword = recommendation_key(significant_emotions)
+    if catalog:
+        served = catalog.lookup(primary_emotion, spotify_keyword)
+        if served:
+            return served
+    logging.info(f"Generating recommendations for primary emotion: {primary_emotion}")
+    if catalog:
+        results, failed = fetch_all_providers(primary_emotion, spotify_keyword, sp, limit=catalog.items_per_category)
+        catalog.store(primary_emotion, spotify_keyword, results, failed)
+    else:
+        results, _ = fetch_all_providers(primary_emotion, spotify_keyword, sp)
+    return build_recommendations(primary_emotion, spotify_keyword, results)
+
 # --- Helper Functions (Conflict Resolution, Significance) ---
 # These don't depend on LLM or SP, so no changes needed
+
+# INCOMPATIBILITY_MATRIX compiled once: emotion index -> bitmask of the emotions it conflicts with.
+# Conflicts are symmetric (either side listing the other is enough), as in the pairwise check this replaces.
+EMOTION_INDEX = {emotion: i for i, emotion in enumerate(EMOTION_LIST)}
+CONFLICT_MASKS = [0] * len(EMOTION_LIST)
+for _emotion, _incompatible in INCOMPATIBILITY_MATRIX.items():
+    for _other in _incompatible:
+        CONFLICT_MASKS[EMOTION_INDEX[_emotion]] |= 1 << EMOTION_INDEX[_other]
+        CONFLICT_MASKS[EMOTION_INDEX[_other]] |= 1 << EMOTION_INDEX[_emotion]
+
 def resolve_conflicts(emotion_scores: dict, selected_emotions: list) -> list:
-    # (Using the improved logic from the previous script)
-    selected = selected_emotions.copy()
-    resolved_list = []
-    emotions_to_process = set(selected)
-    while emotions_to_process:
-        current_emotion = emotions_to_process.pop()
-        is_compatible = True
-        incompatible_list = INCOMPATIBILITY_MATRIX.get(current_emotion, [])
-        temp_resolved = resolved_list.copy()
-        for other_emotion in temp_resolved:
-            other_incompatible_list = INCOMPATIBILITY_MATRIX.get(other_emotion, [])
-            if other_emotion in incompatible_list or current_emotion in other_incompatible_list:
-                if emotion_scores.get(current_emotion, 0) < emotion_scores.get(other_emotion, 0):
-                    is_compatible = False; break
-                else:
-                    resolved_list.remove(other_emotion)
-        if is_compatible: resolved_list.append(current_emotion)
-    final_resolved = []
-    emotions_to_recheck = set(resolved_list)
-    while emotions_to_recheck:
-        current_emotion = emotions_to_recheck.pop()
-        is_compatible = True
-        incompatible_list = INCOMPATIBILITY_MATRIX.get(current_emotion, [])
-        temp_final = final_resolved.copy()
-        for other_emotion in temp_final:
-            other_incompatible_list = INCOMPATIBILITY_MATRIX.get(other_emotion, [])
-            if other_emotion in incompatible_list or current_emotion in other_incompatible_list:
-                 if emotion_scores.get(current_emotion, 0) < emotion_scores.get(other_emotion, 0):
-                    is_compatible = False; break
-                 else: final_resolved.remove(other_emotion)
-        if is_compatible: final_resolved.append(current_emotion)
-    final_resolved.sort(key=lambda e: emotion_scores.get(e, 0), reverse=True)
-    return final_resolved
+    """
+    Drops selected emotions that conflict with a higher-scoring one and returns the rest, highest score first.
+    Candidates are taken in descending score order (ties in EMOTION_LIST order), so each one only needs checking
+    against the accepted emotions, which all score at least as high; on a tie the later candidate wins.
+    """
+    score = lambda e: emotion_scores.get(e, 0)
+    accepted = [] # Stays in descending score order
+    accepted_mask = 0
+    for emotion in sorted(set(selected_emotions), key=lambda e: (-score(e), EMOTION_INDEX.get(e, len(EMOTION_LIST)), e)):
+        index = EMOTION_INDEX.get(emotion)
+        if index is None: # Not in EMOTION_LIST, so it can't conflict with anything
+            accepted.append(emotion)
+            continue
+        conflicts = CONFLICT_MASKS[index] & accepted_mask
+        if conflicts:
+            rivals = [other for other in accepted if other in EMOTION_INDEX and conflicts >> EMOTION_INDEX[other] & 1]
+            if any(score(other) > score(emotion) for other in rivals):
+                continue
+            accepted = [other for other in accepted if other not in rivals]
+            accepted_mask &= ~conflicts
+        accepted.append(emotion)
+        accepted_mask |= 1 << index
+    return accepted
 
 def get_significant_emotions(emotion_scores: dict, threshold=30.0) -> list:
     if not emotion_scores: return ["neutral"]
     strong_emotions = [e for e, s in emotion_scores.items() if s >= threshold]
     if not strong_emotions:
-        sorted_emotions = sorted(emotion_scores.items(), key=lambda x: x[1], reverse=True)
-        strong_emotions = [e for e, s in sorted_emotions[:3] if s > 0]
+        # Top three by score; a full sort isn't needed for that
+        top = heapq.nlargest(3, emotion_scores.items(), key=lambda x: x[1])
+        strong_emotions = [e for e, s in top if s > 0]
         if not strong_emotions: return ["neutral"]
     resolved = resolve_conflicts(emotion_scores, strong_emotions)
     if not resolved:
-         sorted_emotions = sorted(emotion_scores.items(), key=lambda x: x[1], reverse=True)
-         if sorted_emotions and sorted_emotions[0][1] > 0: return [sorted_emotions[0][0]]
-         else: return ["neutral"]
+         top_emotion, top_score = max(emotion_scores.items(), key=lambda x: x[1])
+         return [top_emotion] if top_score > 0 else ["neutral"]
     return resolved
 
 # --- End of chatbot_logic.py ---
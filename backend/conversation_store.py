@@ -0,0 +1,253 @@
+# conversation_store.py
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from typing import Any, Dict, Optional
+
+from metrics import Counter, Gauge
+
+# === CONFIGURATION ===
+CONVERSATION_STORE = os.getenv("CONVERSATION_STORE", "memory").lower() # "memory" or "sqlite"
+CONVERSATION_DB_PATH = os.getenv("CONVERSATION_DB_PATH", "conversations.db")
+CONVERSATION_TTL = float(os.getenv("CONVERSATION_TTL", 30 * 60)) # Idle seconds before a session is evicted
+CONVERSATION_MAX_SESSIONS = int(os.getenv("CONVERSATION_MAX_SESSIONS", 10000))
+# Only the most recent turns are ever read when building prompts
+CONVERSATION_HISTORY_LIMIT = int(os.getenv("CONVERSATION_HISTORY_LIMIT", 6))
+
+# === Metrics ===
+ACTIVE_SESSIONS = Gauge("conversation_sessions", "Conversations currently held by the store.")
+STORE_BYTES = Gauge("conversation_store_bytes", "Approximate memory held by in-memory conversation state.")
+TTL_EVICTIONS = Counter("conversation_ttl_evictions_total", "Conversations evicted after being idle past the TTL.")
+LRU_EVICTIONS = Counter("conversation_lru_evictions_total", "Conversations evicted to stay under the session cap.")
+
+
+def compact_state(state: Dict[str, Any], history_limit: int = CONVERSATION_HISTORY_LIMIT) -> Dict[str, Any]:
+    """Swaps the full history list for a ring buffer of the last history_limit turns."""
+    history = state.get("history")
+    if not isinstance(history, deque) or history.maxlen != history_limit:
+        state["history"] = deque(history or [], maxlen=history_limit)
+    return state
+
+
+def estimate_state_bytes(state: Dict[str, Any]) -> int:
+    # Rough but cheap: message text dominates, plus a fixed per-entry/per-session overhead
+    history_bytes = sum(len(entry.get("content", "")) + 120 for entry in state.get("history", ()))
+    return 600 + history_bytes + len(state.get("summary") or "") + 60 * len(state.get("emotion_scores", {}))
+
+
+# === Store Interface ===
+
+class ConversationStore(ABC):
+    """
+    Where per-user conversation state lives between requests.
+    get() returns a mutable state dict; callers must put() it back after changing it
+    so stores that keep state outside the process see the update.
+    """
+
+    @abstractmethod
+    def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def put(self, user_id: str, state: Dict[str, Any]):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, user_id: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def __contains__(self, user_id: str) -> bool:
+        return self.get(user_id) is not None
+
+    def close(self):
+        pass
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self).__name__,
+            "sessions": len(self),
+            "ttl_evictions": TTL_EVICTIONS.value,
+            "lru_evictions": LRU_EVICTIONS.value,
+        }
+
+
+# === In-Memory Store ===
+
+class InMemoryConversationStore(ConversationStore):
+    """Process-local LRU with idle TTL. Entries are ordered by last access, so expired ones sit at the front."""
+
+    def __init__(self, ttl: float = CONVERSATION_TTL, max_sessions: int = CONVERSATION_MAX_SESSIONS,
+                 history_limit: int = CONVERSATION_HISTORY_LIMIT):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.history_limit = history_limit
+        self._entries: "OrderedDict[str, list]" = OrderedDict() # user_id -> [state, last_access, bytes]
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _evict_expired(self, now: float):
+        while self._entries:
+            user_id, (_, last_access, size) = next(iter(self._entries.items()))
+            if now - last_access < self.ttl:
+                break
+            self._entries.popitem(last=False)
+            self._bytes -= size
+            TTL_EVICTIONS.inc()
+
+    def _update_gauges(self):
+        ACTIVE_SESSIONS.set(len(self._entries))
+        STORE_BYTES.set(self._bytes)
+
+    def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            self._evict_expired(now)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self._update_gauges()
+                return None
+            entry[1] = now
+            self._entries.move_to_end(user_id)
+            return entry[0]
+
+    def put(self, user_id: str, state: Dict[str, Any]):
+        compact_state(state, self.history_limit)
+        size = estimate_state_bytes(state)
+        now = time.monotonic()
+        with self._lock:
+            old = self._entries.pop(user_id, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[user_id] = [state, now, size]
+            self._bytes += size
+            self._evict_expired(now)
+            while len(self._entries) > self.max_sessions:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                LRU_EVICTIONS.inc()
+            self._update_gauges()
+
+    def delete(self, user_id: str) -> bool:
+        with self._lock:
+            entry = self._entries.pop(user_id, None)
+            if entry is not None:
+                self._bytes -= entry[2]
+            self._update_gauges()
+            return entry is not None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def close(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._update_gauges()
+
+    def stats(self) -> dict:
+        return {**super().stats(), "approx_bytes": self._bytes, "ttl_seconds": self.ttl, "max_sessions": self.max_sessions}
+
+
+# === SQLite Store ===
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    Disk-backed store so several uvicorn workers on one host share conversation state.
+    State is stored as JSON with the history already trimmed to history_limit turns.
+    """
+
+    SWEEP_EVERY = 200 # Run TTL/cap eviction every N writes
+
+    def __init__(self, path: str = CONVERSATION_DB_PATH, ttl: float = CONVERSATION_TTL,
+                 max_sessions: int = CONVERSATION_MAX_SESSIONS, history_limit: int = CONVERSATION_HISTORY_LIMIT):
+        self.path = path
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.history_limit = history_limit
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL") # Readers don't block the writer from another worker
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations (user_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at)")
+        self._conn.commit()
+
+    def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT state, updated_at FROM conversations WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            if time.time() - row[1] >= self.ttl:
+                self._conn.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+                self._conn.commit()
+                TTL_EVICTIONS.inc()
+                return None
+        return compact_state(json.loads(row[0]), self.history_limit)
+
+    def put(self, user_id: str, state: Dict[str, Any]):
+        compact_state(state, self.history_limit)
+        payload = json.dumps({**state, "history": list(state["history"])})
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO conversations (user_id, state, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                (user_id, payload, time.time()),
+            )
+            self._writes += 1
+            if self._writes % self.SWEEP_EVERY == 0:
+                self._sweep()
+            self._conn.commit()
+
+    def _sweep(self):
+        expired = self._conn.execute("DELETE FROM conversations WHERE updated_at < ?", (time.time() - self.ttl,)).rowcount
+        TTL_EVICTIONS.inc(max(expired, 0))
+        overflow = self._conn.execute(
+            "DELETE FROM conversations WHERE user_id IN ("
+            "SELECT user_id FROM conversations ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_sessions,),
+        ).rowcount
+        LRU_EVICTIONS.inc(max(overflow, 0))
+
+    def delete(self, user_id: str) -> bool:
+        with self._lock:
+            deleted = self._conn.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,)).rowcount
+            self._conn.commit()
+        return deleted > 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+    def close(self):
+        # Don't clear: other workers may still be serving these conversations
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> dict:
+        ACTIVE_SESSIONS.set(len(self))
+        return {**super().stats(), "path": self.path, "ttl_seconds": self.ttl, "max_sessions": self.max_sessions}
+
+
+def create_conversation_store(kind: str = CONVERSATION_STORE) -> ConversationStore:
+    if kind == "sqlite":
+        logging.info(f"Using SQLite conversation store at {CONVERSATION_DB_PATH}")
+        return SQLiteConversationStore()
+    if kind != "memory":
+        logging.warning(f"Unknown CONVERSATION_STORE '{kind}'. Using in-memory store.")
+    return InMemoryConversationStore()
+
+# --- End of conversation_store.py ---
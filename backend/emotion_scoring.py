@@ -0,0 +1,148 @@
+# emotion_scoring.py
+import os
+import re
+import logging
+from typing import Dict, Optional
+
+from chatbot_logic import EMOTION_LIST, get_significant_emotions
+from metrics import Counter
+
+# === CONFIGURATION ===
+# "llm" keeps the original model-based scoring; "lexicon" scores locally on the CPU
+# and only falls back to the LLM when the text has no emotional keywords.
+EMOTION_SCORER = os.getenv("EMOTION_SCORER", "llm").lower()
+# Re-score the mood on every user turn after the first: "lexicon" uses only the local scorer (turns without
+# emotional keywords leave the mood as it was), "full" falls back to the cached/LLM path for those turns,
+# "off" (the default) keeps the emotions detected on the first message for the whole conversation.
+MOOD_TRACKING = os.getenv("MOOD_TRACKING", "off").lower()
+# Weight of the newest turn in the running (exponentially weighted) emotion scores
+MOOD_SMOOTHING = min(1.0, max(0.0, float(os.getenv("MOOD_SMOOTHING", 0.4))))
+
+# === Metrics ===
+MOOD_UPDATES = Counter("mood_updates_total", "User turns blended into a conversation's running emotion scores.")
+MOOD_SHIFTS = Counter("mood_shifts_total", "Turns after which a conversation's significant emotions changed.")
+
+# --- Lexicon ---
+# Word lists per emotion. Entries ending in "*" match any word with that prefix.
+EMOTION_LEXICON = {
+    "happiness": "happy happier happiest glad good great nice pleased content cheerful smile* fine wonderful awesome",
+    "sadness": "sad sadder saddest unhappy down depress* cry* crying tears upset miserable heartbroken hopeless gloomy blue grief griev*",
+    "anger": "angry anger mad furious rage* hate* pissed annoyed irritat* livid resent*",
+    "stress": "stress* pressure overwhelm* overload* deadline* burnout burned swamped hectic tense",
+    "anxiety": "anxious anxiety worry worried worrying nervous panic* uneasy restless overthink* dread*",
+    "fear": "afraid scared fear* terrified frighten* horrified unsafe threat*",
+    "joy": "joy joyful delighted thrilled ecstatic overjoyed amazing fantastic",
+    "frustration": "frustrat* stuck annoying fed_up useless pointless unfair blocked",
+    "boredom": "bored boring dull monotonous tedious meh",
+    "calmness": "calm relaxed peaceful serene chill rested tranquil okay ok",
+    "excitement": "excited exciting can't_wait pumped eager hyped",
+    "loneliness": "lonely alone isolated lonesome nobody abandoned friendless left_out",
+    "confusion": "confused confusing unsure uncertain lost puzzled don't_know torn",
+    "tiredness": "tired exhausted sleepy drained fatigue* worn weary insomnia",
+    "motivation": "motivated determined driven inspired ready focused productive goal*",
+    "guilt": "guilt* ashamed shame sorry regret* blame* fault",
+    "love": "love loved loving adore crush partner romantic caring",
+    "gratitude": "grateful thankful thanks thank appreciate* blessed",
+}
+NEGATIONS = {"not", "no", "never", "don't", "dont", "isn't", "wasn't", "aren't", "can't", "cannot", "hardly"}
+INTENSIFIERS = {"very": 1.5, "so": 1.5, "really": 1.5, "extremely": 2.0, "super": 1.5, "too": 1.3, "totally": 1.5}
+
+TOKEN_RE = re.compile(r"[a-z']+")
+
+
+class LexiconEmotionScorer:
+    """
+    Keyword-based scorer over EMOTION_LIST. Runs in microseconds and returns the same
+    {emotion: percent} dict as detect_emotion_percentages, or None when it finds no evidence.
+    """
+
+    def __init__(self, lexicon: Dict[str, str] = EMOTION_LEXICON):
+        self._exact: Dict[str, str] = {}
+        self._phrases: Dict[tuple, str] = {}
+        self._prefixes = []
+        for emotion, words in lexicon.items():
+            for word in words.split():
+                if word.endswith("*"):
+                    self._prefixes.append((word[:-1], emotion))
+                elif "_" in word:
+                    self._phrases[tuple(word.split("_"))] = emotion
+                else:
+                    self._exact[word] = emotion
+        # Longest prefix first so "frustrat" wins over shorter overlaps
+        self._prefixes.sort(key=lambda item: len(item[0]), reverse=True)
+
+    def _lookup(self, token: str) -> Optional[str]:
+        emotion = self._exact.get(token)
+        if emotion:
+            return emotion
+        for prefix, emotion in self._prefixes:
+            if token.startswith(prefix):
+                return emotion
+        return None
+
+    def score(self, text: str) -> Optional[dict]:
+        tokens = TOKEN_RE.findall(text.lower())
+        raw = {}
+        for i, token in enumerate(tokens):
+            pair = tuple(tokens[i:i + 2])
+            emotion = self._phrases.get(pair) or self._lookup(token)
+            if not emotion:
+                continue
+            window = tokens[max(0, i - 3):i]
+            if any(word in NEGATIONS for word in window):
+                continue # "not happy" shouldn't count as happiness
+            weight = 1.0
+            if i > 0:
+                weight *= INTENSIFIERS.get(tokens[i - 1], 1.0)
+            raw[emotion] = raw.get(emotion, 0.0) + weight
+
+        total = sum(raw.values())
+        if total == 0:
+            return None
+        scores = {emotion: 0.0 for emotion in EMOTION_LIST}
+        for emotion, value in raw.items():
+            scores[emotion] = value * 100.0 / total
+        return scores
+
+
+# Available local scorers, selectable through EMOTION_SCORER
+SCORERS = {
+    "lexicon": LexiconEmotionScorer,
+}
+
+
+def get_emotion_scorer(name: str = EMOTION_SCORER):
+    """Returns the configured local scorer, or None to use the LLM path."""
+    if name == "llm":
+        return None
+    if name not in SCORERS:
+        logging.warning(f"Unknown EMOTION_SCORER '{name}'. Falling back to LLM emotion scoring.")
+        return None
+    logging.info(f"Using '{name}' emotion scorer with LLM fallback.")
+    return SCORERS[name]()
+
+
+# --- Mood Tracking ---
+
+def blend_scores(running: dict, turn: dict, weight: float = MOOD_SMOOTHING) -> dict:
+    """Exponentially weighted update of a {emotion: percent} vector; both sum to 100, so the result does too."""
+    return {emotion: round((1 - weight) * running.get(emotion, 0.0) + weight * turn.get(emotion, 0.0), 2)
+            for emotion in EMOTION_LIST}
+
+
+def update_mood(state: dict, turn_scores: dict, weight: float = MOOD_SMOOTHING) -> bool:
+    """
+    Blends one turn's scores into the conversation's running `emotion_scores` and recomputes
+    `current_significant_emotions` from them. Constant work per turn, whatever the conversation length.
+    Returns True if the significant emotions changed.
+    """
+    state["emotion_scores"] = blend_scores(state["emotion_scores"], turn_scores, weight)
+    previous = state["current_significant_emotions"]
+    state["current_significant_emotions"] = get_significant_emotions(state["emotion_scores"])
+    MOOD_UPDATES.inc()
+    if state["current_significant_emotions"] != previous:
+        MOOD_SHIFTS.inc()
+        return True
+    return False
+
+# --- End of emotion_scoring.py ---
@@ -0,0 +1,62 @@
+# emotion_vectors.py
+"""
+Batched NumPy version of get_significant_emotions for analytics over many score vectors.
+Rows are emotion-score vectors in EMOTION_LIST order; results match get_significant_emotions row by row.
+"""
+from typing import Iterable, List
+
+import numpy as np
+
+from chatbot_logic import EMOTION_LIST, CONFLICT_MASKS
+
+# Symmetric boolean conflict matrix compiled from the same bitmasks the scalar path uses
+CONFLICTS = np.array([[bool(mask >> j & 1) for j in range(len(EMOTION_LIST))] for mask in CONFLICT_MASKS])
+
+
+def scores_matrix(emotion_scores: Iterable[dict]) -> np.ndarray:
+    """Stacks {emotion: percent} dicts into an (n, len(EMOTION_LIST)) float array; missing emotions are 0."""
+    return np.array([[scores.get(emotion, 0.0) for emotion in EMOTION_LIST] for scores in emotion_scores], dtype=float)
+
+
+def resolve_significant(scores: np.ndarray, threshold: float = 30.0) -> np.ndarray:
+    """
+    Returns an (n, len(EMOTION_LIST)) boolean mask of the significant emotions per row.
+    Every row is processed in parallel, one score rank at a time. Candidates are always the top-ranked
+    emotions of their row, so only as many ranks as the longest candidate list need visiting (usually <= 3).
+    """
+    scores = np.asarray(scores, dtype=float)
+    rows = np.arange(scores.shape[0])
+    order = np.argsort(-scores, axis=1, kind="stable") # Descending score, ties in EMOTION_LIST order
+
+    # Candidates: everything at or above the threshold, else the top three positive scores
+    candidates = scores >= threshold
+    fallback = ~candidates.any(axis=1)
+    top3 = np.zeros_like(candidates)
+    top3[rows[:, None], order[:, :3]] = True
+    candidates[fallback] = top3[fallback] & (scores[fallback] > 0)
+
+    accepted = np.zeros_like(candidates)
+    depth = int(candidates.sum(axis=1).max()) if len(scores) else 0
+    for rank in range(depth):
+        current = order[:, rank]
+        current_score = scores[rows, current]
+        conflicts = CONFLICTS[current] & accepted
+        beaten = (conflicts & (scores > current_score[:, None])).any(axis=1)
+        take = candidates[rows, current] & ~beaten
+        accepted[take] &= ~conflicts[take] # A tie goes to the later candidate
+        accepted[rows[take], current[take]] = True
+
+    none = ~accepted.any(axis=1)
+    accepted[none, EMOTION_LIST.index("neutral")] = True
+    return accepted
+
+
+def significant_emotions_batch(scores: np.ndarray, threshold: float = 30.0) -> List[List[str]]:
+    """get_significant_emotions for every row, each list ordered by score, highest first."""
+    scores = np.asarray(scores, dtype=float)
+    accepted = resolve_significant(scores, threshold)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    ranked = np.where(np.take_along_axis(accepted, order, axis=1), order, -1).tolist()
+    return [[EMOTION_LIST[j] for j in row if j >= 0] for row in ranked]
+
+# --- End of emotion_vectors.py ---
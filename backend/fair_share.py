@@ -0,0 +1,279 @@
+# fair_share.py
+import os
+import time
+import asyncio
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from inference import InferenceQueueFull, InferenceUnavailable
+from metrics import Counter, Gauge, Histogram
+
+# === CONFIGURATION ===
+# Schedule chat turns fairly between users before they reach the model; "false" admits them in arrival order
+FAIR_SHARE = os.getenv("FAIR_SHARE", "true").lower() in ("1", "true", "yes")
+# Turns allowed to use the model at once; 0 sizes it from the follow-up model's workers and batch size
+FAIR_SHARE_CONCURRENCY = max(0, int(os.getenv("FAIR_SHARE_CONCURRENCY", 0)))
+# Per-user token bucket: sustained turns per second and burst size. A rate of 0 turns rate limiting off.
+FAIR_SHARE_USER_RATE = max(0.0, float(os.getenv("FAIR_SHARE_USER_RATE", 1.0)))
+FAIR_SHARE_USER_BURST = max(1, int(os.getenv("FAIR_SHARE_USER_BURST", 5)))
+# Turns that may wait for a slot, across all users; beyond this new turns are shed
+FAIR_SHARE_MAX_WAITING = max(1, int(os.getenv("FAIR_SHARE_MAX_WAITING", 64)))
+# Seconds a turn may wait for a slot before it counts as starved and is refused
+FAIR_SHARE_MAX_WAIT = float(os.getenv("FAIR_SHARE_MAX_WAIT", 15))
+# Which conversations get the larger share when both kinds wait: "continuing", "new" or "none"
+FAIR_SHARE_PRIORITY = os.getenv("FAIR_SHARE_PRIORITY", "continuing").lower()
+# Slots the preferred kind gets for each one the other kind gets
+FAIR_SHARE_PRIORITY_WEIGHT = max(1, int(os.getenv("FAIR_SHARE_PRIORITY_WEIGHT", 4)))
+
+KINDS = ("new", "continuing")
+SHED_REASONS = ("rate_limited", "queue_full", "displaced")
+
+# === Metrics ===
+SHED = {reason: Counter("fair_share_shed_total", "Chat turns refused by the fair-share scheduler, by reason.",
+                        labels={"reason": reason})
+        for reason in SHED_REASONS}
+STARVED = Counter("fair_share_starved_total", "Chat turns refused after waiting FAIR_SHARE_MAX_WAIT for a slot.")
+WAIT = {kind: Histogram("fair_share_wait_seconds", "Time a chat turn waited for a model slot, by conversation kind.",
+                        labels={"kind": kind})
+        for kind in KINDS}
+WAITING = Gauge("fair_share_waiting", "Chat turns waiting for a model slot.")
+ACTIVE = Gauge("fair_share_active", "Chat turns holding a model slot.")
+
+
+class TurnShed(InferenceQueueFull):
+    """Raised when a turn is refused without waiting: rate limited, queue full, or displaced by a preferred turn."""
+
+    def __init__(self, reason: str, retry_after: float = 2.0):
+        super().__init__(f"Chat turn shed ({reason}).")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TurnStarved(InferenceUnavailable):
+    """Raised when a turn waited FAIR_SHARE_MAX_WAIT without getting a slot."""
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """Takes a token and returns 0, or returns the seconds until one is available."""
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class Grant:
+    """A model slot held by one turn; release() hands it to the next waiting turn. Safe to call twice."""
+
+    def __init__(self, scheduler: "FairShareScheduler"):
+        self._scheduler = scheduler
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._scheduler._release()
+
+
+class _Waiter:
+    __slots__ = ("user_id", "kind", "future", "enqueued_at", "timer")
+
+    def __init__(self, user_id: str, kind: str, future: asyncio.Future):
+        self.user_id = user_id
+        self.kind = kind
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+# === Scheduler ===
+
+class FairShareScheduler:
+    """
+    Admits chat turns to the model, `capacity` at a time, so one user (or a flood of new user IDs)
+    can't monopolize it.
+
+    Each user has a token bucket; turns beyond its rate are shed straight away with a Retry-After.
+    Turns that find every slot taken wait in a per-user FIFO, and freed slots go to users by smooth
+    weighted round-robin: every user with a waiting turn gets one slot per round however many turns
+    it queued, and users whose next turn is of the preferred kind (FAIR_SHARE_PRIORITY) weigh
+    FAIR_SHARE_PRIORITY_WEIGHT times more. When the wait queue is full, a preferred turn displaces the
+    newest waiting turn of the other kind. Runs on the event loop only.
+    """
+
+    def __init__(self, capacity: int, user_rate: float = FAIR_SHARE_USER_RATE, user_burst: int = FAIR_SHARE_USER_BURST,
+                 max_waiting: int = FAIR_SHARE_MAX_WAITING, max_wait: float = FAIR_SHARE_MAX_WAIT,
+                 priority: str = FAIR_SHARE_PRIORITY, priority_weight: int = FAIR_SHARE_PRIORITY_WEIGHT):
+        self.capacity = max(1, capacity)
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.priority = priority if priority in KINDS else "none"
+        self.weights = {kind: priority_weight if kind == self.priority else 1 for kind in KINDS}
+        self.active = 0
+        self.waiting = 0
+        self._queues: Dict[str, Deque[_Waiter]] = {} # user_id -> waiting turns, in arrival order
+        self._credit: Dict[str, float] = {} # Smooth WRR state; only users with waiting turns have an entry
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._prune_at = 1024
+
+    async def acquire(self, user_id: str, new: bool) -> Grant:
+        """
+        Waits for a model slot for one of user_id's turns; `new` is True for a conversation's first turn.
+        Raises TurnShed or TurnStarved instead of admitting the turn.
+        """
+        self._take_token(user_id)
+        kind = "new" if new else "continuing"
+        if self.active < self.capacity and not self.waiting:
+            self._grant_now(kind, 0.0)
+            return Grant(self)
+        if self.waiting >= self.max_waiting and not self._displace(kind):
+            SHED["queue_full"].inc()
+            raise TurnShed("queue_full")
+
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(user_id, kind, loop.create_future())
+        waiter.timer = loop.call_later(self.max_wait, self._expire, waiter)
+        self._queues.setdefault(user_id, deque()).append(waiter)
+        self._credit.setdefault(user_id, 0.0)
+        self.waiting += 1
+        WAITING.set(self.waiting)
+        try:
+            return await waiter.future
+        except asyncio.CancelledError: # Caller went away while waiting
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                waiter.future.result().release() # Granted just as it was cancelled
+            else:
+                self._remove(waiter)
+            raise
+
+    def try_acquire_idle(self) -> Optional[Grant]:
+        """
+        A slot for background work (history summaries), or None: only granted while a slot is free and no
+        turn waits, and not charged to any user's bucket, so it never goes ahead of a chat turn.
+        """
+        if self.active >= self.capacity or self.waiting:
+            return None
+        self.active += 1
+        ACTIVE.set(self.active)
+        return Grant(self)
+
+    def _take_token(self, user_id: str):
+        if not self.user_rate:
+            return
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= self._prune_at:
+                self._prune(now)
+            bucket = self._buckets[user_id] = TokenBucket(self.user_rate, self.user_burst, now)
+        wait = bucket.take(now)
+        if wait:
+            SHED["rate_limited"].inc()
+            raise TurnShed("rate_limited", retry_after=wait)
+
+    def _prune(self, now: float):
+        # A bucket that has refilled completely is the same as no bucket
+        for user_id in [u for u, b in self._buckets.items() if b.tokens + (now - b.updated) * b.rate >= b.burst]:
+            del self._buckets[user_id]
+        self._prune_at = max(1024, 2 * len(self._buckets))
+
+    def _grant_now(self, kind: str, waited: float):
+        self.active += 1
+        ACTIVE.set(self.active)
+        WAIT[kind].observe(waited)
+
+    def _release(self):
+        self.active -= 1
+        while self.active < self.capacity and self.waiting:
+            waiter = self._next()
+            waiter.timer.cancel()
+            if waiter.future.done():
+                continue # Cancelled; its caller hasn't run its cleanup yet
+            self._grant_now(waiter.kind, time.perf_counter() - waiter.enqueued_at)
+            waiter.future.set_result(Grant(self))
+        ACTIVE.set(self.active)
+
+    def _next(self) -> _Waiter:
+        """Pops the head turn of the user picked by smooth weighted round-robin."""
+        total = 0
+        picked = None
+        for user_id, queue in self._queues.items():
+            weight = self.weights[queue[0].kind]
+            total += weight
+            self._credit[user_id] += weight
+            if picked is None or self._credit[user_id] > self._credit[picked]:
+                picked = user_id
+        self._credit[picked] -= total
+        waiter = self._queues[picked].popleft()
+        self._forget_if_empty(picked)
+        self.waiting -= 1
+        WAITING.set(self.waiting)
+        return waiter
+
+    def _displace(self, kind: str) -> bool:
+        """Sheds the newest waiting turn of the non-preferred kind to make room for a preferred one."""
+        if kind != self.priority:
+            return False
+        victim = None
+        for queue in self._queues.values():
+            for waiter in queue:
+                if waiter.kind != kind and not waiter.future.done() and (victim is None or waiter.enqueued_at > victim.enqueued_at):
+                    victim = waiter
+        if victim is None:
+            return False
+        self._remove(victim)
+        SHED["displaced"].inc()
+        victim.future.set_exception(TurnShed("displaced"))
+        return True
+
+    def _expire(self, waiter: _Waiter):
+        if waiter.future.done():
+            return
+        self._remove(waiter)
+        STARVED.inc()
+        waiter.future.set_exception(TurnStarved(f"Chat turn waited {self.max_wait:g}s for a model slot."))
+
+    def _remove(self, waiter: _Waiter):
+        queue = self._queues.get(waiter.user_id)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        waiter.timer.cancel()
+        self._forget_if_empty(waiter.user_id)
+        self.waiting -= 1
+        WAITING.set(self.waiting)
+
+    def _forget_if_empty(self, user_id: str):
+        if not self._queues[user_id]:
+            del self._queues[user_id]
+            del self._credit[user_id]
+
+    def stats(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "active": self.active,
+            "waiting": self.waiting,
+            "waiting_users": len(self._queues),
+            "priority": self.priority,
+            "weights": self.weights,
+            "user_rate": self.user_rate,
+            "user_burst": self.user_burst,
+            "shed": {reason: counter.value for reason, counter in SHED.items()},
+            "starved": STARVED.value,
+            "wait_seconds": {kind: histogram.snapshot() for kind, histogram in WAIT.items()},
+        }
+
+# --- End of fair_share.py ---
@@ -0,0 +1,168 @@
+# generation.py
+import re
+import time
+import threading
+from typing import Any, Callable, Dict, Iterator, Optional, Sequence
+
+from metrics import Counter, Histogram
+
+# === Generation Profiles ===
+# Each kind of model call gets its own token budget, stop conditions, sampling settings and
+# latency deadline instead of sharing the model's load-time defaults.
+
+TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512)
+STOP_REASONS = ("eos", "stop", "limit", "deadline")
+
+PROFILES: Dict[str, "GenerationProfile"] = {}
+_lock = threading.Lock()
+
+
+class GenerationProfile:
+    """
+    Settings for one call type. `stop` strings end generation as soon as they appear (after the first
+    non-blank text); `stop_when(text)` can return the index to cut at for conditions a string can't express.
+    `deadline_ms` cuts generation once the budget is spent; callers make a cut-off reply well-formed
+    (the emotion parser tolerates missing lines, follow-up questions go through complete_question).
+    """
+
+    def __init__(self, name: str, max_new_tokens: int, temperature: float = 0.5, top_p: Optional[float] = None,
+                 top_k: Optional[int] = None, repetition_penalty: Optional[float] = None, stop: Sequence[str] = (),
+                 include_stop: bool = False, stop_when: Optional[Callable[[str], Optional[int]]] = None,
+                 deadline_ms: float = 0):
+        self.name = name
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.repetition_penalty = repetition_penalty
+        self.stop = tuple(stop)
+        self.include_stop = include_stop
+        self.stop_when = stop_when
+        self.deadline_ms = deadline_ms
+        self.tokens = Histogram(f"generation_{name}_tokens", f"Tokens generated per {name} call.", buckets=TOKEN_BUCKETS)
+        self.latency = Histogram(f"generation_{name}_seconds", f"Generation time per {name} call.")
+        self.prefill = Histogram(f"generation_{name}_prefill_seconds", f"Time to the first token of each {name} call, mostly prompt evaluation.")
+        self.stopped = {reason: Counter(f"generation_{name}_stopped_{reason}_total", f"{name} calls that ended by {reason}.")
+                        for reason in STOP_REASONS}
+        with _lock:
+            if name in PROFILES:
+                raise ValueError(f"Generation profile '{name}' is already registered.")
+            PROFILES[name] = self
+
+    def sampling(self) -> Dict[str, Any]:
+        """Keyword arguments for the model call (ctransformers accepts these per call)."""
+        settings = {"max_new_tokens": self.max_new_tokens, "temperature": self.temperature, "top_p": self.top_p,
+                    "top_k": self.top_k, "repetition_penalty": self.repetition_penalty}
+        return {key: value for key, value in settings.items() if value is not None}
+
+    def cut_index(self, text: str) -> Optional[int]:
+        """Where text should end if a stop condition is met, else None."""
+        start = len(text) - len(text.lstrip()) # Leading newlines shouldn't end a reply before it starts
+        cuts = []
+        for stop in self.stop:
+            found = text.find(stop, start)
+            if found >= 0:
+                cuts.append(found + len(stop) if self.include_stop else found)
+        if self.stop_when:
+            found = self.stop_when(text)
+            if found is not None:
+                cuts.append(found)
+        return min(cuts) if cuts else None
+
+    def truncate(self, text: str) -> str:
+        cut = self.cut_index(text)
+        return text if cut is None else text[:cut]
+
+    def record(self, tokens: int, seconds: float, reason: str, prefill: Optional[float] = None):
+        self.tokens.observe(tokens)
+        self.latency.observe(seconds)
+        self.stopped[reason].inc()
+        if prefill is not None:
+            self.prefill.observe(prefill)
+
+    def stats(self) -> dict:
+        return {
+            "max_new_tokens": self.max_new_tokens,
+            "temperature": self.temperature,
+            "deadline_ms": self.deadline_ms,
+            "tokens": self.tokens.snapshot(),
+            "seconds": self.latency.snapshot(),
+            "prefill_seconds": self.prefill.snapshot(),
+            "stopped": {reason: counter.value for reason, counter in self.stopped.items()},
+        }
+
+
+# === Executor Jobs ===
+
+def stream_with_profile(prompt: str, profile: GenerationProfile, llm: Any) -> Iterator[str]:
+    """
+    Streams llm's reply under the profile: stops at the first stop condition, the token limit or the
+    deadline, whichever comes first. Closing the model's stream stops generation on the model too.
+    """
+    started = time.perf_counter()
+    deadline = started + profile.deadline_ms / 1000 if profile.deadline_ms > 0 else None
+    text = ""
+    tokens = 0
+    reason = "eos"
+    prefill = None
+    try:
+        for piece in llm(prompt, stream=True, **profile.sampling()):
+            if prefill is None:
+                prefill = time.perf_counter() - started # The prompt is evaluated before the first token comes out
+            tokens += 1 # ctransformers yields one piece per token
+            text += piece
+            cut = profile.cut_index(text)
+            if cut is not None:
+                kept = len(piece) - (len(text) - cut)
+                if kept > 0:
+                    yield piece[:kept]
+                reason = "stop"
+                break
+            yield piece
+            if deadline and time.perf_counter() >= deadline:
+                reason = "deadline"
+                break
+        else:
+            if tokens >= profile.max_new_tokens:
+                reason = "limit"
+    finally:
+        profile.record(tokens, time.perf_counter() - started, reason, prefill)
+
+def generate_with_profile(prompt: str, profile: GenerationProfile, llm: Any) -> str:
+    return "".join(stream_with_profile(prompt, profile, llm))
+
+def generate_batch_with_profile(prompts: Sequence[str], profile: GenerationProfile, llm: Any) -> list:
+    """Batched counterpart for backends with generate_batch; deadlines can't cut a batch short."""
+    started = time.perf_counter()
+    replies = list(llm.generate_batch(list(prompts), **profile.sampling()))
+    seconds = time.perf_counter() - started
+    results = []
+    for reply in replies:
+        text = profile.truncate(reply)
+        profile.record(len(reply.split()), seconds, "stop" if len(text) < len(reply) else "eos") # Words approximate tokens here
+        results.append(text)
+    return results
+
+
+# === Finishers ===
+
+SENTENCE_END_RE = re.compile(r"[.?!](?=\s|$)")
+
+def complete_question(text: str) -> str:
+    """
+    Makes a possibly cut-off reply end cleanly: keeps it if it already ends a sentence, otherwise drops
+    the unfinished trailing sentence, or closes it with '?' when there's nothing complete to fall back to.
+    """
+    text = text.strip()
+    if not text or text[-1] in ".?!\"":
+        return text
+    ends = [match.end() for match in SENTENCE_END_RE.finditer(text)]
+    if ends:
+        return text[:ends[-1]]
+    return text.rstrip(",;:- ") + "?"
+
+
+def stats() -> dict:
+    return {name: profile.stats() for name, profile in PROFILES.items()}
+
+# --- End of generation.py ---
@@ -0,0 +1,193 @@
+# http_client.py
+import os
+import time
+import random
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import Counter, Histogram
+
+# === CONFIGURATION ===
+# --- Connection pools ---
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", 10)) # Hosts kept in the default pool manager
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", 10)) # Keep-alive connections per host
+# Per-host overrides, e.g. "openlibrary.org=4,api.spotify.com=8"
+HTTP_POOL_LIMITS = os.getenv("HTTP_POOL_LIMITS", "")
+
+# --- Retries ---
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 2))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", 0.25))
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", 2.0))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# --- Circuit breakers ---
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", 5))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", 30))
+
+# === Metrics ===
+REQUEST_TIME = Histogram("http_client_request_seconds", "Outbound provider request time, including retries.")
+RETRIES = Counter("http_client_retries_total", "Outbound requests retried after a transient failure.")
+SHORT_CIRCUITED = Counter("http_client_short_circuited_total", "Outbound calls refused by an open circuit breaker.")
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a provider whose circuit breaker is open."""
+
+
+# === Circuit Breaker ===
+
+class CircuitBreaker:
+    """
+    Classic closed/open/half-open breaker. After `failure_threshold` consecutive failures the
+    provider is skipped for `reset_timeout` seconds, then a single trial call decides whether to close again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.state = "closed"
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half-open" # Let one trial call through
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = "closed"
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half-open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logging.warning(f"Circuit breaker for '{self.name}' opened after {self.failures} failure(s).")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def snapshot(self) -> dict:
+        return {"state": self.state, "failures": self.failures}
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_session: Optional[requests.Session] = None
+_lock = threading.Lock()
+
+
+def get_breaker(provider: str) -> CircuitBreaker:
+    with _lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker(provider)
+        return _breakers[provider]
+
+
+def _parse_pool_limits(spec: str) -> Dict[str, int]:
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        try:
+            host, size = item.split("=")
+            limits[host.strip()] = int(size)
+        except ValueError:
+            logging.warning(f"Ignoring malformed HTTP_POOL_LIMITS entry: '{item}'")
+    return limits
+
+
+def get_session() -> requests.Session:
+    """Shared keep-alive session used for every outbound provider call (Spotify included)."""
+    global _session
+    with _lock:
+        if _session is None:
+            session = requests.Session()
+            default_adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount("https://", default_adapter)
+            session.mount("http://", default_adapter)
+            # requests picks the longest matching prefix, so these win for their host
+            for host, size in _parse_pool_limits(HTTP_POOL_LIMITS).items():
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+                session.mount(f"https://{host}", adapter)
+                session.mount(f"http://{host}", adapter)
+            _session = session
+        return _session
+
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+
+def request(provider: str, method: str, url: str, retries: int = HTTP_RETRIES, **kwargs) -> requests.Response:
+    """
+    Sends a request on the shared session, retrying connection errors, timeouts and
+    retryable statuses with jittered backoff. Raises CircuitOpen if the provider's breaker is open,
+    and the last error (via raise_for_status for HTTP errors) once retries are exhausted.
+    """
+    breaker = get_breaker(provider)
+    if not breaker.allow():
+        SHORT_CIRCUITED.inc()
+        raise CircuitOpen(f"Circuit breaker for '{provider}' is open.")
+
+    started = time.perf_counter()
+    try:
+        for attempt in range(retries + 1):
+            try:
+                response = get_session().request(method, url, **kwargs)
+                if response.status_code in RETRY_STATUSES and attempt < retries:
+                    raise requests.HTTPError(f"{response.status_code} from {urlsplit(url).netloc}", response=response)
+                response.raise_for_status()
+                breaker.record_success()
+                return response
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                retryable = not isinstance(e, requests.HTTPError) or e.response is None or e.response.status_code in RETRY_STATUSES
+                if not retryable or attempt >= retries:
+                    breaker.record_failure()
+                    raise
+                RETRIES.inc()
+                delay = backoff_delay(attempt)
+                logging.info(f"Retrying {provider} request in {delay:.2f}s after: {e}")
+                time.sleep(delay)
+            except requests.RequestException: # Not retryable (bad URL, redirect loop, broken body), but still a failure
+                breaker.record_failure()
+                raise
+    finally:
+        REQUEST_TIME.observe(time.perf_counter() - started)
+
+
+def guarded(provider: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Runs a client-library call (e.g. spotipy) behind the provider's circuit breaker."""
+    breaker = get_breaker(provider)
+    if not breaker.allow():
+        SHORT_CIRCUITED.inc()
+        raise CircuitOpen(f"Circuit breaker for '{provider}' is open.")
+    try:
+        result = fn(*args, **kwargs)
+    except Exception:
+        breaker.record_failure()
+        raise
+    breaker.record_success()
+    return result
+
+
+def stats() -> dict:
+    return {
+        "breakers": {name: breaker.snapshot() for name, breaker in _breakers.items()},
+        "retries": RETRIES.value,
+        "short_circuited": SHORT_CIRCUITED.value,
+        "request_seconds": REQUEST_TIME.snapshot(),
+    }
+
+# --- End of http_client.py ---
@@ -0,0 +1,326 @@
+# inference.py
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from metrics import Counter, Gauge, Histogram
+from generation import GenerationProfile, generate_with_profile, generate_batch_with_profile
+
+# === CONFIGURATION ===
+# Each worker owns one model handle; ctransformers models are not safe to call from
+# several threads at once, so extra workers need extra model instances.
+INFERENCE_WORKERS = max(1, int(os.getenv("INFERENCE_WORKERS", 1)))
+INFERENCE_MAX_QUEUE_DEPTH = max(0, int(os.getenv("INFERENCE_MAX_QUEUE_DEPTH", 16)))
+INFERENCE_QUEUE_TIMEOUT = float(os.getenv("INFERENCE_QUEUE_TIMEOUT", 30))
+
+# Micro-batching: prompts arriving within BATCH_WINDOW_MS of each other share one model call,
+# unless waiting longer would break the latency SLO.
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", 10))
+BATCH_MAX_SIZE = max(1, int(os.getenv("BATCH_MAX_SIZE", 8)))
+BATCH_LATENCY_SLO_MS = float(os.getenv("BATCH_LATENCY_SLO_MS", 5000))
+
+# === Metrics ===
+QUEUE_WAIT = Histogram("inference_queue_wait_seconds", "Time a job waited for a free inference worker.")
+INFERENCE_TIME = Histogram("inference_duration_seconds", "Time spent running a job on the model.")
+QUEUE_DEPTH = Gauge("inference_queue_depth", "Jobs admitted but not yet running.")
+IN_FLIGHT = Gauge("inference_in_flight", "Jobs currently running on a worker.")
+REJECTED = Counter("inference_rejected_total", "Jobs refused because the queue was full.")
+TIMED_OUT = Counter("inference_queue_timeouts_total", "Jobs dropped after waiting past the queue timeout.")
+BATCH_SIZE = Histogram("inference_batch_size", "Prompts per dispatched batch.", buckets=(1, 2, 4, 8, 16, 32, 64))
+BATCH_LATENCY = Histogram("inference_batch_request_seconds", "Time from prompt submission to result, including the batch window.")
+TIME_TO_FIRST_TOKEN = Histogram("inference_time_to_first_token_seconds", "Time from submitting a streamed prompt to its first token.")
+SINGLE_CALLS = Counter("inference_single_calls_total", "Prompts sent unbatched because the backend can't batch.")
+
+
+class InferenceQueueFull(Exception):
+    """Raised when the queue is at max depth and a new job can't be admitted."""
+
+
+class InferenceUnavailable(Exception):
+    """Raised when the executor is shut down or a job waited too long to start."""
+
+
+# === Inference Executor ===
+
+class InferenceExecutor:
+    """
+    Bounded worker pool that owns the model handles.
+    Jobs are plain functions taking an `llm` keyword argument (e.g. `detect_emotion_percentages`);
+    `run` executes them off the event loop so a slow generation doesn't block other requests.
+    """
+
+    def __init__(self, models: List[Any], max_queue_depth: int = INFERENCE_MAX_QUEUE_DEPTH,
+                 queue_timeout: float = INFERENCE_QUEUE_TIMEOUT):
+        if not models:
+            raise ValueError("InferenceExecutor needs at least one model.")
+        self.workers = len(models)
+        self.max_queue_depth = max_queue_depth
+        self.queue_timeout = queue_timeout
+        self._models = list(models)
+        self._idle = list(range(len(models))) # Slot indexes of models not in use
+        self._slot_owner: List[Any] = [None] * len(models) # Affinity key each slot last served
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference")
+        self._lock = threading.Lock()
+        self._pending = 0 # Admitted jobs, queued or running
+        self._running = 0
+        self._closed = False
+
+    @property
+    def queue_depth(self) -> int:
+        return self._pending - self._running
+
+    def saturated(self) -> bool:
+        return self._pending >= self.workers + self.max_queue_depth
+
+    def holds_idle(self, affinity: Any) -> bool:
+        """True if an idle model last served `affinity`, so a job with that key wouldn't take another key's model."""
+        with self._lock:
+            return any(self._slot_owner[slot] == affinity for slot in self._idle)
+
+    async def run(self, fn: Callable[..., Any], *args, affinity: Any = None, **kwargs) -> Any:
+        """
+        Runs fn(*args, llm=<model>, **kwargs) on a worker and returns its result.
+        Jobs with the same affinity key prefer the model that served that key last,
+        so its evaluated prompt prefix is still in the model's context.
+        """
+        return await asyncio.wrap_future(self.submit(fn, *args, affinity=affinity, **kwargs))
+
+    def submit(self, fn: Callable[..., Any], *args, affinity: Any = None, **kwargs) -> Future:
+        """Admits a job and returns its future. Raises InferenceQueueFull/InferenceUnavailable immediately."""
+        if self._closed:
+            raise InferenceUnavailable("Inference executor is shut down.")
+        with self._lock:
+            if self.saturated():
+                REJECTED.inc()
+                raise InferenceQueueFull(f"Inference queue is full ({self.max_queue_depth} waiting).")
+            self._pending += 1
+            QUEUE_DEPTH.set(self.queue_depth)
+
+        enqueued_at = time.perf_counter()
+        context = contextvars.copy_context() # Keeps the request's trace ID in the worker's log lines
+        future = self._pool.submit(context.run, self._invoke, fn, args, kwargs, enqueued_at, affinity)
+        future.add_done_callback(self._release)
+        return future
+
+    def stream(self, prompt: str, affinity: Any = None,
+               generate: Optional[Callable[..., Any]] = None) -> AsyncIterator[str]:
+        """
+        Runs llm(prompt, stream=True) on a worker and returns an async iterator over its tokens.
+        `generate(prompt, llm=...)` can replace the plain call, e.g. to wrap it with cache bookkeeping.
+        Admission happens here, before iteration starts, so callers can still answer 429/503.
+        """
+        loop = asyncio.get_running_loop()
+        tokens: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+        end = object()
+
+        def produce(llm):
+            pieces = generate(prompt, llm=llm) if generate else llm(prompt, stream=True)
+            for token in pieces:
+                if stop.is_set():
+                    break # Consumer went away; stop generating
+                loop.call_soon_threadsafe(tokens.put_nowait, token)
+
+        def finished(_future):
+            try:
+                loop.call_soon_threadsafe(tokens.put_nowait, end)
+            except RuntimeError:
+                pass # Event loop already closed
+
+        submitted_at = time.perf_counter()
+        future = self.submit(produce, affinity=affinity)
+        future.add_done_callback(finished)
+
+        async def iterate():
+            first = True
+            try:
+                while True:
+                    token = await tokens.get()
+                    if token is end:
+                        break
+                    if first:
+                        TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - submitted_at)
+                        first = False
+                    yield token
+                if not future.cancelled() and future.exception():
+                    raise future.exception()
+            finally:
+                stop.set()
+                future.cancel()
+
+        return iterate()
+
+    def _checkout(self, affinity: Any) -> int:
+        # There are as many threads as slots, so a running job always finds an idle slot
+        with self._lock:
+            slot = self._idle[0]
+            if affinity is not None:
+                for candidate in self._idle:
+                    if self._slot_owner[candidate] == affinity:
+                        slot = candidate
+                        break
+                self._slot_owner[slot] = affinity
+            self._idle.remove(slot)
+            return slot
+
+    def _checkin(self, slot: int):
+        with self._lock:
+            self._idle.append(slot)
+
+    def _invoke(self, fn, args, kwargs, enqueued_at: float, affinity: Any = None):
+        started = time.perf_counter()
+        waited = started - enqueued_at
+        QUEUE_WAIT.observe(waited)
+        if waited > self.queue_timeout:
+            TIMED_OUT.inc()
+            raise InferenceUnavailable(f"Job waited {waited:.1f}s for a worker (timeout {self.queue_timeout}s).")
+
+        with self._lock:
+            self._running += 1
+            QUEUE_DEPTH.set(self.queue_depth)
+        IN_FLIGHT.inc()
+        slot = self._checkout(affinity)
+        try:
+            return fn(*args, llm=self._models[slot], **kwargs)
+        finally:
+            self._checkin(slot)
+            IN_FLIGHT.dec()
+            INFERENCE_TIME.observe(time.perf_counter() - started)
+            with self._lock:
+                self._running -= 1
+
+    def _release(self, _future):
+        # Runs when a job finishes, fails or is cancelled before it started
+        with self._lock:
+            self._pending -= 1
+            QUEUE_DEPTH.set(self.queue_depth)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_queue_depth": self.max_queue_depth,
+            "queue_depth": self.queue_depth,
+            "running": self._running,
+            "queue_wait_seconds": QUEUE_WAIT.snapshot(),
+            "inference_seconds": INFERENCE_TIME.snapshot(),
+            "time_to_first_token_seconds": TIME_TO_FIRST_TOKEN.snapshot(),
+            "rejected": REJECTED.value,
+            "queue_timeouts": TIMED_OUT.value,
+        }
+
+    def shutdown(self):
+        self._closed = True
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        logging.info("Inference executor shut down.")
+
+# === Micro-batching ===
+
+def supports_batching(llm: Any) -> bool:
+    """A backend can batch if it exposes generate_batch(prompts) -> list of replies."""
+    return callable(getattr(llm, "generate_batch", None))
+
+def run_prompt(prompt: str, profile: GenerationProfile, llm: Any) -> str:
+    return generate_with_profile(prompt, profile, llm)
+
+def run_prompt_batch(prompts: List[str], profile: GenerationProfile, llm: Any) -> List[str]:
+    return generate_batch_with_profile(prompts, profile, llm)
+
+
+class BatchScheduler:
+    """
+    Collects prompts from concurrent conversations and dispatches them to the executor as batches.
+    A batch is sent when it reaches max_batch_size or when the window closes, whichever is first;
+    the window shrinks if the estimated batch time would push the oldest prompt past the SLO.
+    Prompts are only batched with others using the same generation profile.
+    Backends without generate_batch get one executor job per prompt instead.
+    """
+
+    def __init__(self, executor: InferenceExecutor, can_batch: bool = True,
+                 window_ms: float = BATCH_WINDOW_MS, max_batch_size: int = BATCH_MAX_SIZE,
+                 latency_slo_ms: float = BATCH_LATENCY_SLO_MS):
+        self.executor = executor
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.latency_slo = latency_slo_ms / 1000
+        self.can_batch = can_batch and max_batch_size > 1
+        self._waiting: Dict[str, List[Tuple[str, asyncio.Future, float]]] = {} # Per profile name
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._profiles: Dict[str, GenerationProfile] = {}
+        self._tasks: set = set()
+        self._seconds_per_prompt = 0.0 # EWMA of batch time / batch size
+
+    async def generate(self, prompt: str, profile: GenerationProfile) -> str:
+        """Returns the model's reply to prompt, possibly computed as part of a larger batch."""
+        if not self.can_batch:
+            SINGLE_CALLS.inc()
+            return await self.executor.run(run_prompt, prompt, profile)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._profiles[profile.name] = profile
+        waiting = self._waiting.setdefault(profile.name, [])
+        waiting.append((prompt, future, time.perf_counter()))
+        if len(waiting) >= self.max_batch_size:
+            self._flush(profile.name)
+        elif profile.name not in self._timers:
+            self._timers[profile.name] = loop.call_later(self._flush_delay(), self._flush, profile.name)
+        return await future
+
+    def _flush_delay(self) -> float:
+        headroom = self.latency_slo - self._seconds_per_prompt * self.max_batch_size
+        return max(0.0, min(self.window, headroom))
+
+    def _flush(self, name: str):
+        timer = self._timers.pop(name, None)
+        if timer is not None:
+            timer.cancel()
+        waiting = self._waiting.get(name, [])
+        batch, self._waiting[name] = waiting[:self.max_batch_size], waiting[self.max_batch_size:]
+        if batch:
+            task = asyncio.ensure_future(self._dispatch(batch, self._profiles[name]))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if self._waiting[name]:
+            self._timers[name] = asyncio.get_running_loop().call_later(self._flush_delay(), self._flush, name)
+
+    async def _dispatch(self, batch: List[Tuple[str, asyncio.Future, float]], profile: GenerationProfile):
+        # Drop prompts whose caller already went away
+        batch = [item for item in batch if not item[1].done()]
+        if not batch:
+            return
+        BATCH_SIZE.observe(len(batch))
+        started = time.perf_counter()
+        try:
+            replies = await self.executor.run(run_prompt_batch, [prompt for prompt, _, _ in batch], profile)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        finished = time.perf_counter()
+        per_prompt = (finished - started) / len(batch)
+        self._seconds_per_prompt = per_prompt if not self._seconds_per_prompt else 0.8 * self._seconds_per_prompt + 0.2 * per_prompt
+        for (_, future, submitted_at), reply in zip(batch, replies):
+            BATCH_LATENCY.observe(finished - submitted_at)
+            if not future.done():
+                future.set_result(reply)
+
+    def stats(self) -> dict:
+        return {
+            "batching": self.can_batch,
+            "window_ms": self.window * 1000,
+            "max_batch_size": self.max_batch_size,
+            "latency_slo_ms": self.latency_slo * 1000,
+            "waiting": sum(len(waiting) for waiting in self._waiting.values()),
+            "batch_size": BATCH_SIZE.snapshot(),
+            "request_seconds": BATCH_LATENCY.snapshot(),
+            "single_calls": SINGLE_CALLS.value,
+        }
+
+# --- End of inference.py ---
@@ -1,40 +1,96 @@
 # main.py
 import os
+import json
+import math
+import asyncio
 import logging
-import sys
-from typing import Dict, List, Optional, Any
+from functools import partial
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Any
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
 # --- FastAPI & Related ---
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import FastAPI, HTTPException, Body, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 import uvicorn
 
 # --- Import Logic from chatbot_logic ---
 # Import the initialization function and specific logic functions needed
 from chatbot_logic import (
-    initialize_dependencies,
-    detect_emotion_percentages,
+    init_spotify,
+    build_emotion_prompt,
+    parse_emotion_response,
+    build_followup_preamble,
+    build_followup_prompt,
+    window_followup_history,
+    build_summary_prompt,
+    parse_summary_response,
+    parse_followup_response,
     get_significant_emotions,
-    generate_followup_question,
-    generate_recommendations,
+    EMOTION_PROFILE,
+    FOLLOWUP_PROFILE,
+    SUMMARY_PROFILE,
+    NEUTRAL_SCORES,
     MAX_CHAT_ROUNDS # Import constants if needed
 )
+from inference import (
+    InferenceExecutor,
+    BatchScheduler,
+    InferenceQueueFull,
+    InferenceUnavailable,
+)
+from prefix_cache import PrefixCache, generate_with_prefix_cache, stream_with_prefix_cache, PREFIX_CACHE_MAX_BYTES
+from emotion_scoring import get_emotion_scorer, update_mood, LexiconEmotionScorer, MOOD_TRACKING
+from recommendation_cache import RecommendationCache
+from recommendation_catalog import create_catalog
+from conversation_store import create_conversation_store
+from generation import stream_with_profile, complete_question
+from structured_decoding import score_emotions_structured, supports_constrained_decoding, EMOTION_DECODING
+from response_cache import ResponseCache, followup_cache_key, RESPONSE_CACHE_SIMILARITY
+from model_loader import ModelLoader, warm_up_job, WARMUP_MESSAGES, MODEL_WARMUP, DEGRADED_REPLIES
+from model_registry import ModelPool, ModelRouter, model_specs
+from fair_share import FairShareScheduler, FAIR_SHARE, FAIR_SHARE_CONCURRENCY
+from prompt_window import TokenCounter, PROMPT_TOKENS, FOLLOWUP_PROMPT_TOKENS, HISTORY_SUMMARY
+import http_client
+import generation
+import metrics
+import tracing
+from tracing import stage, new_trace_id, TraceMiddleware, TRACE_ID, TRACE_REQUESTS
+from metrics import Counter, Gauge
 
 # --- Logging Setup ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# force: chatbot_logic logs while it is imported, which already gave the root logger a default handler
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(trace_id)s] %(message)s', force=True)
+tracing.install_log_filter()
 
 # === Global Variables for FastAPI App ===
 # These hold the initialized objects accessible within API calls
 llm: Optional[Any] = None
 sp: Optional[Any] = None # Using Any for sp since spotipy type hints might require explicit install
+router: Optional[ModelRouter] = None # Picks the model (pool) for each generation profile, see MODEL_ROUTES
+inference: Optional[InferenceExecutor] = None # The main model's executor; owns its llm handle(s)
+batcher: Optional[BatchScheduler] = None # Groups prompts from concurrent requests before they reach `inference`
+fair_share: Optional[FairShareScheduler] = None # Orders chat turns between users before they reach the model, see FAIR_SHARE
+recommendations: Optional[RecommendationCache] = None # TTL cache in front of the recommendation providers
+prefix_cache: Optional[PrefixCache] = None # Set when the model exposes its tokenizer (ctransformers)
+structured_emotions = False # Constrained emotion decoding; needs token-level model access (ctransformers)
+token_counter = TokenCounter() # Sizes follow-up prompts; the follow-up model's tokenizer once loaded, estimates until then
+emotion_scorer: Optional[Any] = get_emotion_scorer() # Local scorer from EMOTION_SCORER; None means LLM only
+local_scorer = emotion_scorer or LexiconEmotionScorer() # Model-free scoring for mood tracking and degraded replies
+model_loader = ModelLoader(model_specs()) # Loads the model handles in the background; see /readyz
+model_loading: Optional[asyncio.Task] = None
+# Model outputs keyed by normalized message text / (emotions, history window); near-duplicates match when RESPONSE_CACHE_SIMILARITY > 0
+emotion_cache = ResponseCache("emotion", similarity_threshold=RESPONSE_CACHE_SIMILARITY)
+followup_cache = ResponseCache("followup", normalize=str) # Keys are exact JSON (see followup_cache_key)
 
-# In-memory store for conversation state {user_id: state}
-# **NOTE:** This state is lost when the server restarts. Use a persistent store for production.
-conversations: Dict[str, Dict[str, Any]] = {}
+# Conversation state store {user_id: state}, chosen by CONVERSATION_STORE.
+# **NOTE:** The default in-memory store is lost on restart; use CONVERSATION_STORE=sqlite to persist/share it.
+conversations = create_conversation_store()
 
 # === FastAPI App Setup ===
 app = FastAPI(
@@ -43,27 +99,81 @@ app = FastAPI(
     description="API to interact with a mood-aware chatbot, providing chat responses and recommendations."
 )
 
+async def load_models():
+    """
+    Background half of startup: loads the model handles, builds the executor around them and optionally
+    warms them up. Chat requests get degraded replies until this marks the loader ready.
+    """
+    global llm, router, inference, batcher, prefix_cache, structured_emotions, fair_share, token_counter
+    try:
+        # One handle per worker of each model; each worker loads its own instance
+        models = await model_loader.load_models()
+        pools = {spec.name: ModelPool(spec, models[spec.name]) for spec in model_loader.specs if spec.name in models}
+        router = ModelRouter(pools)
+    except Exception as e:
+        model_loader.mark_failed(e)
+        return
+    inference, batcher = router.main.executor, router.main.batcher
+    handles = [m for pool in pools.values() for m in pool.models]
+    if PREFIX_CACHE_MAX_BYTES > 0 and all(PrefixCache.supported(m) for m in handles):
+        prefix_cache = PrefixCache()
+    token_counter = TokenCounter(router.pool_for(FOLLOWUP_PROFILE).models[0])
+    structured_emotions = EMOTION_DECODING == "structured" and all(
+        supports_constrained_decoding(m) for m in router.pool_for(EMOTION_PROFILE).models)
+    if FAIR_SHARE:
+        # Like the analysis limit: enough turns to keep every follow-up worker busy or fill a batch
+        followups = router.pool_for(FOLLOWUP_PROFILE)
+        fair_share = FairShareScheduler(FAIR_SHARE_CONCURRENCY or max(
+            followups.executor.workers * 2, followups.batcher.max_batch_size if followups.batcher.can_batch else 1))
+    for name, pool in pools.items():
+        logging.info(f"Model '{name}' started with {pool.executor.workers} worker(s), batching {'on' if pool.batcher.can_batch else 'off'}.")
+
+    if MODEL_WARMUP:
+        model_loader.warming_up()
+        try:
+            # Jobs run concurrently, so each one lands on a different worker
+            await asyncio.gather(*(pool.executor.run(warm_up_job, WARMUP_MESSAGES[i % len(WARMUP_MESSAGES)],
+                                                     cache=prefix_cache, structured=structured_emotions)
+                                   for pool in pools.values() for i in range(pool.executor.workers)))
+        except Exception as e:
+            logging.warning(f"Model warm-up failed, serving anyway: {e}")
+    llm = router.main.models[0]
+    model_loader.mark_ready()
+
 def lifespan(app):
     async def startup_event():
-        """Initialize LLM and Spotify client at startup by calling the function from chatbot_logic."""
-        global llm, sp
+        """Starts loading the model in the background and sets up everything that doesn't need it."""
+        global sp, recommendations, model_loading
         logging.info("FastAPI Startup: Initializing dependencies...")
-        llm, sp = initialize_dependencies() # Call the function from the logic file
-        if not llm:
-            logging.warning("LLM initialization failed. API will run with limited functionality.")
-            # Depending on requirements, you might stop the app:
-            # raise RuntimeError("LLM failed to initialize. Cannot start API.")
+        model_loading = asyncio.ensure_future(load_models())
+        sp = init_spotify()
         if not sp:
             logging.warning("Spotify initialization failed or skipped. Recommendation features might be limited.")
+        recommendations = RecommendationCache(sp, catalog=create_catalog())
+        recommendations.start()
+        emotion_cache.load()
+        followup_cache.load()
 
     async def shutdown_event():
-        logging.info("FastAPI Shutdown: Clearing in-memory conversation state.")
-        global conversations
-        conversations.clear()
+        logging.info("FastAPI Shutdown: Closing conversation store.")
+        if model_loading and not model_loading.done():
+            model_loading.cancel() # A handle already loading finishes in its thread and is dropped
+        for task in list(summary_tasks.values()):
+            task.cancel()
+        conversations.close()
+        emotion_cache.save()
+        followup_cache.save()
+        if recommendations:
+            recommendations.stop()
+            if recommendations.catalog:
+                recommendations.catalog.close()
+        if router:
+            router.shutdown()
         # Add any other cleanup if necessary
 
     return startup_event, shutdown_event
 
+app.add_middleware(TraceMiddleware) # Per-request trace IDs (X-Request-ID), see TRACE_REQUESTS
 app.add_event_handler("startup", lifespan(app)[0])
 app.add_event_handler("shutdown", lifespan(app)[1])
 
@@ -80,6 +190,18 @@ class RecommendationOutput(BaseModel):
     songs: List[str]
     music_category: str
 
+class AnalysisMessage(BaseModel):
+    id: Optional[str] = None
+    text: str
+
+class AnalysisRequest(BaseModel):
+    messages: List[AnalysisMessage]
+
+class AnalysisResult(BaseModel):
+    id: Optional[str] = None
+    emotion_scores: Dict[str, float]
+    significant_emotions: List[str]
+
 class ChatResponse(BaseModel):
     user_id: str
     assistant_message: str
@@ -87,49 +209,280 @@ class ChatResponse(BaseModel):
     feeling_better_acknowledged: bool = False
     recommendations: Optional[RecommendationOutput] = None
     current_significant_emotions: Optional[List[str]] = None
+    degraded: bool = False # True when answered without the model (still loading); nothing was recorded
 
-# === API Endpoint ===
-@app.post("/chat/message",
-          response_model=ChatResponse,
-          summary="Send a message to the chatbot",
-          description="Handles user messages, manages conversation state, and returns chatbot responses or recommendations.",
-          tags=["Chat"]
-         )
-async def handle_chat_message(message_input: ChatMessageInput = Body(...)):
+# === Helpers ===
+def inference_overloaded(error: Exception) -> HTTPException:
+    """Maps executor admission errors to 429 (queue full) or 503 (unavailable/timed out)."""
+    logging.warning(f"Inference rejected request: {error}")
+    if isinstance(error, InferenceQueueFull):
+        retry_after = math.ceil(getattr(error, "retry_after", 2)) # Rate-limited turns know when a token is due
+        return HTTPException(status_code=429, detail="Chatbot is busy, please retry shortly.", headers={"Retry-After": str(retry_after)})
+    return HTTPException(status_code=503, detail="Chatbot is temporarily unavailable.", headers={"Retry-After": "5"})
+
+async def generate(prompt: str, profile: Any, conversation_id: Optional[str] = None, preamble: Optional[str] = None,
+                   stage_name: Optional[str] = "llm_inference", affinity: Optional[str] = None) -> str:
     """
-    Main endpoint for chat interaction.
-    Requires user_id and text. Manages conversation state in memory.
+    Sends one prompt to the profile's model (see ModelRouter). With the prefix cache active, calls run directly
+    on the executor (conversation prompts pinned to the model holding their prefix); otherwise via the batch scheduler.
+    `affinity` pins a prompt that isn't the conversation's follow-up (e.g. its summary) to that model too.
+    Background calls pass stage_name=None so they don't count toward chat request stages.
     """
-    user_id = message_input.user_id
-    user_text = message_input.text
-    user_name = message_input.user_name
-
-    # Access initialized LLM and SP clients from globals
-    global llm, sp
-    global conversations
-
-    # Now using the MockLLM fallback, this should never be None
-    if not llm:
-        logging.warning("Using basic fallback responses as LLM is unavailable")
-        # Very simple fallback if somehow llm is still None
-        return ChatResponse(
-            user_id=user_id,
-            assistant_message="I'm here to listen. Can you tell me more about how you're feeling?",
-            current_significant_emotions=["neutral"]
-        )
+    async def call(pool: ModelPool) -> str:
+        if prefix_cache:
+            return await pool.executor.run(generate_with_prefix_cache, prompt, prefix_cache, profile,
+                                           affinity=affinity or conversation_id, conversation_id=conversation_id, preamble=preamble)
+        return await pool.batcher.generate(prompt, profile)
+
+    if stage_name is None:
+        return await router.generate(profile, call)
+    with stage(stage_name):
+        return await router.generate(profile, call)
+
+def stream_followup(prompt: str, conversation_id: str, preamble: str):
+    """
+    Starts streaming a follow-up question; raises admission errors before any token is produced.
+    Streams go to the routed model without the draft cascade, since tokens are sent as they arrive.
+    """
+    executor = router.pool_for(FOLLOWUP_PROFILE).executor
+    if prefix_cache:
+        job = partial(stream_with_prefix_cache, cache=prefix_cache, profile=FOLLOWUP_PROFILE,
+                      conversation_id=conversation_id, preamble=preamble)
+        return executor.stream(prompt, affinity=conversation_id, generate=job)
+    return executor.stream(prompt, generate=partial(stream_with_profile, profile=FOLLOWUP_PROFILE))
+
+async def detect_emotions(text: str, admit: Optional[Callable[[], Awaitable[None]]] = None) -> dict:
+    """
+    Async counterpart of chatbot_logic.detect_emotion_percentages.
+    Uses the local emotion scorer when configured, then the response cache, and only goes to the LLM
+    when neither has an answer: constrained decoding if the model supports it, otherwise the
+    free-form prompt via the batch scheduler. `admit` is awaited before the model call.
+    """
+    if emotion_scorer:
+        scores = emotion_scorer.score(text)
+        if scores is not None:
+            return scores
+    cached = emotion_cache.get(text)
+    if cached is not None:
+        return dict(cached)
+    if admit:
+        await admit()
+    if structured_emotions:
+        with stage("llm_inference"):
+            scores = await router.pool_for(EMOTION_PROFILE).executor.run(score_emotions_structured, text, cache=prefix_cache)
+        if scores is not None:
+            emotion_cache.put(text, scores)
+            return dict(scores)
+    try:
+        response = await generate(build_emotion_prompt(text), EMOTION_PROFILE)
+    except (InferenceQueueFull, InferenceUnavailable):
+        raise
+    except Exception as e:
+        logging.error(f"Error during emotion detection: {e}")
+        return NEUTRAL_SCORES.copy()
+    scores = parse_emotion_response(response)
+    if scores != NEUTRAL_SCORES: # Neutral is also the parse-failure fallback; don't pin it
+        emotion_cache.put(text, scores)
+    return dict(scores)
+
+async def next_followup_question(significant_emotions: list, history: list, conversation_id: str,
+                                 summary: Optional[str] = None, admit: Optional[Callable[[], Awaitable[None]]] = None) -> str:
+    """
+    Async counterpart of chatbot_logic.generate_followup_question, cached per (emotions, history window).
+    `admit` is awaited before the model call, so cache hits skip it.
+    """
+    with stage("prompt_build"):
+        window = window_followup_history(significant_emotions, history, summary, token_counter)
+        cache_key = followup_cache_key(significant_emotions, summary, window[1])
+        cached = followup_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        prompt = build_followup_prompt(significant_emotions, history, summary, token_counter, window=window)
+    if admit:
+        await admit()
+    try:
+        response = await generate(prompt, FOLLOWUP_PROFILE, conversation_id, build_followup_preamble(significant_emotions))
+    except (InferenceQueueFull, InferenceUnavailable):
+        raise
+    except Exception as e:
+        logging.error(f"Error generating follow-up question: {e}")
+        return "How are you feeling about that?"
+    question = complete_question(parse_followup_response(response)) # Well-formed even if cut at the deadline
+    if question:
+        followup_cache.put(cache_key, question)
+    return question
+
+async def score_turn(text: str, admit: Optional[Callable[[], Awaitable[None]]] = None) -> Optional[dict]:
+    """
+    Scores one later user turn for mood tracking (see MOOD_TRACKING), or None if the turn carries no signal.
+    Only the new message is scored, so the cost doesn't grow with the conversation.
+    """
+    scores = local_scorer.score(text)
+    if scores is None and MOOD_TRACKING == "full":
+        scores = await detect_emotions(text, admit) # Cache first, then one short model call
+        if scores == NEUTRAL_SCORES: # Also the parse-failure fallback, so it says nothing about the mood
+            scores = None
+    return scores
 
+# === History Summaries ===
+# Follow-up prompts hold as much recent history as fits FOLLOWUP_PROMPT_TOKENS; once the history outgrows it,
+# the entries left out are folded into a rolling summary stored in the conversation state, after the reply
+# has gone out. Summaries are the lowest-priority model work: they wait for an idle model and never queue.
+
+HISTORY_SUMMARIES = {
+    outcome: Counter("history_summaries_total", "Background history summary runs, by outcome.", labels={"outcome": outcome})
+    for outcome in ("updated", "skipped_busy", "failed")
+}
+summary_tasks: Dict[str, asyncio.Task] = {} # user_id -> running summarize_history, at most one per conversation
+
+def entries_to_summarize(state: Dict[str, Any]) -> int:
+    """How many of the oldest history entries to fold into the summary: those the next follow-up prompt has no room for."""
+    _, _, left_out, _ = window_followup_history(state["current_significant_emotions"], list(state["history"]),
+                                                state.get("summary"), token_counter)
+    return left_out
+
+def schedule_summary(user_id: str, state: Dict[str, Any]):
+    if not HISTORY_SUMMARY or user_id in summary_tasks or entries_to_summarize(state) <= 0:
+        return
+    task = asyncio.ensure_future(summarize_history(user_id))
+    summary_tasks[user_id] = task
+    task.add_done_callback(lambda _: summary_tasks.pop(user_id, None))
+
+async def summarize_history(user_id: str):
+    """
+    Folds the oldest history entries into the conversation's summary with one short model call, so it never
+    delays a reply: it runs only while the summary model has no queue and, with FAIR_SHARE, on a slot no
+    waiting turn wants. On the follow-up model it also waits for the idle model holding this conversation's
+    prefix rather than overwriting another conversation's. A skipped run is retried after the next turn.
+    """
+    pool = router.pool_for(SUMMARY_PROFILE)
+    # The summary changes the follow-up prompt right after the tone preamble, so only the preamble stays
+    # reusable; the summary prompt starts with it and the conversation's model keeps it (see PrefixCache).
+    own_model = prefix_cache is not None and pool is router.pool_for(FOLLOWUP_PROFILE)
+    if pool.executor.queue_depth > 0 or (own_model and not pool.executor.holds_idle(user_id)):
+        HISTORY_SUMMARIES["skipped_busy"].inc()
+        return
+    state = conversations.get(user_id)
+    if state is None:
+        return
+    folded = list(state["history"])[:entries_to_summarize(state)]
+    if not folded:
+        return
+    grant = fair_share.try_acquire_idle() if fair_share else None
+    if fair_share and grant is None:
+        HISTORY_SUMMARIES["skipped_busy"].inc()
+        return
+    preamble = build_followup_preamble(state["current_significant_emotions"]) if own_model else ""
+    try:
+        summary = parse_summary_response(await generate(build_summary_prompt(state.get("summary"), folded, preamble),
+                                                        SUMMARY_PROFILE, stage_name=None, affinity=user_id if own_model else None))
+    except Exception as e: # Busy, unavailable or failed; the entries stay in the history for now
+        logging.warning(f"History summary for user {user_id} failed: {e}")
+        HISTORY_SUMMARIES["failed"].inc()
+        return
+    finally:
+        if grant:
+            grant.release()
+    if not summary:
+        HISTORY_SUMMARIES["failed"].inc()
+        return
+
+    # Re-read: a turn may have run meanwhile. The store may also have dropped some folded entries already.
+    # With a store outside the process, a turn saved after this update overwrites it and the next run redoes it.
+    state = conversations.get(user_id)
+    if state is None:
+        return # Ended meanwhile
+    history = state["history"]
+    for entry in folded:
+        if history and history[0] == entry:
+            history.popleft()
+    state["summary"] = summary
+    conversations.put(user_id, state)
+    HISTORY_SUMMARIES["updated"].inc()
+    logging.info(f"Summarized {len(folded)} older history entries for user_id: {user_id}")
+
+# === Conversation Turn Handling ===
+# Shared by the regular and streaming chat endpoints so both update state identically.
+
+FALLBACK_REPLY = "I'm here to listen. Can you tell me more about how you're feeling?"
+
+def degraded_reply(user_id: str, user_text: str) -> ChatResponse:
+    """
+    Reply for chat requests that arrive before the model is ready (see MODEL_READY_WAIT_MS).
+    No conversation state is created, so the conversation starts normally once the model is up.
+    """
+    DEGRADED_REPLIES.inc()
+    scores = local_scorer.score(user_text)
+    significant_emotions = get_significant_emotions(scores) if scores else ["neutral"]
+    return ChatResponse(user_id=user_id, assistant_message=FALLBACK_REPLY,
+                        current_significant_emotions=significant_emotions, degraded=True)
+
+async def admit_turn(turn: Dict[str, Any]):
+    """
+    Waits for the fair-share scheduler to give the turn a model slot (see FAIR_SHARE). Awaited right before
+    the turn's first model call, so turns answered without the model (endings, cache hits) take neither a
+    slot nor a rate-limit token; later calls in the same turn keep the slot. Refusals are raised as the
+    executor's InferenceQueueFull / InferenceUnavailable, which callers already map to 429/503.
+    """
+    if not fair_share or turn["grant"]:
+        return
+    with stage("fair_share_wait"):
+        turn["grant"] = await fair_share.acquire(turn["user_id"], turn["new"])
+
+def undo_turn(turn: Dict[str, Any]):
+    """
+    Puts the conversation back as it was before open_turn, for a turn refused with 429/503 after it stored the
+    user message: the client retries the same message, which must neither be recorded twice nor use up a round.
+    """
+    if turn["previous_state"] is None:
+        conversations.delete(turn["user_id"])
+    else:
+        conversations.put(turn["user_id"], turn["previous_state"])
+
+def release_turn(turn: Dict[str, Any]):
+    """Hands the turn's model slot to the next waiting turn once its reply is generated. Safe to call twice."""
+    if turn["grant"]:
+        turn["grant"].release()
+
+async def begin_turn(user_id: str, user_text: str, user_name: Optional[str]) -> Dict[str, Any]:
+    """
+    Loads the conversation state and opens the turn. Returns the turn dict consumed by finish_turn;
+    callers call release_turn once the reply is generated.
+    """
+    with stage("state_lookup"):
+        state = conversations.get(user_id)
+    turn = {
+        "user_id": user_id,
+        "new": state is None,
+        "grant": None, # Model slot from the fair-share scheduler, taken by admit_turn on the first model call
+        # What undo_turn restores; None for a new conversation. Shallow is enough: open_turn only appends to the history.
+        "previous_state": None if state is None else {**state, "history": list(state["history"])},
+    }
+    try:
+        await open_turn(turn, user_text, user_name, state)
+    except BaseException: # Including cancellation; the slot must not leak
+        release_turn(turn)
+        raise
+    return turn
+
+async def open_turn(turn: Dict[str, Any], user_text: str, user_name: Optional[str], state: Optional[Dict[str, Any]]):
+    """Creates the conversation state if there is none, records the user message and checks end conditions."""
+    user_id = turn["user_id"]
     # --- Initialize or retrieve conversation state ---
-    if user_id not in conversations:
+    if state is None:
         logging.info(f"Starting new conversation for user_id: {user_id}")
         try:
-            # Call functions from chatbot_logic, passing llm/sp
-            emotion_scores = detect_emotion_percentages(user_text, llm=llm)
+            # Model calls go through the batch scheduler and inference executor
+            with stage("emotion_detection"):
+                emotion_scores = await detect_emotions(user_text, partial(admit_turn, turn))
             significant_emotions = get_significant_emotions(emotion_scores)
+        except (InferenceQueueFull, InferenceUnavailable) as e:
+            raise inference_overloaded(e)
         except Exception as e:
              logging.error(f"Initial mood analysis failed for user {user_id}: {e}")
              raise HTTPException(status_code=500, detail="Failed to analyze initial mood.")
 
-        conversations[user_id] = {
+        state = {
             "history": [{"role": "user", "content": user_text}],
             "initial_significant_emotions": significant_emotions.copy(),
             "current_significant_emotions": significant_emotions.copy(),
@@ -141,45 +494,63 @@ async def handle_chat_message(message_input: ChatMessageInput = Body(...)):
     else:
         # Continuing existing conversation
         logging.info(f"Continuing conversation for user_id: {user_id}")
-        state = conversations[user_id]
         state["history"].append({"role": "user", "content": user_text})
         state["rounds"] += 1
+        if MOOD_TRACKING != "off":
+            try:
+                with stage("emotion_detection"):
+                    turn_scores = await score_turn(user_text, partial(admit_turn, turn))
+            except (InferenceQueueFull, InferenceUnavailable) as e:
+                logging.warning(f"Skipping mood update for user {user_id}: {e}") # The reply matters more than the update
+                turn_scores = None
+            if turn_scores and update_mood(state, turn_scores):
+                logging.info(f"Mood for user_id {user_id} is now {state['current_significant_emotions']}")
 
-    # Access the current conversation state
-    state = conversations[user_id]
+    turn.update({
+        "state": state,
+        "assistant_reply": "",
+        "conversation_ended": False,
+        "feeling_better_acknowledged": False,
+    })
 
     # --- Check for End Conditions ---
-    assistant_reply = ""
-    conversation_ended = False
-    feeling_better_acknowledged = False
-    recommendations_obj = None # Use different name to avoid conflict with module
-
     if user_text.lower() in ["exit", "quit", "bye", "stop"]:
-        assistant_reply = f"Okay {state['name']}, ending our chat here. Take care!"
-        conversation_ended = True
+        turn["assistant_reply"] = f"Okay {state['name']}, ending our chat here. Take care!"
+        turn["conversation_ended"] = True
     elif any(phrase in user_text.lower() for phrase in ["feel better", "good now", "happy now", "relaxed now", "yes i feel better", "yes", "improved", "calmer"]):
-        assistant_reply = f"That's wonderful to hear, {state['name']}! I'm glad our chat helped a bit. 😊"
-        conversation_ended = True
-        feeling_better_acknowledged = True
+        turn["assistant_reply"] = f"That's wonderful to hear, {state['name']}! I'm glad our chat helped a bit. 😊"
+        turn["conversation_ended"] = True
+        turn["feeling_better_acknowledged"] = True
         state["feeling_better_flag"] = True
     elif state["rounds"] >= MAX_CHAT_ROUNDS:
-        assistant_reply = f"We've chatted for a bit, {state['name']}. Remember I'm here if you need to talk more later. Let me know if you'd like some recommendations based on how you felt initially."
-        conversation_ended = True
+        # Recommendations follow the tracked mood unless mood tracking is off (see finish_turn)
+        basis = "how you felt initially" if MOOD_TRACKING == "off" else "how you're feeling now"
+        turn["assistant_reply"] = f"We've chatted for a bit, {state['name']}. Remember I'm here if you need to talk more later. Let me know if you'd like some recommendations based on {basis}."
+        turn["conversation_ended"] = True
+
+    conversations.put(user_id, state)
+
+async def finish_turn(turn: Dict[str, Any]) -> ChatResponse:
+    """Records the assistant reply, adds recommendations and clears state if the conversation ended."""
+    user_id = turn["user_id"]
+    state = turn["state"]
+    assistant_reply = turn["assistant_reply"]
+    conversation_ended = turn["conversation_ended"]
+    recommendations_obj = None # Use different name to avoid conflict with module
 
-    # --- Generate response based on conversation state ---
     if not conversation_ended:
-        try:
-            assistant_reply = generate_followup_question(state["current_significant_emotions"], state["history"], llm=llm)
-        except Exception as e:
-            logging.error(f"Follow-up question generation failed for user {user_id}: {e}")
-            raise HTTPException(status_code=500, detail="Failed to generate chat response.")
         state["history"].append({"role": "assistant", "content": assistant_reply})
+        conversations.put(user_id, state)
+        schedule_summary(user_id, state) # Off the critical path; the next prompt uses it if it's ready
 
     # --- Generate Recommendations if Conversation Ended ---
     if conversation_ended:
         try:
-            # Call recommendation function from logic, passing sp
-            recommendations_data = generate_recommendations(state["initial_significant_emotions"], sp=sp)
+            # Served from the recommendation cache; providers are queried concurrently on a miss
+            with stage("recommendations"):
+                # With mood tracking, recommendations follow where the conversation ended up
+                mood = state["initial_significant_emotions"] if MOOD_TRACKING == "off" else state["current_significant_emotions"]
+                recommendations_data = await recommendations.get(mood)
             recommendations_obj = RecommendationOutput(**recommendations_data) # Create Pydantic obj
             if assistant_reply: assistant_reply += "\n\nBased on how you were feeling, here are some ideas:"
             else: assistant_reply = "Based on how you were feeling, here are some ideas:"
@@ -189,8 +560,9 @@ async def handle_chat_message(message_input: ChatMessageInput = Body(...)):
             else: assistant_reply = "Okay, ending chat. (Sorry, couldn't fetch recommendations right now.)"
 
         # --- Clean up state for ended conversation ---
-        if user_id in conversations: # Check if key exists before deleting
-            del conversations[user_id]
+        if prefix_cache:
+            prefix_cache.discard(user_id)
+        if conversations.delete(user_id): # False if the state was already removed or evicted
             logging.info(f"Conversation ended and state cleared for user_id: {user_id}")
         else:
             logging.warning(f"Attempted to delete state for user_id {user_id}, but it was already removed.")
@@ -200,11 +572,337 @@ async def handle_chat_message(message_input: ChatMessageInput = Body(...)):
         user_id=user_id,
         assistant_message=assistant_reply,
         conversation_ended=conversation_ended,
-        feeling_better_acknowledged=feeling_better_acknowledged,
+        feeling_better_acknowledged=turn["feeling_better_acknowledged"],
         recommendations=recommendations_obj, # Assign Pydantic obj here
         current_significant_emotions=state.get("current_significant_emotions")
     )
 
+async def start_reply(turn: Dict[str, Any]) -> AsyncIterator[str]:
+    """
+    Starts the follow-up question for the streaming transports (SSE and WebSocket): a cached reply, or a
+    stream from the model. Admission errors (fair share and executor) are raised here, before iteration. The returned iterator yields
+    the reply's text pieces and records the final reply in the turn; it yields nothing for an ended turn.
+    """
+    user_id = turn["user_id"]
+    tokens = None
+    cache_key = cached_reply = None
+    if not turn["conversation_ended"]:
+        state = turn["state"]
+        with stage("prompt_build"):
+            window = window_followup_history(state["current_significant_emotions"], state["history"], state.get("summary"), token_counter)
+            cache_key = followup_cache_key(state["current_significant_emotions"], state.get("summary"), window[1])
+            cached_reply = followup_cache.get(cache_key)
+            if cached_reply is None:
+                prompt = build_followup_prompt(state["current_significant_emotions"], state["history"], state.get("summary"), token_counter,
+                                               window=window)
+                preamble = build_followup_preamble(state["current_significant_emotions"])
+        if cached_reply is None:
+            await admit_turn(turn)
+            tokens = stream_followup(prompt, user_id, preamble)
+
+    async def pieces():
+        if cached_reply is not None:
+            turn["assistant_reply"] = cached_reply
+            yield cached_reply
+        elif tokens is not None:
+            generated = []
+            try:
+                async for token in tokens:
+                    generated.append(token)
+                    yield token
+            except Exception as e:
+                logging.error(f"Streaming follow-up generation failed for user {user_id}: {e}")
+            reply = complete_question(parse_followup_response("".join(generated)))
+            if reply:
+                followup_cache.put(cache_key, reply)
+            turn["assistant_reply"] = reply or "How are you feeling about that?"
+
+    return pieces()
+
+def sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+
+# === API Endpoints ===
+@app.post("/chat/message",
+          response_model=ChatResponse,
+          summary="Send a message to the chatbot",
+          description="Handles user messages, manages conversation state, and returns chatbot responses or recommendations.",
+          tags=["Chat"]
+         )
+async def handle_chat_message(message_input: ChatMessageInput = Body(...)):
+    """
+    Main endpoint for chat interaction.
+    Requires user_id and text. Manages conversation state in memory.
+    """
+    user_id = message_input.user_id
+
+    if not await model_loader.wait_ready():
+        logging.warning(f"Model not ready ({model_loader.phase}); sending a degraded reply")
+        return degraded_reply(user_id, message_input.text)
+
+    turn = await begin_turn(user_id, message_input.text, message_input.user_name)
+
+    # --- Generate response based on conversation state ---
+    try:
+        if not turn["conversation_ended"]:
+            state = turn["state"]
+            try:
+                turn["assistant_reply"] = await next_followup_question(state["current_significant_emotions"], state["history"], user_id,
+                                                                       state.get("summary"), partial(admit_turn, turn))
+            except (InferenceQueueFull, InferenceUnavailable) as e:
+                undo_turn(turn)
+                raise inference_overloaded(e)
+            except Exception as e:
+                logging.error(f"Follow-up question generation failed for user {user_id}: {e}")
+                raise HTTPException(status_code=500, detail="Failed to generate chat response.")
+    finally:
+        release_turn(turn) # Recommendations don't need the model
+
+    response = await finish_turn(turn)
+    with stage("response_serialization"):
+        # Serialized here rather than by FastAPI so the time shows up in chat_stage_seconds
+        return JSONResponse(jsonable_encoder(response))
+
+
+@app.post("/chat/message/stream",
+          summary="Send a message and stream the reply",
+          description="Same as /chat/message, but streams the follow-up question as Server-Sent Events. "
+                      "Emits `token` events ({\"text\": ...}) while generating, then one `done` event carrying the ChatResponse.",
+          tags=["Chat"]
+         )
+async def stream_chat_message(message_input: ChatMessageInput = Body(...)):
+    """Streaming variant of handle_chat_message; conversation state is finalized the same way."""
+    user_id = message_input.user_id
+
+    if not await model_loader.wait_ready():
+        logging.warning(f"Model not ready ({model_loader.phase}); sending a degraded reply")
+        fallback = degraded_reply(user_id, message_input.text)
+        return StreamingResponse(iter([sse_event("done", fallback)]), media_type="text/event-stream")
+
+    turn = await begin_turn(user_id, message_input.text, message_input.user_name)
+
+    try:
+        # Admission happens here so an overloaded queue still gets a proper 429/503
+        pieces = await start_reply(turn)
+    except (InferenceQueueFull, InferenceUnavailable) as e:
+        release_turn(turn)
+        undo_turn(turn)
+        raise inference_overloaded(e)
+
+    async def events():
+        try:
+            async for piece in pieces:
+                yield sse_event("token", {"text": piece})
+        finally:
+            release_turn(turn)
+        response = await finish_turn(turn)
+        with stage("response_serialization"):
+            done = sse_event("done", response)
+        yield done
+
+    # The background task also frees the slot if the client disconnects before the stream starts
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"},
+                             background=BackgroundTask(release_turn, turn))
+
+
+# === WebSocket Gateway ===
+# One persistent connection per user carrying chat turns and streamed replies, without an HTTP
+# request per message. Turns on a connection are answered one at a time, in order.
+WS_MAX_PENDING = max(1, int(os.getenv("WS_MAX_PENDING", 4))) # Messages a connection may queue behind the one being answered
+WS_PING_INTERVAL = max(1.0, float(os.getenv("WS_PING_INTERVAL", 20))) # Seconds of client silence before the server sends a ping
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", 300)) # Seconds without any client message before the connection is closed
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", 10)) # A client that doesn't read for this long is disconnected
+
+WS_CONNECTIONS = Gauge("ws_connections", "Open chat WebSocket connections.")
+WS_TURNS = Counter("ws_turns_total", "Chat messages answered over WebSocket connections.")
+WS_REJECTED = {
+    reason: Counter("ws_rejected_total", "WebSocket chat messages refused by backpressure.", labels={"reason": reason})
+    for reason in ("connection_busy", "server_busy")
+}
+WS_CLOSED = {
+    reason: Counter("ws_closed_total", "WebSocket connections closed, by reason.", labels={"reason": reason})
+    for reason in ("client", "idle", "slow_consumer", "error")
+}
+
+
+class SlowConsumer(Exception):
+    pass
+
+
+class ChatSocket:
+    """
+    Server side of one /ws/chat connection. `receive_forever` reads client messages, answers pings and
+    queues chat messages (up to WS_MAX_PENDING); `answer_forever` answers them in order. Each connection
+    costs two idle tasks, so thousands of open connections fit in one process.
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: str, user_name: str):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.user_name = user_name
+        self.pending: asyncio.Queue = asyncio.Queue(maxsize=WS_MAX_PENDING)
+        self._send_lock = asyncio.Lock()
+
+    async def send(self, payload: Dict[str, Any]):
+        data = json.dumps(jsonable_encoder(payload))
+        async with self._send_lock:
+            try:
+                await asyncio.wait_for(self.websocket.send_text(data), WS_SEND_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise SlowConsumer(f"Client didn't read for {WS_SEND_TIMEOUT}s")
+
+    async def send_error(self, message_id: Any, status: int, detail: str, retry_after: Optional[str] = None):
+        await self.send({"type": "error", "id": message_id, "status": status, "detail": detail, "retry_after": retry_after})
+
+    async def receive_forever(self) -> str:
+        """Returns why reading stopped: "client" (disconnected) or "idle"."""
+        loop = asyncio.get_running_loop()
+        last_seen = loop.time()
+        while True:
+            try:
+                frame = await asyncio.wait_for(self.websocket.receive(), WS_PING_INTERVAL)
+            except asyncio.TimeoutError:
+                if loop.time() - last_seen >= WS_IDLE_TIMEOUT:
+                    return "idle"
+                await self.send({"type": "ping"})
+                continue
+            if frame["type"] == "websocket.disconnect":
+                return "client"
+            last_seen = loop.time()
+            try:
+                message = json.loads(frame.get("text") or frame.get("bytes") or b"")
+                kind = message.get("type")
+            except (ValueError, AttributeError):
+                await self.send_error(None, 400, "Messages must be JSON objects.")
+                continue
+
+            if kind == "ping":
+                await self.send({"type": "pong"})
+            elif kind == "pong":
+                pass
+            elif kind == "message":
+                if not isinstance(message.get("text"), str) or not message["text"].strip():
+                    await self.send_error(message.get("id"), 422, "A chat message needs non-empty `text`.")
+                    continue
+                try:
+                    self.pending.put_nowait(message)
+                except asyncio.QueueFull:
+                    WS_REJECTED["connection_busy"].inc()
+                    await self.send_error(message.get("id"), 429, f"At most {WS_MAX_PENDING} messages may wait for a reply.", "1")
+            else:
+                await self.send_error(message.get("id"), 400, f"Unknown message type '{kind}'.")
+
+    async def answer_forever(self):
+        while True:
+            message = await self.pending.get()
+            if TRACE_REQUESTS:
+                TRACE_ID.set(str(message["id"])[:64] if message.get("id") else new_trace_id())
+            await self.answer(message)
+
+    async def answer(self, message: Dict[str, Any]):
+        """One chat turn, same state handling as the HTTP endpoints; replies are `token` events then `done`."""
+        message_id = message.get("id")
+        text = message["text"]
+        WS_TURNS.inc()
+        if not await model_loader.wait_ready():
+            await self.send({"type": "done", "id": message_id, "response": degraded_reply(self.user_id, text)})
+            return
+        # Global backpressure: refuse before doing any work while the inference queue is full
+        if router.pool_for(FOLLOWUP_PROFILE).executor.saturated():
+            WS_REJECTED["server_busy"].inc()
+            await self.send_error(message_id, 429, "Chatbot is busy, please retry shortly.", "2")
+            return
+        try:
+            turn = await begin_turn(self.user_id, text, message.get("user_name") or self.user_name)
+            try:
+                pieces = await start_reply(turn)
+            except (InferenceQueueFull, InferenceUnavailable) as e:
+                release_turn(turn)
+                undo_turn(turn)
+                raise inference_overloaded(e)
+        except HTTPException as e:
+            await self.send_error(message_id, e.status_code, e.detail, (e.headers or {}).get("Retry-After"))
+            return
+
+        try:
+            async for piece in pieces:
+                await self.send({"type": "token", "id": message_id, "text": piece})
+        finally:
+            release_turn(turn)
+        response = await finish_turn(turn)
+        with stage("response_serialization"):
+            done = {"type": "done", "id": message_id, "response": jsonable_encoder(response)}
+        await self.send(done)
+
+
+@app.websocket("/ws/chat")
+async def chat_socket(websocket: WebSocket, user_id: str, user_name: str = "Friend"):
+    """
+    WebSocket chat: `/ws/chat?user_id=...`. The client sends {"type": "message", "text": ..., "id": ...};
+    the server answers with `token` events ({"text": ...}) and one `done` event carrying the ChatResponse,
+    echoing the message id. Refused or failed messages get an `error` event with an HTTP-style status.
+    Either side may send {"type": "ping"}; the other answers {"type": "pong"}.
+    """
+    await websocket.accept()
+    WS_CONNECTIONS.inc()
+    socket = ChatSocket(websocket, user_id, user_name)
+    reader = asyncio.ensure_future(socket.receive_forever())
+    writer = asyncio.ensure_future(socket.answer_forever())
+    reason = "error"
+    try:
+        done, _ = await asyncio.wait({reader, writer}, return_when=asyncio.FIRST_COMPLETED)
+        finished = done.pop()
+        error = finished.exception()
+        if error is None:
+            reason = finished.result()
+        elif isinstance(error, SlowConsumer):
+            reason = "slow_consumer"
+        elif isinstance(error, WebSocketDisconnect):
+            reason = "client"
+        else:
+            logging.error(f"WebSocket connection for user {user_id} failed: {error}")
+    finally:
+        reader.cancel()
+        writer.cancel()
+        WS_CONNECTIONS.dec()
+        WS_CLOSED[reason].inc()
+    if reason != "client":
+        try:
+            await websocket.close(code=1008 if reason == "slow_consumer" else 1000 if reason == "idle" else 1011)
+        except Exception: # Already gone
+            pass
+
+
+# Bigger exports should go through `python batch_analysis.py`, which checkpoints and uses a process pool
+ANALYSIS_MAX_MESSAGES = int(os.getenv("ANALYSIS_MAX_MESSAGES", 100))
+
+@app.post("/analysis/emotions",
+          response_model=List[AnalysisResult],
+          summary="Score emotions for a batch of messages",
+          description="Scores up to ANALYSIS_MAX_MESSAGES messages without touching conversation state. "
+                      "Results are returned in request order.",
+          tags=["Analysis"]
+         )
+async def analyze_emotions(request: AnalysisRequest = Body(...)):
+    if not await model_loader.wait_ready():
+        raise HTTPException(status_code=503, detail=f"Emotion analysis is unavailable (model {model_loader.phase}).",
+                            headers={"Retry-After": "5"})
+    if len(request.messages) > ANALYSIS_MAX_MESSAGES:
+        raise HTTPException(status_code=413, detail=f"At most {ANALYSIS_MAX_MESSAGES} messages per request.")
+
+    # Enough concurrency to fill a batch or keep every worker busy, without flooding the shared queue
+    pool = router.pool_for(EMOTION_PROFILE)
+    limit = asyncio.Semaphore(max(pool.executor.workers * 2, pool.batcher.max_batch_size if pool.batcher.can_batch else 1))
+
+    async def analyze(message: AnalysisMessage) -> AnalysisResult:
+        async with limit:
+            scores = await detect_emotions(message.text)
+        return AnalysisResult(id=message.id, emotion_scores=scores, significant_emotions=get_significant_emotions(scores))
+
+    try:
+        return await asyncio.gather(*(analyze(message) for message in request.messages))
+    except (InferenceQueueFull, InferenceUnavailable) as e:
+        raise inference_overloaded(e)
 
 # === Root Endpoint ===
 @app.get("/", tags=["Status"])
@@ -212,10 +910,62 @@ async def root():
     """Basic status endpoint to check if the API is running."""
     return {"message": "Mood Aware Chatbot API is running. POST to /chat/message to interact."}
 
+@app.get("/healthz", tags=["Status"])
+async def healthz():
+    """Liveness probe: the process is up and serving, even while the model is still loading."""
+    if model_loader.phase == "failed":
+        return JSONResponse({"status": "failed", "error": model_loader.error}, status_code=503)
+    return {"status": "ok"}
+
+@app.get("/readyz", tags=["Status"])
+async def readyz():
+    """Readiness probe: 200 once chat requests are served by the model, 503 with load progress until then."""
+    if model_loader.ready:
+        return model_loader.status()
+    return JSONResponse(model_loader.status(), status_code=503, headers={"Retry-After": "5"})
+
+@app.get("/stats", tags=["Status"])
+async def stats():
+    """Inference queue and timing metrics, useful for sizing replicas."""
+    return {
+        "model": model_loader.status(),
+        "inference": inference.stats() if inference else None,
+        "batching": batcher.stats() if batcher else None,
+        "models": router.stats() if router else None,
+        "fair_share": fair_share.stats() if fair_share else None,
+        "followup_prompts": {
+            "budget_tokens": FOLLOWUP_PROMPT_TOKENS,
+            "exact_token_counts": token_counter.exact,
+            "prompt_tokens": PROMPT_TOKENS.snapshot(),
+            "summaries": {outcome: counter.value for outcome, counter in HISTORY_SUMMARIES.items()},
+        },
+        "generation": generation.stats(),
+        "prefix_cache": prefix_cache.stats() if prefix_cache else None,
+        "response_cache": {"emotion": emotion_cache.stats(), "followup": followup_cache.stats()},
+        "recommendations": recommendations.stats() if recommendations else None,
+        "providers": http_client.stats(),
+        "conversations": conversations.stats(),
+        "metrics": metrics.snapshot(),
+    }
+
+@app.get("/metrics", tags=["Status"], response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """All registered metrics in the Prometheus text format, for scraping."""
+    conversations.stats() # Refreshes the session gauge for stores that keep state outside the process
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
 # === Run the API ===
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
-    logging.info(f"Starting Uvicorn server on host 0.0.0.0, port {port}")
+    workers = max(1, int(os.getenv("UVICORN_WORKERS", 1)))
+    if workers > 1:
+        # Worker processes inherit these. Conversation state has to live outside the process because
+        # a user's next message can land on any worker, and model threads are split across workers.
+        if os.getenv("CONVERSATION_STORE", "memory").lower() == "memory":
+            logging.warning("UVICORN_WORKERS > 1 needs shared conversation state. Using CONVERSATION_STORE=sqlite.")
+            os.environ["CONVERSATION_STORE"] = "sqlite"
+        os.environ.setdefault("MODEL_THREADS", str(max(1, (os.cpu_count() or 1) // workers)))
+    logging.info(f"Starting Uvicorn server on host 0.0.0.0, port {port} with {workers} worker(s)")
     # Note: reload=True is useful for development as it restarts the server on code changes,
     # but ensure it's False for production. It will call the startup event again on reload.
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=False)
\ No newline at end of file
+    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=False, workers=workers)
\ No newline at end of file
@@ -0,0 +1,180 @@
+# metrics.py
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, Sequence
+
+# === Metric Primitives ===
+# Small, dependency-free counters/gauges/histograms. Every metric registers itself
+# in REGISTRY on creation so the API can dump them all from one place. Metrics that share
+# a name but differ in labels (e.g. one histogram per stage) are rendered as one family.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+REGISTRY: Dict[str, Any] = {}
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(labels: Dict[str, str]) -> str:
+    return ",".join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items()))
+
+
+def _register(metric):
+    labels = _label_text(metric.labels)
+    metric.key = f"{metric.name}{{{labels}}}" if labels else metric.name
+    if metric.key in REGISTRY:
+        raise ValueError(f"Metric '{metric.key}' is already registered.")
+    REGISTRY[metric.key] = metric
+
+
+class Counter:
+    """Monotonically increasing count."""
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.description = description
+        self.labels = dict(labels or {})
+        self.value = 0.0
+        self._lock = threading.Lock()
+        _register(self)
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self) -> dict:
+        return {"value": self.value}
+
+
+class Gauge:
+    """Value that can go up and down (queue depth, active sessions, ...)."""
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labels: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.description = description
+        self.labels = dict(labels or {})
+        self.value = 0.0
+        self._lock = threading.Lock()
+        _register(self)
+
+    def set(self, value: float):
+        with self._lock:
+            self.value = value
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        with self._lock:
+            self.value -= amount
+
+    def snapshot(self) -> dict:
+        return {"value": self.value}
+
+
+class Histogram:
+    """Cumulative-bucket histogram with approximate quantiles."""
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: Sequence[float] = DEFAULT_BUCKETS,
+                 labels: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.description = description
+        self.labels = dict(labels or {})
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1) # Last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+        _register(self)
+
+    def observe(self, value: float):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    return
+            self.counts[-1] += 1
+
+    @contextmanager
+    def time(self):
+        """Observes the duration of the with-block, including when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def quantile(self, q: float) -> float:
+        """Estimates the q-quantile by linear interpolation inside the matching bucket."""
+        with self._lock:
+            if self.count == 0:
+                return 0.0
+            rank = q * self.count
+            seen = 0
+            lower = 0.0
+            for i, bound in enumerate(self.buckets):
+                in_bucket = self.counts[i]
+                if seen + in_bucket >= rank and in_bucket:
+                    return lower + (bound - lower) * (rank - seen) / in_bucket
+                seen += in_bucket
+                lower = bound
+            return self.buckets[-1] if self.buckets else 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "avg": round(self.sum / self.count, 6) if self.count else 0.0,
+            "p50": round(self.quantile(0.50), 6),
+            "p95": round(self.quantile(0.95), 6),
+            "p99": round(self.quantile(0.99), 6),
+        }
+
+
+def snapshot() -> dict:
+    """Returns a JSON-friendly view of every registered metric."""
+    return {name: metric.snapshot() for name, metric in sorted(REGISTRY.items())}
+
+
+def _sample(name: str, labels: Dict[str, str], value: float) -> str:
+    label_text = _label_text(labels)
+    return f"{name}{{{label_text}}} {value!r}" if label_text else f"{name} {value!r}"
+
+
+def render_prometheus() -> str:
+    """Renders every registered metric in the Prometheus text exposition format (version 0.0.4)."""
+    families: Dict[str, list] = {}
+    for key in sorted(REGISTRY):
+        metric = REGISTRY[key]
+        families.setdefault(metric.name, []).append(metric)
+
+    lines = []
+    for name, members in families.items():
+        help_text = members[0].description.replace("\\", "\\\\").replace("\n", "\\n")
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {members[0].kind}")
+        for metric in members:
+            if metric.kind != "histogram":
+                lines.append(_sample(name, metric.labels, float(metric.value)))
+                continue
+            with metric._lock:
+                counts, total, count = list(metric.counts), metric.sum, metric.count
+            cumulative = 0
+            for bound, in_bucket in zip(metric.buckets + (float("inf"),), counts):
+                cumulative += in_bucket
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(_sample(f"{name}_bucket", {**metric.labels, "le": le}, float(cumulative)))
+            lines.append(_sample(f"{name}_sum", metric.labels, float(total)))
+            lines.append(_sample(f"{name}_count", metric.labels, float(count)))
+    return "\n".join(lines) + "\n"
+
+# --- End of metrics.py ---
@@ -0,0 +1,151 @@
+# model_loader.py
+import os
+import time
+import asyncio
+import logging
+from functools import partial
+from typing import Any, Dict, List, Optional
+
+from chatbot_logic import (
+    load_llm,
+    build_emotion_prompt,
+    parse_emotion_response,
+    build_followup_prompt,
+    get_significant_emotions,
+    EMOTION_PROFILE,
+    FOLLOWUP_PROFILE,
+)
+from generation import GenerationProfile, generate_with_profile
+from prefix_cache import PrefixCache, generate_with_prefix_cache
+from structured_decoding import score_emotions_structured
+from model_registry import ModelSpec, MAIN_MODEL
+from metrics import Counter, Gauge
+
+# === CONFIGURATION ===
+# Run a few representative prompts on every model handle before reporting ready,
+# so the first real users don't pay for page faults and cold caches.
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "false").lower() in ("1", "true", "yes")
+# How long a chat request arriving during startup waits for the model before getting a degraded reply
+MODEL_READY_WAIT_MS = max(0.0, float(os.getenv("MODEL_READY_WAIT_MS", 0)))
+
+PHASES = ("pending", "loading", "warming_up", "ready", "failed")
+WARMUP_MESSAGES = (
+    "I've been really stressed about work and I can't switch off at night.",
+    "Honestly I feel a bit lonely since my friends moved away.",
+    "I'm excited but also nervous about starting my new course next week.",
+)
+
+# === Metrics ===
+MODELS_LOADED = Gauge("model_handles_loaded", "Model handles loaded so far during startup.")
+MODEL_READY = Gauge("model_ready", "1 once the models are loaded (and warmed up) and chat requests are served.")
+LOAD_SECONDS = Gauge("model_load_seconds", "Time from startup until the models were ready.")
+DEGRADED_REPLIES = Counter("chat_degraded_replies_total", "Chat requests answered without the model because it was still loading.")
+
+
+class ModelLoader:
+    """
+    Loads the model handles in a background thread so the API can answer health checks right away.
+    Progress moves through PHASES and is reported by `status()` for the readiness probe; requests
+    that need the model call `wait_ready()` to queue for it up to a deadline.
+    """
+
+    def __init__(self, specs: List[ModelSpec]):
+        self.specs = list(specs)
+        self.count = sum(spec.workers for spec in self.specs)
+        self.phase = "pending"
+        self.loaded = 0
+        self.error: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.ready_at: Optional[float] = None
+        self._ready: Optional[asyncio.Event] = None # Created on the event loop in load_models
+
+    @property
+    def ready(self) -> bool:
+        return self.phase == "ready"
+
+    async def load_models(self) -> Dict[str, List[Any]]:
+        """
+        Loads every spec's handles one after another off the event loop; progress is visible while it runs.
+        main falls back to MockLLM like before; another model that fails to load is left out, so its
+        routes go to main.
+        """
+        self._ready = asyncio.Event()
+        self.phase = "loading"
+        self.started_at = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        models: Dict[str, List[Any]] = {}
+        for spec in self.specs:
+            load = partial(load_llm, spec.path, spec.model_type, fallback=spec.name == MAIN_MODEL)
+            for _ in range(spec.workers):
+                handle = await loop.run_in_executor(None, load)
+                if handle is None:
+                    logging.warning(f"Model '{spec.name}' is unavailable; its routes will use {MAIN_MODEL}.")
+                    break
+                models.setdefault(spec.name, []).append(handle)
+                self.loaded += 1
+                MODELS_LOADED.set(self.loaded)
+                logging.info(f"Loaded model handle {self.loaded}/{self.count} ({spec.name}).")
+        return models
+
+    def warming_up(self):
+        self.phase = "warming_up"
+
+    def mark_ready(self):
+        self.phase = "ready"
+        self.ready_at = time.perf_counter()
+        MODEL_READY.set(1)
+        LOAD_SECONDS.set(self.ready_at - self.started_at)
+        logging.info(f"Model ready after {self.ready_at - self.started_at:.1f}s.")
+        self._ready.set()
+
+    def mark_failed(self, error: BaseException):
+        self.phase = "failed"
+        self.error = f"{type(error).__name__}: {error}"
+        logging.error(f"Model loading failed: {self.error}")
+        if self._ready:
+            self._ready.set() # Release waiting requests; they get degraded replies
+
+    async def wait_ready(self, timeout: float = MODEL_READY_WAIT_MS / 1000.0) -> bool:
+        """True once the model is ready; waits up to `timeout` seconds for it first."""
+        if self.ready or self._ready is None or timeout <= 0 or self.phase == "failed":
+            return self.ready
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.ready
+
+    def status(self) -> dict:
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = round((self.ready_at or time.perf_counter()) - self.started_at, 3)
+        return {
+            "status": self.phase,
+            "models_loaded": self.loaded,
+            "models_total": self.count,
+            "seconds": elapsed,
+            "warmup": MODEL_WARMUP,
+            "error": self.error,
+        }
+
+
+# --- Executor Job ---
+
+def warm_up_job(text: str, llm: Any, cache: Optional[PrefixCache] = None, structured: bool = False) -> list:
+    """
+    Runs one emotion and one follow-up prompt on llm through the same code paths as a real chat turn
+    and returns the emotions found. Submitting one job per worker concurrently warms every handle.
+    """
+    def run(prompt: str, profile: GenerationProfile) -> str:
+        if cache:
+            return generate_with_prefix_cache(prompt, cache, profile, llm)
+        return generate_with_profile(prompt, profile, llm)
+
+    scores = score_emotions_structured(text, llm, cache=cache) if structured else None
+    if scores is None:
+        scores = parse_emotion_response(run(build_emotion_prompt(text), EMOTION_PROFILE))
+    emotions = get_significant_emotions(scores)
+    run(build_followup_prompt(emotions, [{"role": "user", "content": text}]), FOLLOWUP_PROFILE)
+    return emotions
+
+# --- End of model_loader.py ---
@@ -0,0 +1,189 @@
+# model_registry.py
+import os
+import random
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from chatbot_logic import MODEL_PATH, EMOTION_PROFILE, FOLLOWUP_PROFILE, emotion_table_complete, followup_acceptable
+from generation import GenerationProfile, PROFILES
+from inference import InferenceExecutor, BatchScheduler, supports_batching, INFERENCE_WORKERS
+from metrics import Counter, Histogram
+
+# === CONFIGURATION ===
+# MODEL_PATH is always loaded as "main" with INFERENCE_WORKERS handles. MODELS adds more GGUF models,
+# one handle each, as comma-separated name=model_type:path entries,
+# e.g. MODELS="draft=llama:/models/tinyllama-1.1b-chat.Q4_K_M.gguf"
+MODELS = os.getenv("MODELS", "")
+# Which model serves each generation profile, e.g. MODEL_ROUTES="followup=draft". Unlisted profiles use main.
+MODEL_ROUTES = os.getenv("MODEL_ROUTES", "")
+# "cascade": a reply from a routed (smaller) model that fails its profile's acceptance check is
+# regenerated on main. "off" serves routed replies as they are.
+DRAFT_MODE = os.getenv("DRAFT_MODE", "off").lower()
+# Fraction of routed replies that are also generated on main in the background to measure agreement
+QUALITY_SAMPLE_RATE = min(1.0, max(0.0, float(os.getenv("QUALITY_SAMPLE_RATE", 0))))
+
+MAIN_MODEL = "main"
+AGREEMENT_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+# Acceptance checks on raw replies, per profile; profiles without one are always accepted
+ACCEPTANCE: Dict[str, Callable[[str], bool]] = {
+    EMOTION_PROFILE.name: lambda reply: emotion_table_complete(reply) is not None,
+    FOLLOWUP_PROFILE.name: followup_acceptable,
+}
+
+
+class ModelSpec:
+    """One configured model: a name to route to, its GGUF file and ctransformers model type."""
+
+    def __init__(self, name: str, path: str, model_type: str = "mistral", workers: int = 1):
+        self.name = name
+        self.path = path
+        self.model_type = model_type
+        self.workers = workers
+
+
+def model_specs(spec: str = MODELS) -> List[ModelSpec]:
+    """main (MODEL_PATH) first, then the MODELS entries."""
+    specs = [ModelSpec(MAIN_MODEL, MODEL_PATH, workers=INFERENCE_WORKERS)]
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        try:
+            name, target = (part.strip() for part in item.split("=", 1))
+            model_type, path = (part.strip() for part in target.split(":", 1))
+        except ValueError:
+            logging.warning(f"Ignoring malformed MODELS entry: '{item}'")
+            continue
+        if name in (s.name for s in specs):
+            logging.warning(f"Ignoring duplicate MODELS entry for '{name}'.")
+            continue
+        specs.append(ModelSpec(name, path, model_type))
+    return specs
+
+
+def parse_routes(spec: str = MODEL_ROUTES) -> Dict[str, str]:
+    routes = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        try:
+            profile, model = item.split("=")
+            routes[profile.strip()] = model.strip()
+        except ValueError:
+            logging.warning(f"Ignoring malformed MODEL_ROUTES entry: '{item}'")
+    return routes
+
+
+def word_agreement(a: str, b: str) -> float:
+    """Jaccard similarity of the two replies' lowercase word sets, 1.0 for identical wording."""
+    words_a, words_b = set(a.lower().split()), set(b.lower().split())
+    if not words_a and not words_b:
+        return 1.0
+    return len(words_a & words_b) / len(words_a | words_b)
+
+
+# === Model Pools ===
+
+class ModelPool:
+    """One named model: its handles behind an executor and batch scheduler, plus per-model call stats."""
+
+    def __init__(self, spec: ModelSpec, models: List[Any]):
+        self.spec = spec
+        self.name = spec.name
+        self.models = list(models)
+        self.executor = InferenceExecutor(self.models)
+        self.batcher = BatchScheduler(self.executor, can_batch=all(supports_batching(m) for m in self.models))
+        labels = {"model": self.name}
+        self.latency = {name: Histogram("model_call_seconds", "Time per model call, by model and generation profile.",
+                                        labels={**labels, "profile": name})
+                        for name in PROFILES}
+        self.rejected = Counter("model_cascade_rejects_total", "Routed replies that failed acceptance and were regenerated on main.", labels=labels)
+        self.agreement = Histogram("model_quality_agreement", "Word overlap between a routed reply and main's reply to the same prompt.",
+                                   buckets=AGREEMENT_BUCKETS, labels=labels)
+
+    async def timed(self, profile: GenerationProfile, call: Callable[["ModelPool"], Awaitable[str]]) -> str:
+        with self.latency[profile.name].time():
+            return await call(self)
+
+    def stats(self, routes: List[str]) -> dict:
+        return {
+            "path": self.spec.path,
+            "workers": self.executor.workers,
+            "profiles": routes,
+            "batching": self.batcher.can_batch,
+            "call_seconds": {name: histogram.snapshot() for name, histogram in self.latency.items() if histogram.count},
+            "cascade_rejects": self.rejected.value,
+            "quality_samples": self.agreement.count,
+            "quality_agreement": self.agreement.snapshot(),
+        }
+
+
+class ModelRouter:
+    """
+    Sends each generation profile to the model configured in MODEL_ROUTES, defaulting to main.
+
+    ctransformers only exposes the logits of the last evaluated token, so a small model's tokens can't
+    be verified by the big one in a single forward pass as in speculative decoding. DRAFT_MODE=cascade
+    applies the same idea per reply instead: the routed model drafts it, a cheap acceptance check
+    verifies it, and only rejected drafts cost a main-model generation.
+    """
+
+    def __init__(self, pools: Dict[str, ModelPool], routes: Optional[Dict[str, str]] = None,
+                 draft_mode: str = DRAFT_MODE, sample_rate: float = QUALITY_SAMPLE_RATE):
+        self.pools = pools
+        self.main = pools[MAIN_MODEL]
+        self.draft_mode = draft_mode
+        self.sample_rate = sample_rate
+        self.routes: Dict[str, str] = {}
+        for profile, model in (parse_routes() if routes is None else routes).items():
+            if profile not in PROFILES:
+                logging.warning(f"MODEL_ROUTES names unknown generation profile '{profile}'; ignoring it.")
+            elif model not in pools:
+                logging.warning(f"Model '{model}' for profile '{profile}' isn't loaded; using {MAIN_MODEL}.")
+            else:
+                self.routes[profile] = model
+        self._samples: set = set()
+
+    def pool_for(self, profile: GenerationProfile) -> ModelPool:
+        return self.pools[self.routes.get(profile.name, MAIN_MODEL)]
+
+    async def generate(self, profile: GenerationProfile, call: Callable[[ModelPool], Awaitable[str]]) -> str:
+        """
+        Runs `call(pool)` (one model call returning the raw reply) on the profile's model.
+        Routed replies are checked under DRAFT_MODE=cascade and sampled against main for quality stats.
+        """
+        pool = self.pool_for(profile)
+        reply = await pool.timed(profile, call)
+        if pool is self.main:
+            return reply
+        accept = ACCEPTANCE.get(profile.name)
+        if self.draft_mode == "cascade" and accept and not accept(reply):
+            pool.rejected.inc()
+            return await self.main.timed(profile, call)
+        if self.sample_rate and random.random() < self.sample_rate:
+            task = asyncio.ensure_future(self._sample(pool, profile, call, reply))
+            self._samples.add(task)
+            task.add_done_callback(self._samples.discard)
+        return reply
+
+    async def _sample(self, pool: ModelPool, profile: GenerationProfile, call: Callable[[ModelPool], Awaitable[str]],
+                      reply: str):
+        try:
+            reference = await self.main.timed(profile, call)
+        except Exception as e: # Busy main model or failed call; the sample is just skipped
+            logging.debug(f"Quality sample for '{pool.name}' skipped: {e}")
+            return
+        pool.agreement.observe(word_agreement(reply, reference))
+
+    def stats(self) -> dict:
+        return {
+            "draft_mode": self.draft_mode,
+            "quality_sample_rate": self.sample_rate,
+            "models": {
+                name: pool.stats(sorted(profile for profile in PROFILES if self.pool_for(PROFILES[profile]) is pool))
+                for name, pool in self.pools.items()
+            },
+        }
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.executor.shutdown()
+
+# --- End of model_registry.py ---
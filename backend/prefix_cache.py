@@ -0,0 +1,158 @@
+# prefix_cache.py
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Sequence
+
+from metrics import Counter, Gauge
+from generation import GenerationProfile, generate_with_profile, stream_with_profile
+
+# === CONFIGURATION ===
+PREFIX_CACHE_MAX_BYTES = int(os.getenv("PREFIX_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+
+# === Metrics ===
+PREFIX_HITS = Counter("prefix_cache_hits_total", "Follow-up prompts that reused the conversation's evaluated history.")
+PREAMBLE_HITS = Counter("prefix_cache_preamble_hits_total", "Follow-up prompts that reused only the tone preamble.")
+PREFIX_MISSES = Counter("prefix_cache_misses_total", "Follow-up prompts evaluated from scratch.")
+TOKENS_REUSED = Counter("prefix_cache_tokens_reused_total", "Prompt tokens skipped because they were already evaluated.")
+TOKENS_EVALUATED = Counter("prefix_cache_tokens_evaluated_total", "Prompt tokens the model had to evaluate.")
+EVICTIONS = Counter("prefix_cache_evictions_total", "Conversation entries evicted to stay under the memory bound.")
+CACHE_BYTES = Gauge("prefix_cache_bytes", "Approximate memory held by cached conversation prefixes.")
+
+
+def common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+# === Prefix Cache ===
+
+class PrefixCache:
+    """
+    Tracks which prompt prefix is resident in each model's context.
+
+    ctransformers keeps the KV state of the previous call and only evaluates the tokens after the
+    longest common prefix with the new prompt. Follow-up prompts are laid out preamble-first and
+    history in order, so a conversation's next prompt extends its last one. This cache records the
+    tokens each model last evaluated and, per conversation, the last prompt sent (LRU, bounded by
+    PREFIX_CACHE_MAX_BYTES). The executor's affinity routing sends a conversation back to the model
+    that still holds its prefix; the tone preamble is shared by every conversation with that tone.
+    """
+
+    def __init__(self, max_bytes: int = PREFIX_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, array]" = OrderedDict() # conversation_id -> last prompt tokens
+        self._resident: Dict[int, array] = {} # id(model) -> tokens currently in its context
+        self._preamble_tokens: Dict[str, int] = {} # preamble text -> token count
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def supported(llm: Any) -> bool:
+        return callable(getattr(llm, "tokenize", None))
+
+    def _store(self, conversation_id: str, tokens: array):
+        old = self._entries.pop(conversation_id, None)
+        if old is not None:
+            self._bytes -= old.itemsize * len(old)
+        self._entries[conversation_id] = tokens
+        self._bytes += tokens.itemsize * len(tokens)
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.itemsize * len(evicted)
+            EVICTIONS.inc()
+        CACHE_BYTES.set(self._bytes)
+
+    def record_prompt(self, llm: Any, tokens: Sequence[int], conversation_id: Optional[str] = None,
+                      preamble: Optional[str] = None) -> int:
+        """
+        Accounts for a prompt about to run on llm and returns how many of its tokens are reused.
+        Hit/miss counters only cover conversation prompts (follow-up questions).
+        """
+        with self._lock:
+            reused = common_prefix_length(self._resident.get(id(llm), ()), tokens)
+            reused = min(reused, max(0, len(tokens) - 1)) # The last token is always evaluated for logits
+            if conversation_id is None:
+                return reused
+
+            if preamble not in self._preamble_tokens:
+                self._preamble_tokens[preamble] = len(llm.tokenize(preamble))
+            preamble_len = self._preamble_tokens[preamble]
+            previous = self._entries.get(conversation_id)
+            if previous is not None and reused > preamble_len:
+                PREFIX_HITS.inc()
+            elif reused >= preamble_len:
+                PREAMBLE_HITS.inc()
+            else:
+                PREFIX_MISSES.inc()
+            TOKENS_REUSED.inc(reused)
+            TOKENS_EVALUATED.inc(len(tokens) - reused)
+
+            self._store(conversation_id, array("i", tokens))
+            return reused
+
+    def record_resident(self, llm: Any, tokens: Sequence[int]):
+        """Records what llm's context holds after a call (prompt plus generated tokens)."""
+        with self._lock:
+            self._resident[id(llm)] = array("i", tokens)
+
+    def discard(self, conversation_id: str):
+        with self._lock:
+            old = self._entries.pop(conversation_id, None)
+            if old is not None:
+                self._bytes -= old.itemsize * len(old)
+                CACHE_BYTES.set(self._bytes)
+
+    def stats(self) -> dict:
+        lookups = PREFIX_HITS.value + PREAMBLE_HITS.value + PREFIX_MISSES.value
+        return {
+            "conversations": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": PREFIX_HITS.value,
+            "preamble_hits": PREAMBLE_HITS.value,
+            "misses": PREFIX_MISSES.value,
+            "hit_rate": round((PREFIX_HITS.value + PREAMBLE_HITS.value) / lookups, 4) if lookups else 0.0,
+            "tokens_reused": TOKENS_REUSED.value,
+            "tokens_evaluated": TOKENS_EVALUATED.value,
+            "evictions": EVICTIONS.value,
+        }
+
+
+# --- Executor Jobs ---
+# Every call on a model changes its context, so all prompts on a cache-enabled model go through these.
+
+def generate_with_prefix_cache(prompt: str, cache: PrefixCache, profile: GenerationProfile, llm: Any,
+                               conversation_id: Optional[str] = None, preamble: Optional[str] = None) -> str:
+    """Runs prompt on llm and keeps the prefix cache's view of its context up to date."""
+    tokens = llm.tokenize(prompt)
+    cache.record_prompt(llm, tokens, conversation_id, preamble)
+    try:
+        response = generate_with_profile(prompt, profile, llm)
+    except Exception:
+        cache.record_resident(llm, ()) # Context state is unknown after a failure
+        raise
+    cache.record_resident(llm, list(tokens) + list(llm.tokenize(response)))
+    return response
+
+def stream_with_prefix_cache(prompt: str, cache: PrefixCache, profile: GenerationProfile, llm: Any,
+                             conversation_id: Optional[str] = None, preamble: Optional[str] = None):
+    """Streaming counterpart of generate_with_prefix_cache, for InferenceExecutor.stream."""
+    tokens = llm.tokenize(prompt)
+    cache.record_prompt(llm, tokens, conversation_id, preamble)
+    pieces = []
+    completed = False
+    try:
+        for piece in stream_with_profile(prompt, profile, llm):
+            pieces.append(piece)
+            yield piece
+        completed = True
+    finally:
+        # A stream cut short leaves an unknown number of generated tokens in the context
+        cache.record_resident(llm, list(tokens) + list(llm.tokenize("".join(pieces))) if completed else ())
+
+# --- End of prefix_cache.py ---
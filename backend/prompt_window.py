@@ -0,0 +1,105 @@
+# prompt_window.py
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, List, Tuple
+
+from metrics import Counter, Histogram
+
+# === CONFIGURATION ===
+# Token budget for a whole follow-up prompt. The preamble, summary and instructions always fit;
+# history entries are added newest first until the budget is used up.
+FOLLOWUP_PROMPT_TOKENS = max(64, int(os.getenv("FOLLOWUP_PROMPT_TOKENS", 512)))
+# Fold history entries that no longer fit the prompt into a rolling summary, in the background
+HISTORY_SUMMARY = os.getenv("HISTORY_SUMMARY", "true").lower() in ("1", "true", "yes")
+CHARS_PER_TOKEN = 4 # Estimate for models without a tokenizer (MockLLM)
+TOKEN_COUNT_CACHE_ENTRIES = 8192
+
+PROMPT_TOKEN_BUCKETS = (64, 128, 192, 256, 384, 512, 768, 1024, 2048)
+
+# === Metrics ===
+PROMPT_TOKENS = Histogram("followup_prompt_tokens", "Tokens in each follow-up prompt after windowing.", buckets=PROMPT_TOKEN_BUCKETS)
+WINDOW_ENTRIES = Histogram("followup_history_entries", "History entries that fit in a follow-up prompt.",
+                           buckets=(0, 1, 2, 3, 4, 6, 8, 12))
+ENTRIES_LEFT_OUT = Counter("followup_history_left_out_total", "History entries left out of a follow-up prompt for lack of budget.")
+ENTRIES_TRIMMED = Counter("followup_history_trimmed_total", "Newest messages cut down because they alone exceeded the budget.")
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class TokenCounter:
+    """
+    Counts tokens with the model's tokenizer, or estimates them when it has none. Counts are cached
+    per text (LRU), since every turn re-counts the same history entries and preamble. Tokenizing only
+    reads the model's vocabulary, so this can run on the event loop while the handle generates.
+    """
+
+    def __init__(self, llm: Any = None, max_entries: int = TOKEN_COUNT_CACHE_ENTRIES):
+        tokenize = getattr(llm, "tokenize", None)
+        self.exact = callable(tokenize)
+        self._count: Callable[[str], int] = (lambda text: len(tokenize(text))) if self.exact else estimate_tokens
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, text: str) -> int:
+        with self._lock:
+            count = self._cache.get(text)
+            if count is not None:
+                self._cache.move_to_end(text)
+                return count
+        count = self._count(text)
+        with self._lock:
+            self._cache[text] = count
+            if len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return count
+
+
+def trim_to_tokens(text: str, tokens: int, budget: int) -> str:
+    """Keeps the end of text, cut by the character share of the budget (approximate, no detokenizing)."""
+    keep = max(1, len(text) * max(0, budget) // max(1, tokens))
+    return "…" + text[-keep:].lstrip()
+
+
+def window_history(entries: List[dict], budget: int,
+                   count: Callable[[str], int] = estimate_tokens) -> Tuple[List[str], int, bool]:
+    """
+    Fits the newest history entries, as "role: content" lines in order, into `budget` tokens.
+    Returns the lines, how many of the oldest entries were left out and whether the newest was cut:
+    it is always kept, and if it alone is over budget only the last part that fits is.
+    """
+    lines: List[str] = []
+    used = 0
+    left_out = 0
+    trimmed = False
+    for position in range(len(entries) - 1, -1, -1):
+        entry = entries[position]
+        line = f"{entry['role']}: {entry['content']}"
+        cost = count(line) + 1 # The newline joining it to the next line
+        if used + cost > budget:
+            if not lines:
+                prefix = f"{entry['role']}: "
+                lines.append(prefix + trim_to_tokens(entry["content"], cost, budget - count(prefix) - 1))
+                trimmed = True
+                position -= 1
+            left_out = position + 1
+            break
+        lines.append(line)
+        used += cost
+    lines.reverse()
+    return lines, left_out, trimmed
+
+
+def record_window(prompt_tokens: int, lines: List[str], left_out: int, trimmed: bool):
+    """Metrics for a follow-up prompt that was actually built (not for window checks)."""
+    PROMPT_TOKENS.observe(prompt_tokens)
+    WINDOW_ENTRIES.observe(len(lines))
+    if left_out:
+        ENTRIES_LEFT_OUT.inc(left_out)
+    if trimmed:
+        ENTRIES_TRIMMED.inc()
+
+# --- End of prompt_window.py ---
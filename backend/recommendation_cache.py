@@ -0,0 +1,164 @@
+# recommendation_cache.py
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from chatbot_logic import EMOTION_LIST, RECOMMENDATIONS_PER_CATEGORY, recommendation_key, fetch_all_providers, build_recommendations
+from metrics import Counter, Histogram
+from recommendation_catalog import RECOMMENDATION_CATALOG_RETRY, retry_delay
+
+# === CONFIGURATION ===
+# Entries older than the TTL are refreshed in the background; requests keep getting the
+# previous value until the refresh lands, so nothing expires on the request path.
+RECOMMENDATION_CACHE_TTL = float(os.getenv("RECOMMENDATION_CACHE_TTL", 6 * 3600))
+RECOMMENDATION_REFRESH_INTERVAL = float(os.getenv("RECOMMENDATION_REFRESH_INTERVAL", 60))
+RECOMMENDATION_PREWARM = os.getenv("RECOMMENDATION_PREWARM", "false").lower() in ("1", "true", "yes")
+
+# === Metrics ===
+CACHE_HITS = Counter("recommendation_cache_hits_total", "Recommendation requests served from cache.")
+CACHE_MISSES = Counter("recommendation_cache_misses_total", "Recommendation requests that had to fetch live.")
+REFRESHES = Counter("recommendation_cache_refreshes_total", "Background refreshes of cached recommendations.")
+PROVIDER_FAILURES = Counter("recommendation_provider_failures_total", "Provider calls that errored or missed the deadline.")
+FETCH_TIME = Histogram("recommendation_fetch_seconds", "Wall time of one concurrent fetch across all providers.")
+
+
+class RecommendationCache:
+    """
+    TTL cache in front of the recommendation providers, keyed by (primary emotion, Spotify keyword).
+    Fetches for the same key are deduplicated, partial results (a provider failed) are served and
+    refetched after `retry_after` (doubling while the provider keeps failing), and stale entries are
+    refreshed by `refresh_forever`.
+    With a RecommendationCatalog, lookups are served from it first and `refresh_forever` keeps it
+    populated for every emotion; the TTL entries then only cover catalog misses.
+    """
+
+    def __init__(self, sp: Optional[Any], ttl: float = RECOMMENDATION_CACHE_TTL,
+                 refresh_interval: float = RECOMMENDATION_REFRESH_INTERVAL, catalog: Optional[Any] = None,
+                 retry_after: float = RECOMMENDATION_CATALOG_RETRY):
+        self.sp = sp
+        self.catalog = catalog
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.retry_after = catalog.retry_after if catalog else retry_after
+        self._entries: Dict[Tuple[str, str], Tuple[dict, float, bool]] = {} # key -> (recommendations, fetched_at, complete)
+        self._attempts: Dict[Tuple[str, str], Tuple[float, int]] = {} # key -> (last fetch, consecutive fetches with a failed provider)
+        self._in_flight: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._refresher: Optional[asyncio.Task] = None
+
+    async def get(self, significant_emotions: list) -> dict:
+        key = recommendation_key(significant_emotions)
+        if self.catalog:
+            served = self.catalog.lookup(*key)
+            if served:
+                return served
+        entry = self._entries.get(key)
+        if entry:
+            CACHE_HITS.inc()
+            return dict(entry[0])
+        CACHE_MISSES.inc()
+        # Shielded so a caller going away doesn't cancel a fetch others are waiting on
+        return dict(await asyncio.shield(self._fetch(key)))
+
+    def _fetch(self, key: Tuple[str, str]) -> "asyncio.Task":
+        # Share one in-flight fetch between concurrent callers for the same key
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._do_fetch(key))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return task
+
+    async def _do_fetch(self, key: Tuple[str, str]) -> dict:
+        primary_emotion, spotify_keyword = key
+        started = time.perf_counter()
+        limit = self.catalog.items_per_category if self.catalog else RECOMMENDATIONS_PER_CATEGORY
+        results, failed = await asyncio.to_thread(fetch_all_providers, primary_emotion, spotify_keyword, self.sp, limit=limit)
+        FETCH_TIME.observe(time.perf_counter() - started)
+        self._attempts[key] = (time.time(), self._attempts.get(key, (0.0, 0))[1] + 1 if failed else 0)
+        if failed:
+            PROVIDER_FAILURES.inc(len(failed))
+            logging.warning(f"Recommendation providers failed for '{primary_emotion}': {', '.join(failed)}")
+        if self.catalog:
+            await asyncio.to_thread(self.catalog.store, primary_emotion, spotify_keyword, results, failed)
+        recommendations = build_recommendations(primary_emotion, spotify_keyword, results)
+        previous = self._entries.get(key)
+        if failed and previous and previous[2]:
+            # Keep serving the last complete result rather than replacing it with fallbacks
+            return previous[0]
+        self._entries[key] = (recommendations, time.time(), not failed)
+        return recommendations
+
+    def _needs_refresh(self, key: Tuple[str, str], entry: Tuple[dict, float, bool]) -> bool:
+        _, fetched_at, complete = entry
+        if complete:
+            return time.time() - fetched_at >= self.ttl
+        attempted_at, failures = self._attempts.get(key, (0.0, 1))
+        return time.time() - attempted_at >= retry_delay(max(1, failures), self.retry_after, self.ttl)
+
+    async def refresh_catalog(self):
+        """Catalog population job: fetches every emotion the catalog is missing or holds stale items for."""
+        await asyncio.to_thread(self.catalog.load) # Picks up rows other workers wrote since the last pass
+        for emotion in EMOTION_LIST:
+            key = recommendation_key([emotion])
+            if self.catalog.stale(*key):
+                REFRESHES.inc()
+                await self._safe_fetch(key)
+
+    async def refresh_forever(self):
+        """
+        Background loop: keeps the catalog populated (when there is one) and refreshes stale or partial
+        entries, optionally prewarming every emotion first.
+        """
+        if self.catalog:
+            await self._safe_refresh_catalog()
+        elif RECOMMENDATION_PREWARM:
+            for emotion in EMOTION_LIST:
+                key = recommendation_key([emotion])
+                if key not in self._entries:
+                    await self._safe_fetch(key)
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            if self.catalog:
+                await self._safe_refresh_catalog()
+            for key, entry in list(self._entries.items()):
+                if self._needs_refresh(key, entry):
+                    REFRESHES.inc()
+                    await self._safe_fetch(key)
+
+    async def _safe_fetch(self, key: Tuple[str, str]):
+        try:
+            await self._fetch(key)
+        except Exception as e:
+            logging.error(f"Background recommendation refresh failed for {key}: {e}")
+
+    async def _safe_refresh_catalog(self):
+        try:
+            await self.refresh_catalog()
+        except Exception as e:
+            logging.error(f"Recommendation catalog refresh failed: {e}")
+
+    def start(self):
+        if self._refresher is None:
+            self._refresher = asyncio.ensure_future(self.refresh_forever())
+
+    def stop(self):
+        if self._refresher:
+            self._refresher.cancel()
+            self._refresher = None
+
+    def stats(self) -> dict:
+        lookups = CACHE_HITS.value + CACHE_MISSES.value
+        return {
+            "entries": len(self._entries),
+            "hits": CACHE_HITS.value,
+            "misses": CACHE_MISSES.value,
+            "hit_rate": round(CACHE_HITS.value / lookups, 4) if lookups else 0.0,
+            "refreshes": REFRESHES.value,
+            "provider_failures": PROVIDER_FAILURES.value,
+            "fetch_seconds": FETCH_TIME.snapshot(),
+            "catalog": self.catalog.stats() if self.catalog else None,
+        }
+
+# --- End of recommendation_cache.py ---
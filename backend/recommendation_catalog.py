@@ -0,0 +1,170 @@
+# recommendation_catalog.py
+import os
+import time
+import sqlite3
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from chatbot_logic import PROVIDER_EMPTY, RECOMMENDATIONS_PER_CATEGORY, build_recommendations, is_placeholder
+from metrics import Counter, Gauge
+
+# === CONFIGURATION ===
+# SQLite file holding fetched recommendations; empty disables the catalog (live fetches + TTL cache only)
+RECOMMENDATION_CATALOG_PATH = os.getenv("RECOMMENDATION_CATALOG_PATH", "recommendation_catalog.db")
+# Items fetched per provider and emotion; replies rotate through them two at a time
+RECOMMENDATION_CATALOG_ITEMS = max(1, int(os.getenv("RECOMMENDATION_CATALOG_ITEMS", 20)))
+# Age after which an emotion's items are fetched again in the background
+RECOMMENDATION_CATALOG_MAX_AGE = float(os.getenv("RECOMMENDATION_CATALOG_MAX_AGE", 24 * 3600))
+# Wait before retrying an emotion whose providers failed, so a missing API key doesn't cause a fetch every pass.
+# Doubles with each further failed attempt, up to RECOMMENDATION_CATALOG_MAX_AGE.
+RECOMMENDATION_CATALOG_RETRY = float(os.getenv("RECOMMENDATION_CATALOG_RETRY", 15 * 60))
+
+# === Metrics ===
+CATALOG_HITS = Counter("recommendation_catalog_hits_total", "Recommendations served from the local catalog.")
+CATALOG_MISSES = Counter("recommendation_catalog_misses_total", "Recommendation lookups the catalog had nothing for.")
+CATALOG_ITEMS = Gauge("recommendation_catalog_items", "Items held in the local recommendation catalog.")
+
+
+def retry_delay(failures: int, retry_after: float = RECOMMENDATION_CATALOG_RETRY,
+                max_delay: float = RECOMMENDATION_CATALOG_MAX_AGE) -> float:
+    """Seconds to wait before fetching again after `failures` consecutive failed attempts (at least one wait)."""
+    return min(max(retry_after, max_delay), retry_after * 2 ** max(0, failures - 1))
+
+
+def _category_keys(primary_emotion: str, spotify_keyword: str) -> Tuple[Tuple[str, str], ...]:
+    # Movies and books are searched by primary emotion, songs by Spotify keyword (see recommendation_key)
+    return ("movies", primary_emotion), ("books", primary_emotion), ("songs", spotify_keyword)
+
+
+class RecommendationCatalog:
+    """
+    On-disk store of provider results, indexed by (category, emotion), with an in-memory copy for lookups.
+
+    Lookups never touch the disk or the network: they rotate through the cached items so consecutive
+    users with the same emotion get different suggestions. Rows are written by the background population
+    job in RecommendationCache and by live fetches on a miss; several workers can share the file.
+    """
+
+    def __init__(self, path: str = RECOMMENDATION_CATALOG_PATH, items_per_category: int = RECOMMENDATION_CATALOG_ITEMS,
+                 max_age: float = RECOMMENDATION_CATALOG_MAX_AGE, retry_after: float = RECOMMENDATION_CATALOG_RETRY):
+        self.path = path
+        self.items_per_category = items_per_category
+        self.max_age = max_age
+        self.retry_after = retry_after
+        self._items: Dict[Tuple[str, str], List[str]] = {}
+        self._fetched_at: Dict[Tuple[str, str], float] = {}
+        self._attempted_at: Dict[Tuple[str, str], float] = {} # (primary emotion, keyword) -> last fetch, failed or not
+        self._failures: Dict[Tuple[str, str], int] = {} # (primary emotion, keyword) -> consecutive fetches with a failed provider
+        self._placeholders: Dict[Tuple[str, str], List[str]] = {} # (category, key) -> what its provider last returned instead of items
+        self._cursor: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS catalog (category TEXT NOT NULL, emotion TEXT NOT NULL, position INTEGER NOT NULL, "
+            "item TEXT NOT NULL, fetched_at REAL NOT NULL, PRIMARY KEY (category, emotion, position)) WITHOUT ROWID"
+        )
+        self._conn.commit()
+        self.load()
+
+    def load(self):
+        """Rebuilds the in-memory index from disk, picking up rows written by other workers."""
+        items: Dict[Tuple[str, str], List[str]] = {}
+        fetched_at: Dict[Tuple[str, str], float] = {}
+        with self._lock:
+            rows = self._conn.execute("SELECT category, emotion, item, fetched_at FROM catalog ORDER BY category, emotion, position").fetchall()
+        for category, emotion, item, fetched in rows:
+            items.setdefault((category, emotion), []).append(item)
+            fetched_at[(category, emotion)] = fetched
+        self._items, self._fetched_at = items, fetched_at
+        CATALOG_ITEMS.set(len(rows))
+
+    def _rotate(self, key: Tuple[str, str], items: List[str], count: int) -> List[str]:
+        # Unlocked on purpose: a lost cursor update under contention just repeats a suggestion
+        start = self._cursor.get(key, 0)
+        self._cursor[key] = (start + count) % len(items)
+        return [items[(start + i) % len(items)] for i in range(min(count, len(items)))]
+
+    def lookup(self, primary_emotion: str, spotify_keyword: str, count: int = RECOMMENDATIONS_PER_CATEGORY) -> Optional[dict]:
+        """
+        The next `count` items of each category, or None if the catalog doesn't have them all for this emotion.
+        Songs are shared between emotions with the same keyword, so they alone don't make a hit. Once this
+        emotion has been fetched, a category still without items gets what its provider last returned:
+        the empty-search reply if it found nothing, its failure reply if it errored.
+        """
+        keys = _category_keys(primary_emotion, spotify_keyword)
+        if not all(key in self._items for key in keys) and (primary_emotion, spotify_keyword) not in self._attempted_at:
+            CATALOG_MISSES.inc()
+            return None
+        results = {}
+        for category, key in keys:
+            items = self._items.get((category, key))
+            results[category] = self._rotate((category, key), items, count) if items else \
+                self._placeholders.get((category, key), PROVIDER_EMPTY[category])
+        CATALOG_HITS.inc()
+        return build_recommendations(primary_emotion, spotify_keyword, results)
+
+    def store(self, primary_emotion: str, spotify_keyword: str, results: dict, failed: List[str]):
+        """Replaces each category's items with a fresh fetch; failed or empty results keep the old items."""
+        now = time.time()
+        self._attempted_at[(primary_emotion, spotify_keyword)] = now
+        self._failures[(primary_emotion, spotify_keyword)] = self._failures.get((primary_emotion, spotify_keyword), 0) + 1 if failed else 0
+        fresh = {}
+        for category, key in _category_keys(primary_emotion, spotify_keyword):
+            if category in failed or is_placeholder(category, results[category]):
+                self._placeholders[(category, key)] = list(results[category])
+            else:
+                fresh[(category, key)] = results[category]
+                self._placeholders.pop((category, key), None)
+        if not fresh:
+            return
+        with self._lock:
+            for (category, key), items in fresh.items():
+                self._conn.execute("DELETE FROM catalog WHERE category = ? AND emotion = ?", (category, key))
+                self._conn.executemany(
+                    "INSERT INTO catalog (category, emotion, position, item, fetched_at) VALUES (?, ?, ?, ?, ?)",
+                    [(category, key, position, item, now) for position, item in enumerate(items)],
+                )
+            self._conn.commit()
+        for key, items in fresh.items():
+            self._items[key] = list(items)
+            self._fetched_at[key] = now
+        CATALOG_ITEMS.set(sum(len(items) for items in self._items.values()))
+
+    def stale(self, primary_emotion: str, spotify_keyword: str) -> bool:
+        """True if a category is missing or older than max_age, and the last attempt is past the retry wait (see retry_delay)."""
+        now = time.time()
+        wait = retry_delay(max(1, self._failures.get((primary_emotion, spotify_keyword), 0)), self.retry_after, self.max_age)
+        if now - self._attempted_at.get((primary_emotion, spotify_keyword), 0.0) < wait:
+            return False
+        return any(now - self._fetched_at.get(key, 0.0) >= self.max_age
+                   for key in _category_keys(primary_emotion, spotify_keyword))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> dict:
+        lookups = CATALOG_HITS.value + CATALOG_MISSES.value
+        return {
+            "path": self.path,
+            "emotions": len({key for _, key in self._items}),
+            "items": sum(len(items) for items in self._items.values()),
+            "hits": CATALOG_HITS.value,
+            "misses": CATALOG_MISSES.value,
+            "hit_rate": round(CATALOG_HITS.value / lookups, 4) if lookups else 0.0,
+        }
+
+
+def create_catalog(path: str = RECOMMENDATION_CATALOG_PATH) -> Optional[RecommendationCatalog]:
+    """The configured catalog, or None when RECOMMENDATION_CATALOG_PATH is empty or unusable."""
+    if not path:
+        return None
+    try:
+        return RecommendationCatalog(path)
+    except sqlite3.Error as e:
+        logging.error(f"Could not open recommendation catalog '{path}': {e}. Using live fetches only.")
+        return None
+
+# --- End of recommendation_catalog.py ---
@@ -0,0 +1,208 @@
+# response_cache.py
+import os
+import re
+import json
+import random
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from metrics import Counter, Gauge
+
+# === CONFIGURATION ===
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 10000)) # 0 disables the cache
+# Estimated Jaccard similarity (0-1) above which a near-duplicate message reuses a cached emotion score.
+# 0 turns the similarity layer off and keeps exact matching only.
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", 0))
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "") # Persist caches here across restarts when set
+
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16 # 16 bands x 4 rows: pairs around 0.5 Jaccard or above almost always share a bucket
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(1234) # Fixed seed so signatures stay comparable after a restart
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME)) for _ in range(MINHASH_PERMUTATIONS)]
+
+SPACES_RE = re.compile(r"\s+")
+
+
+def _word_char(char: str) -> bool:
+    # Letters, combining marks (Devanagari vowel signs, accents) and digits in any script
+    return char == "'" or unicodedata.category(char)[0] in "LMN"
+
+
+def normalize_text(text: str) -> str:
+    """
+    Case-folds, drops punctuation and symbols (emoji included) and collapses whitespace, so trivial
+    variants share a key. Unicode-aware: non-Latin words are kept whole. May return "" (never a key).
+    """
+    folded = unicodedata.normalize("NFKC", text).casefold()
+    return SPACES_RE.sub(" ", "".join(char if _word_char(char) else " " for char in folded)).strip()
+
+
+def minhash_signature(text: str) -> Tuple[int, ...]:
+    """MinHash over character 3-grams of the normalized text."""
+    padded = f" {text} "
+    shingles = {padded[i:i + 3] for i in range(max(1, len(padded) - 2))}
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big") for s in shingles]
+    return tuple(min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _PERMUTATIONS)
+
+
+def estimated_similarity(a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+    return sum(1 for x, y in zip(a, b) if x == y) / len(a)
+
+
+# === Response Cache ===
+
+class ResponseCache:
+    """
+    LRU cache for model outputs. The exact layer is keyed by normalized text (`normalize`; pass str for keys
+    that are already exact). The optional similarity layer uses MinHash signatures with LSH buckets, so a
+    lookup only compares against a handful of candidates. Text that normalizes to "" is never cached.
+    """
+
+    def __init__(self, name: str, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+                 similarity_threshold: float = 0.0, persist_dir: str = RESPONSE_CACHE_DIR,
+                 normalize: Callable[[str], str] = normalize_text):
+        self.name = name
+        self.normalize = normalize
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.path = os.path.join(persist_dir, f"{name}_cache.json") if persist_dir else None
+        self._entries: "OrderedDict[str, Any]" = OrderedDict()
+        self._signatures: Dict[str, Tuple[int, ...]] = {}
+        self._buckets: Dict[Tuple[int, Tuple[int, ...]], Set[str]] = {}
+        self._lock = threading.Lock()
+        self.exact_hits = Counter(f"response_cache_{name}_exact_hits_total", f"{name} lookups answered by an identical normalized key.")
+        self.similar_hits = Counter(f"response_cache_{name}_similar_hits_total", f"{name} lookups answered by a near-duplicate.")
+        self.misses = Counter(f"response_cache_{name}_misses_total", f"{name} lookups that went to the model.")
+        self.evictions = Counter(f"response_cache_{name}_evictions_total", f"{name} entries evicted by the LRU bound.")
+        self.size = Gauge(f"response_cache_{name}_entries", f"Entries held by the {name} cache.")
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _bands(self, signature: Tuple[int, ...]) -> List[Tuple[int, Tuple[int, ...]]]:
+        rows = len(signature) // LSH_BANDS
+        return [(band, signature[band * rows:(band + 1) * rows]) for band in range(LSH_BANDS)]
+
+    def get(self, text: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        key = self.normalize(text)
+        if not key:
+            self.misses.inc()
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.exact_hits.inc()
+                return self._entries[key]
+            if self.similarity_threshold > 0:
+                signature = minhash_signature(key)
+                best_key, best_score = None, self.similarity_threshold
+                candidates = set()
+                for band in self._bands(signature):
+                    candidates |= self._buckets.get(band, set())
+                for candidate in candidates:
+                    score = estimated_similarity(signature, self._signatures[candidate])
+                    if score >= best_score:
+                        best_key, best_score = candidate, score
+                if best_key is not None:
+                    self._entries.move_to_end(best_key)
+                    self.similar_hits.inc()
+                    return self._entries[best_key]
+            self.misses.inc()
+            return None
+
+    def put(self, text: str, value: Any):
+        if not self.enabled:
+            return
+        key = self.normalize(text)
+        if not key:
+            return
+        with self._lock:
+            self._insert(key, value)
+
+    def _insert(self, key: str, value: Any):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        elif self.similarity_threshold > 0:
+            signature = minhash_signature(key)
+            self._signatures[key] = signature
+            for band in self._bands(signature):
+                self._buckets.setdefault(band, set()).add(key)
+        self._entries[key] = value
+        while len(self._entries) > self.max_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            self._forget_signature(evicted)
+            self.evictions.inc()
+        self.size.set(len(self._entries))
+
+    def _forget_signature(self, key: str):
+        signature = self._signatures.pop(key, None)
+        if signature is None:
+            return
+        for band in self._bands(signature):
+            bucket = self._buckets.get(band)
+            if bucket:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band]
+
+    # --- Persistence ---
+
+    def load(self):
+        if not self.enabled or not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                items = json.load(f)
+            with self._lock:
+                for key, value in items:
+                    if key:
+                        self._insert(key, value)
+            logging.info(f"Loaded {len(self._entries)} entries into the {self.name} response cache.")
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not load {self.name} response cache from {self.path}: {e}")
+
+    def save(self):
+        if not self.enabled or not self.path:
+            return
+        with self._lock:
+            items = list(self._entries.items()) # Oldest first, so reloading keeps LRU order
+        tmp_path = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(items, f)
+            os.replace(tmp_path, self.path) # Atomic, so a crash never leaves a half-written cache
+        except OSError as e:
+            logging.warning(f"Could not save {self.name} response cache to {self.path}: {e}")
+
+    def stats(self) -> dict:
+        hits = self.exact_hits.value + self.similar_hits.value
+        lookups = hits + self.misses.value
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "similarity_threshold": self.similarity_threshold,
+            "exact_hits": self.exact_hits.value,
+            "similar_hits": self.similar_hits.value,
+            "misses": self.misses.value,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions.value,
+        }
+
+
+def followup_cache_key(significant_emotions: list, summary: Optional[str], history_lines: List[str]) -> str:
+    """
+    Follow-up questions are reused only for identical prompt inputs: emotions, rolling summary and the
+    windowed history lines (see chatbot_logic.window_followup_history).
+    """
+    return json.dumps([list(significant_emotions), summary, list(history_lines)])
+
+# --- End of response_cache.py ---
@@ -0,0 +1,137 @@
+# structured_decoding.py
+import os
+import re
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from chatbot_logic import EMOTION_LIST, build_emotion_prompt, parse_emotion_response
+from metrics import Counter, Histogram
+
+# === CONFIGURATION ===
+# "structured" fills in the emotion template itself and only lets the model choose the numbers.
+# Models without token-level access (e.g. MockLLM) always use the free-form prompt.
+EMOTION_DECODING = os.getenv("EMOTION_DECODING", "structured").lower()
+MAX_SCORE_DIGITS = 3 # 0-100
+
+# === Metrics ===
+STRUCTURED_CALLS = Counter("emotion_structured_calls_total", "Emotion scores produced by constrained decoding.")
+STRUCTURED_FAILURES = Counter("emotion_structured_failures_total", "Constrained decodes that failed and fell back to free-form.")
+GENERATED_TOKENS = Histogram("emotion_structured_generated_tokens", "Tokens sampled per constrained emotion decode.",
+                             buckets=(10, 20, 30, 40, 60, 80, 120, 300))
+
+NUMBER_TOKEN_RE = re.compile(r"^( ?)(\d{1,3})$")
+
+
+def supports_constrained_decoding(llm: Any) -> bool:
+    """ctransformers models expose tokenize/eval/logits; the MockLLM doesn't."""
+    return all(callable(getattr(llm, name, None)) for name in ("tokenize", "detokenize", "eval", "prepare_inputs_for_generation")) \
+        and hasattr(llm, "logits")
+
+
+# === Vocabulary ===
+
+class _ScoreVocabulary:
+    """Token ids the model may pick while writing a score: numbers (with/without a leading space) and '%'."""
+
+    def __init__(self, llm: Any):
+        self.leading: Dict[int, str] = {} # " 25" style tokens, only allowed as the first piece
+        self.plain: Dict[int, str] = {}
+        self.terminators: List[int] = []
+        vocab_size = getattr(llm, "vocab_size", None) or len(llm.logits)
+        for token in range(vocab_size):
+            try:
+                text = llm.detokenize([token])
+            except Exception:
+                continue
+            match = NUMBER_TOKEN_RE.match(text)
+            if match:
+                (self.leading if match.group(1) else self.plain)[token] = match.group(2)
+            elif text.startswith("%"):
+                self.terminators.append(token)
+        if not self.plain:
+            raise ValueError("Model vocabulary has no number tokens; constrained decoding is unavailable.")
+
+
+_vocabularies: Dict[int, _ScoreVocabulary] = {}
+_vocab_lock = threading.Lock()
+
+
+def _score_vocabulary(llm: Any) -> _ScoreVocabulary:
+    with _vocab_lock:
+        if id(llm) not in _vocabularies:
+            _vocabularies[id(llm)] = _ScoreVocabulary(llm) # One vocabulary scan per model, at first use
+        return _vocabularies[id(llm)]
+
+
+def _best(logits: Any, candidates) -> Optional[int]:
+    best_token, best_logit = None, float("-inf")
+    for token in candidates:
+        if logits[token] > best_logit:
+            best_token, best_logit = token, logits[token]
+    return best_token
+
+
+# === Constrained Decoding ===
+
+def decode_emotion_scores(text: str, llm: Any) -> Tuple[dict, List[int], int]:
+    """
+    Writes the 'emotion: N%' template for every EMOTION_LIST key, sampling only the numbers.
+    The emotion names and separators are fed to the model rather than generated, each number is
+    picked greedily among number tokens, and decoding stops right after the last emotion.
+    Returns (scores, tokens now in the model's context, tokens sampled).
+    """
+    vocab = _score_vocabulary(llm)
+    context = list(llm.tokenize(build_emotion_prompt(text) + "Emotion Probabilities:\n"))
+    # Keeps the prefix this prompt shares with the model's context (e.g. the instructions) and evaluates the rest
+    llm.eval(llm.prepare_inputs_for_generation(context, reset=True))
+
+    lines = []
+    generated = 0
+    for i, emotion in enumerate(EMOTION_LIST):
+        separator = "%\n" if i else "" # Close the previous score before naming the next emotion
+        forced = llm.tokenize(f"{separator}{emotion}:", add_bos_token=False)
+        llm.eval(forced)
+        context.extend(forced)
+
+        digits = ""
+        while len(digits) < MAX_SCORE_DIGITS:
+            room = MAX_SCORE_DIGITS - len(digits)
+            candidates = [t for t, s in vocab.plain.items() if len(s) <= room]
+            if not digits:
+                candidates += [t for t, s in vocab.leading.items() if len(s) <= room]
+            else:
+                candidates += vocab.terminators
+            token = _best(llm.logits, candidates)
+            if token is None or token in vocab.terminators:
+                break
+            llm.eval([token])
+            context.append(token)
+            generated += 1
+            digits += vocab.plain.get(token) or vocab.leading[token]
+        lines.append(f"{emotion}: {min(100, int(digits or 0))}%")
+
+    scores = parse_emotion_response("Emotion Probabilities:\n" + "\n".join(lines)) # Same normalization as free-form
+    return scores, context, generated
+
+
+def score_emotions_structured(text: str, llm: Any, cache: Optional[Any] = None) -> Optional[dict]:
+    """
+    Executor job for constrained emotion scoring. Returns None if decoding fails, so the caller can
+    retry with the free-form prompt. Keeps the prefix cache's view of the model's context current.
+    """
+    try:
+        scores, context, generated = decode_emotion_scores(text, llm)
+    except Exception as e:
+        STRUCTURED_FAILURES.inc()
+        logging.warning(f"Constrained emotion decoding failed, using free-form prompt: {e}")
+        if cache:
+            cache.record_resident(llm, ())
+        return None
+    if cache:
+        cache.record_resident(llm, context)
+    STRUCTURED_CALLS.inc()
+    GENERATED_TOKENS.observe(generated)
+    return scores
+
+# --- End of structured_decoding.py ---
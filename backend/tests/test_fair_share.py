@@ -0,0 +1,156 @@
+# test_fair_share.py
+import asyncio
+
+import pytest
+
+from fair_share import SHED, STARVED, FairShareScheduler, TurnShed, TurnStarved
+
+
+async def turn(scheduler, user_id, order, new=False, hold=0.002):
+    """One chat turn: waits for a slot, records when it got it, holds it for `hold` seconds."""
+    grant = await scheduler.acquire(user_id, new)
+    order.append(user_id)
+    await asyncio.sleep(hold)
+    grant.release()
+
+
+async def flood_then_light(scheduler, flood):
+    """Queues the `flood` turns behind a busy slot, then one turn of a light user; returns the grant order."""
+    order = []
+    tasks = [asyncio.create_task(turn(scheduler, user_id, order, new)) for user_id, new in flood]
+    await asyncio.sleep(0) # Everyone in the flood is waiting now
+    tasks.append(asyncio.create_task(turn(scheduler, "light", order)))
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_light_user_is_not_stuck_behind_one_users_flood():
+    scheduler = FairShareScheduler(capacity=1, user_rate=0, max_waiting=100)
+    order = asyncio.run(flood_then_light(scheduler, [("heavy", False)] * 30))
+    # FIFO would serve all 30 heavy turns first; fair share serves the light user within a round
+    assert order.index("light") <= 2
+
+
+def test_light_user_is_not_stuck_behind_a_flood_of_new_user_ids():
+    scheduler = FairShareScheduler(capacity=1, user_rate=0, max_waiting=100, priority="continuing")
+    order = asyncio.run(flood_then_light(scheduler, [(f"bot-{i}", True) for i in range(30)]))
+    assert order.index("light") <= 2
+
+
+def test_rate_limited_turns_are_shed_and_counted():
+    async def run():
+        scheduler = FairShareScheduler(capacity=4, user_rate=0.01, user_burst=2)
+        for _ in range(2):
+            (await scheduler.acquire("u", new=False)).release()
+        with pytest.raises(TurnShed) as shed:
+            await scheduler.acquire("u", new=False)
+        (await scheduler.acquire("other", new=False)).release() # Buckets are per user
+        return shed.value
+
+    before = SHED["rate_limited"].value
+    shed = asyncio.run(run())
+    assert shed.reason == "rate_limited" and shed.retry_after > 0
+    assert SHED["rate_limited"].value == before + 1
+
+
+def test_full_queue_sheds_and_counts():
+    async def run():
+        scheduler = FairShareScheduler(capacity=1, user_rate=0, max_waiting=1, priority="none")
+        grant = await scheduler.acquire("a", new=False)
+        waiting = asyncio.create_task(scheduler.acquire("b", new=False))
+        await asyncio.sleep(0)
+        with pytest.raises(TurnShed) as shed:
+            await scheduler.acquire("c", new=False)
+        grant.release()
+        (await waiting).release()
+        return shed.value
+
+    before = SHED["queue_full"].value
+    assert asyncio.run(run()).reason == "queue_full"
+    assert SHED["queue_full"].value == before + 1
+
+
+def test_preferred_turn_displaces_a_waiting_turn_of_the_other_kind():
+    async def run():
+        scheduler = FairShareScheduler(capacity=1, user_rate=0, max_waiting=1, priority="continuing")
+        grant = await scheduler.acquire("a", new=False)
+        newcomer = asyncio.create_task(scheduler.acquire("b", new=True))
+        await asyncio.sleep(0)
+        continuing = asyncio.create_task(scheduler.acquire("c", new=False))
+        await asyncio.sleep(0)
+        with pytest.raises(TurnShed) as shed:
+            await newcomer
+        grant.release()
+        (await continuing).release()
+        return shed.value, scheduler
+
+    before = SHED["displaced"].value
+    shed, scheduler = asyncio.run(run())
+    assert shed.reason == "displaced"
+    assert SHED["displaced"].value == before + 1
+    assert scheduler.active == 0 and scheduler.waiting == 0
+
+
+def test_turn_waiting_past_max_wait_is_starved():
+    async def run():
+        scheduler = FairShareScheduler(capacity=1, user_rate=0, max_wait=0.01)
+        grant = await scheduler.acquire("a", new=False)
+        with pytest.raises(TurnStarved):
+            await scheduler.acquire("b", new=False)
+        grant.release()
+        return scheduler
+
+    before = STARVED.value
+    scheduler = asyncio.run(run())
+    assert STARVED.value == before + 1
+    assert scheduler.waiting == 0
+
+
+@pytest.mark.parametrize("priority", ["continuing", "new"])
+def test_preferred_kind_is_served_first(priority):
+    async def run():
+        scheduler = FairShareScheduler(capacity=1, user_rate=0, priority=priority, priority_weight=4)
+        order = []
+        grant = await scheduler.acquire("holder", new=False)
+        tasks = []
+        for i in range(3): # Interleaved arrivals, the non-preferred kind first each time
+            for new in (priority == "continuing", priority == "new"):
+                kind = "new" if new else "continuing"
+                tasks.append(asyncio.create_task(turn(scheduler, f"{kind}-{i}", order, new)))
+                await asyncio.sleep(0)
+        grant.release()
+        await asyncio.gather(*tasks)
+        return order
+
+    order = asyncio.run(run())
+    assert [user_id.split("-")[0] for user_id in order[:3]] == [priority] * 3
+
+
+def test_no_priority_serves_users_in_arrival_order():
+    async def run():
+        scheduler = FairShareScheduler(capacity=1, user_rate=0, priority="none")
+        order = []
+        grant = await scheduler.acquire("holder", new=False)
+        tasks = []
+        for user_id, new in [("a", True), ("b", False), ("c", True), ("d", False)]:
+            tasks.append(asyncio.create_task(turn(scheduler, user_id, order, new)))
+            await asyncio.sleep(0)
+        grant.release()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ["a", "b", "c", "d"]
+
+
+def test_background_work_gets_only_a_free_slot():
+    async def run():
+        scheduler = FairShareScheduler(capacity=2, user_rate=0)
+        background = scheduler.try_acquire_idle()
+        grant = await scheduler.acquire("a", new=False)
+        assert scheduler.try_acquire_idle() is None # Both slots taken
+        background.release()
+        grant.release()
+        return scheduler
+
+    scheduler = asyncio.run(run())
+    assert scheduler.active == 0 and scheduler.waiting == 0
@@ -0,0 +1,121 @@
+# test_http_client.py
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import http_client
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers each request with the next status in `statuses` (the last one repeats); 307 redirects to itself."""
+    statuses = [200]
+    calls = 0
+
+    def do_GET(self):
+        cls = type(self)
+        status = cls.statuses[min(cls.calls, len(cls.statuses) - 1)]
+        cls.calls += 1
+        self.send_response(status)
+        if status == 307:
+            self.send_header("Location", self.path)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    """Starts a stub provider; call it with the statuses to serve and it returns the URL."""
+    handler = type("Handler", (StubHandler,), {})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def serve(*statuses):
+        handler.statuses = list(statuses)
+        handler.calls = 0
+        return f"http://127.0.0.1:{server.server_port}/search"
+
+    serve.handler = handler
+    yield serve
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(http_client, "HTTP_BACKOFF_BASE", 0.0)
+
+
+def open_breaker(provider: str) -> http_client.CircuitBreaker:
+    """A breaker that opens on the first failure and lets a trial call through right away."""
+    breaker = http_client.get_breaker(provider)
+    breaker.failure_threshold = 1
+    breaker.reset_timeout = 0.0
+    breaker.record_failure()
+    assert breaker.state == "open"
+    return breaker
+
+
+def test_retries_transient_statuses(stub):
+    url = stub(503, 502, 200)
+    response = http_client.request("retry-ok", "GET", url, retries=2, timeout=5)
+    assert response.status_code == 200
+    assert stub.handler.calls == 3
+    assert http_client.get_breaker("retry-ok").state == "closed"
+
+
+def test_gives_up_after_retries(stub):
+    url = stub(503)
+    with pytest.raises(requests.HTTPError):
+        http_client.request("retry-exhausted", "GET", url, retries=2, timeout=5)
+    assert stub.handler.calls == 3
+    assert http_client.get_breaker("retry-exhausted").failures == 1
+
+
+def test_does_not_retry_client_errors(stub):
+    url = stub(404)
+    with pytest.raises(requests.HTTPError):
+        http_client.request("no-retry", "GET", url, retries=2, timeout=5)
+    assert stub.handler.calls == 1
+
+
+def test_open_breaker_short_circuits(stub):
+    url = stub(200)
+    breaker = open_breaker("short-circuit")
+    breaker.reset_timeout = 60.0
+    with pytest.raises(http_client.CircuitOpen):
+        http_client.request("short-circuit", "GET", url, timeout=5)
+    assert stub.handler.calls == 0
+
+
+def test_half_open_trial_success_closes(stub):
+    url = stub(200)
+    breaker = open_breaker("half-open-close")
+    http_client.request("half-open-close", "GET", url, retries=0, timeout=5)
+    assert breaker.state == "closed"
+    assert breaker.failures == 0
+
+
+def test_half_open_trial_failure_reopens(stub):
+    url = stub(503)
+    breaker = open_breaker("half-open-reopen")
+    with pytest.raises(requests.HTTPError):
+        http_client.request("half-open-reopen", "GET", url, retries=0, timeout=5)
+    assert breaker.state == "open"
+
+
+def test_half_open_trial_other_request_errors_reopen(stub):
+    url = stub(307) # Redirects to itself until requests raises TooManyRedirects
+    breaker = open_breaker("half-open-redirects")
+    with pytest.raises(requests.TooManyRedirects):
+        http_client.request("half-open-redirects", "GET", url, retries=0, timeout=5)
+    assert breaker.state == "open"
+    # Once it reopens, a later trial can still close it
+    stub(200)
+    http_client.request("half-open-redirects", "GET", url, retries=0, timeout=5)
+    assert breaker.state == "closed"
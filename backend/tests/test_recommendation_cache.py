@@ -0,0 +1,28 @@
+# test_recommendation_cache.py
+import asyncio
+
+import recommendation_cache
+from chatbot_logic import PROVIDER_FALLBACKS
+
+
+def test_failing_provider_is_not_refetched_every_pass(monkeypatch):
+    calls = []
+
+    def movies_down(primary_emotion, spotify_keyword, sp, limit=2):
+        calls.append(primary_emotion)
+        results = {category: [f"{category} {i}" for i in range(limit)] for category in ("books", "songs")}
+        return dict(results, movies=PROVIDER_FALLBACKS["movies"]), ["movies"]
+
+    monkeypatch.setattr(recommendation_cache, "fetch_all_providers", movies_down)
+
+    async def run():
+        cache = recommendation_cache.RecommendationCache(None, refresh_interval=0.01, retry_after=60)
+        served = await cache.get(["sadness"])
+        cache.start()
+        await asyncio.sleep(0.3) # About 30 refresh passes
+        cache.stop()
+        return served
+
+    served = asyncio.run(run())
+    assert served["movies"] == PROVIDER_FALLBACKS["movies"]
+    assert calls == ["sadness"]
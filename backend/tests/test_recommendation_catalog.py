@@ -0,0 +1,69 @@
+# test_recommendation_catalog.py
+import time
+
+import pytest
+
+from chatbot_logic import PROVIDER_EMPTY, PROVIDER_FALLBACKS, recommendation_key
+from recommendation_catalog import RecommendationCatalog
+
+
+def results_for(emotion: str) -> dict:
+    return {category: [f"{emotion} {category} {i}" for i in range(4)] for category in ("movies", "books", "songs")}
+
+
+@pytest.fixture
+def catalog():
+    catalog = RecommendationCatalog(":memory:")
+    yield catalog
+    catalog.close()
+
+
+def test_lookup_rotates_stored_items(catalog):
+    catalog.store("joy", "joy", results_for("joy"), failed=[])
+    first = catalog.lookup("joy", "joy")
+    second = catalog.lookup("joy", "joy")
+    assert first["movies"] == ["joy movies 0", "joy movies 1"]
+    assert second["movies"] == ["joy movies 2", "joy movies 3"]
+
+
+def test_shared_song_keyword_is_not_a_hit(catalog):
+    # Both are downer moods, so their songs are stored under the same "uplifting" keyword
+    anger, sadness = recommendation_key(["anger"]), recommendation_key(["sadness"])
+    assert anger[1] == sadness[1]
+    catalog.store(*anger, results_for("anger"), failed=[])
+    assert catalog.lookup(*sadness) is None
+
+    catalog.store(*sadness, results_for("sadness"), failed=[])
+    served = catalog.lookup(*sadness)
+    assert served["movies"][0].startswith("sadness")
+    assert served["books"][0].startswith("sadness")
+
+
+def test_missing_categories_keep_failed_and_empty_apart(catalog):
+    results = results_for("joy")
+    results["movies"] = PROVIDER_FALLBACKS["movies"]
+    results["books"] = PROVIDER_EMPTY["books"]
+    catalog.store("joy", "joy", results, failed=["movies"])
+    served = catalog.lookup("joy", "joy")
+    assert served["movies"] == PROVIDER_FALLBACKS["movies"]
+    assert served["books"] == PROVIDER_EMPTY["books"]
+    assert served["songs"][0] == "joy songs 0"
+
+
+def test_failed_fetches_back_off(catalog):
+    catalog.retry_after = 0.2
+    catalog.max_age = 10.0
+    assert catalog.stale("joy", "joy")
+    catalog.store("joy", "joy", dict(results_for("joy"), movies=PROVIDER_FALLBACKS["movies"]), failed=["movies"])
+    assert not catalog.stale("joy", "joy")
+    time.sleep(0.25)
+    assert catalog.stale("joy", "joy")
+    catalog.store("joy", "joy", dict(results_for("joy"), movies=PROVIDER_FALLBACKS["movies"]), failed=["movies"])
+    time.sleep(0.25)
+    assert not catalog.stale("joy", "joy") # Second failure in a row waits twice as long
+    time.sleep(0.2)
+    assert catalog.stale("joy", "joy")
+
+
+def test_unknown_emotion_misses(catalog):
+    assert catalog.lookup("joy", "joy") is None
@@ -0,0 +1,32 @@
+# test_response_cache.py
+from response_cache import ResponseCache, followup_cache_key, normalize_text
+
+
+def test_normalize_keeps_non_latin_words():
+    assert normalize_text("Très   FATIGUÉ!!") == "très fatigué"
+    assert normalize_text("मैं बहुत दुखी हूँ।") == "मैं बहुत दुखी हूँ"
+    assert normalize_text("I'm sad 😢") == "i'm sad"
+    assert normalize_text("😊 !!") == ""
+
+
+def test_different_scripts_do_not_share_a_key():
+    cache = ResponseCache("test_scripts", max_entries=10, persist_dir="")
+    cache.put("मैं बहुत दुखी हूँ", "sad")
+    assert cache.get("मैं बहुत खुश हूँ") is None
+    assert cache.get("मैं बहुत दुखी हूँ!") == "sad"
+
+
+def test_empty_keys_are_never_cached():
+    cache = ResponseCache("test_empty", max_entries=10, persist_dir="")
+    cache.put("😢", "sad")
+    assert cache.get("😊") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_exact_keys_skip_normalization():
+    cache = ResponseCache("test_exact", max_entries=10, persist_dir="", normalize=str)
+    sad = followup_cache_key(["sadness"], None, ["user: 😢"])
+    happy = followup_cache_key(["sadness"], None, ["user: 😊"])
+    cache.put(sad, "Why?")
+    assert cache.get(happy) is None
+    assert cache.get(sad) == "Why?"
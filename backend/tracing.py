@@ -0,0 +1,78 @@
+# tracing.py
+import os
+import uuid
+import logging
+import contextvars
+
+from metrics import Histogram
+
+# === CONFIGURATION ===
+# Tag each request with a trace ID (the caller's X-Request-ID, or a new one) and add it to every log line
+TRACE_REQUESTS = os.getenv("TRACE_REQUESTS", "true").lower() in ("1", "true", "yes")
+TRACE_HEADER = "x-request-id"
+
+TRACE_ID: contextvars.ContextVar = contextvars.ContextVar("trace_id", default=None)
+
+# === Stage Timing ===
+# Where a /chat/message request spends its time. Recommendation providers have their own
+# histograms in chatbot_logic since they run in the provider pool.
+STAGES = ("state_lookup", "fair_share_wait", "emotion_detection", "prompt_build", "llm_inference", "recommendations", "response_serialization")
+STAGE_SECONDS = {
+    stage: Histogram("chat_stage_seconds", "Time spent in each stage of handling a chat message.", labels={"stage": stage})
+    for stage in STAGES
+}
+
+
+def stage(name: str):
+    """Context manager timing one pipeline stage: `with stage("state_lookup"): ...`."""
+    return STAGE_SECONDS[name].time()
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+class TraceIdFilter(logging.Filter):
+    """Adds `trace_id` to log records so formats can include %(trace_id)s."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = TRACE_ID.get() or "-"
+        return True
+
+
+def install_log_filter():
+    # Handler filters (unlike logger filters) also see records propagated from module loggers
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(TraceIdFilter())
+
+
+class TraceMiddleware:
+    """
+    ASGI middleware that sets the trace ID for the duration of an HTTP request and echoes it
+    back in the X-Request-ID response header. Work submitted to the inference executor and the
+    recommendation pool copies the context, so their log lines carry the same ID.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not TRACE_REQUESTS:
+            await self.app(scope, receive, send)
+            return
+
+        supplied = dict(scope.get("headers") or []).get(TRACE_HEADER.encode())
+        trace_id = supplied.decode("latin-1")[:64] if supplied else new_trace_id()
+
+        async def send_with_trace_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers") or []) + [(TRACE_HEADER.encode(), trace_id.encode("latin-1"))]
+            await send(message)
+
+        token = TRACE_ID.set(trace_id)
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        finally:
+            TRACE_ID.reset(token)
+
+# --- End of tracing.py ---